@@ -1,24 +1,59 @@
 #!/miniconda3/envs/py39us/bin/python
 # coding: utf-8
 import argparse
+import filecmp
+import heapq
 import json
 import os
+import queue
 import shlex
+import shutil
+import stat as stat_mode
+import sys
+import threading
 import time
+import xmlrpc.client
+from array import array
 from concurrent.futures import ThreadPoolExecutor
-from copy import deepcopy
 from enum import Enum
-from typing import List
-
-import pandas as pd
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
 
+from autoscale import WorkerScaler
+from common import dir_slot_acquire
+from common import file_hash_cached_get
 from common import file_size_format
-from common import getstatusoutput_s
-from common import sh2bash
 from common import str_md5_get
+from common import time_format
 from common import time_now_get
-from common import user_time_get
-from common import video_duration_get
+from compress_cache import CompressCache
+from compress_policy import CompressCalibration
+from compress_policy import CompressPolicy
+from compress_policy import policy_key_get
+from cost_model import CostModel
+from cost_model import compress_pixels
+from cost_model import cost_feature_get
+from job_db import JobDB
+from log_writer import AsyncLogWriter
+from log_writer import DEBUG
+from log_writer import INFO
+from log_writer import WARNING
+from log_writer import level_get
+from log_writer import level_names
+from probe_cache import ProbeCache
+from report_sink import ReportWriter
+from report_sink import report_formats
+from report_sink import report_xlsx_export
+from runner import ProcUsage
+from runner import run
+from slot_allocator import DeviceSlots
+from slot_allocator import SlotAllocator
+from slot_allocator import device_name_get
+from slot_allocator import device_spec_parse
+from walker import WalkFilter
+from walker import Walker
+from work_queue import LeaseQueue
+from work_queue import WorkQueueClient
+from work_queue import WorkQueueServer
 
 # =================
 
@@ -27,12 +62,19 @@ from common import video_duration_get
 backup = os.path.join(os.getcwd(), "backup")
 log_filename = "batch_far_create.log"
 xlsx_export = "batch_far_create_report.xlsx"
+# 任务结束时逐行写入的报告, 文件名为 {report_name}.{格式}
+report_name = "batch_far_create_report"
 path_report = "batch_far_create_path_report.txt"
+# 分布式模式下日志和报告文件名的后缀, 同一目录中运行的协调进程和多个工作进程不会互相覆盖
+coordinator_report_suffix = "-coordinator"
 
 # 设备相关配置
 # compress_threshold = 1
 compress_threshold = 1280 * 720
+# 校准模式生成的是否压缩的决策表, 保存在缓存目录中, 存在时优先于 compress_threshold
+compress_policy_name = "compress_policy.json"
 
+# 默认的压缩设备, 命令行参数 --ffmpeg_device 指定时不使用
 # ffmpeg_devices = [] 表示不进行解码
 ffmpeg_devices = [
     # CPU设备ID 支持线程个数
@@ -42,79 +84,201 @@ ffmpeg_devices = [
     # [2, 7],
 ]
 
+# CPU/GPU 压缩使用的ffmpeg, 对应命令模板中的 {ffmpeg}
+ffmpeg_bin = "ffmpeg"
+ffmpeg_gpu_bin = "/root/ffmpeg.N-107154-gc11fb46731"
+
+# 命令模板为参数列表, 每个参数单独替换 {ffmpeg} {src} {dst} {gpu_id} {codec}, 直接执行不经过shell
 ffmpeg_shell_tpl = [
-    "time ffmpeg -i {src} -s 400:244 {dst}",
-    "time /root/ffmpeg.N-107154-gc11fb46731 -hwaccel_device {gpu_id} -hwaccel cuvid -c:v {codec}_cuvid -i {src} -c:v h264_nvenc -vf scale_npp=400:-2 -y {dst}"
+    ["{ffmpeg}", "-i", "{src}", "-s", "400:244", "{dst}"],
+    ["{ffmpeg}", "-hwaccel_device", "{gpu_id}", "-hwaccel", "cuvid", "-c:v", "{codec}_cuvid",
+     "-i", "{src}", "-c:v", "h264_nvenc", "-vf", "scale_npp=400:-2", "-y", "{dst}"]
 ]
 
-ffmpeg_rebuild = True
+# 管道模式下ffmpeg的命令模板, 输出为可流式读取的mpegts, 由VDNAGen边压缩边读取
+ffmpeg_pipe_tpl = [
+    ["{ffmpeg}", "-i", "{src}", "-s", "400:244", "-f", "mpegts", "-y", "{dst}"],
+    ["{ffmpeg}", "-hwaccel_device", "{gpu_id}", "-hwaccel", "cuvid", "-c:v", "{codec}_cuvid",
+     "-i", "{src}", "-c:v", "h264_nvenc", "-vf", "scale_npp=400:-2", "-f", "mpegts", "-y", "{dst}"]
+]
+
+# True 时不使用缓存中已经压缩完成的视频, 全部重新压缩
+ffmpeg_rebuild = False
+# 压缩视频缓存的总大小上限, 正在使用的压缩视频占满时压缩任务等待
+compress_cache_quota = 20 * 1024 * 1024 * 1024
+# __compress_cache_prepare 的结果: 可以执行, 缓存空间不足, 相同的压缩视频正在生成或者使用中
+_compress_cache_ready, _compress_cache_full, _compress_cache_busy = range(3)
+# 压缩前预留缓存空间时, 每秒视频的预计压缩大小, 视频时长未知时按源视频大小预留
+compress_bytes_per_sec = 128 * 1024
 vdnagen_rebuild = True
 
+# 超时相关配置
+# ffmpeg/VDNAGen超时时间(秒) = task_timeout_base + 视频时长(秒) x task_timeout_factor, task_timeout_factor<=0 表示不限制
+# 视频时长未知时按 task_timeout_duration_unknown 秒计算, 超时后终止整个进程组
+task_timeout_base = 600
+task_timeout_factor = 10.0
+task_timeout_duration_unknown = 3600
+# ffprobe超时时间(秒)
+probe_timeout = 120
+# 拟合耗时模型时最多使用的已完成任务数量, 只读取最近完成的任务, 启动时间不随历史记录增长
+cost_model_samples = 20000
+
 
 # =================
 
 
+def worker_report_suffix_get(worker: str) -> str:
+    """ 工作进程日志和报告文件名的后缀, worker 为工作进程标识 主机名:进程号
+    """
+    return "-worker-" + worker.replace(":", "-").replace(os.sep, "_")
+
+
 class Reporter:
     backup_dir = backup
 
-    def __init__(self):
+    def __init__(self, level: int = INFO, suffix: str = ""):
+        """
+        :param level: 日志级别, 低于该级别的日志不输出
+        :param suffix: 日志和报告文件名的后缀, 加在扩展名之前, 同一目录中运行多个进程时各自使用不同的后缀
+        """
         os.makedirs(self.backup_dir, exist_ok=True)
+        self.level = level
 
         time_start = time.strftime("%Y%m%d%H%M%S", time.localtime())
 
-        self.__log_path = os.path.join(os.getcwd(), log_filename)
-        self.__log_path_bkp = os.path.join(self.backup_dir, f"{time_start}-{log_filename}")
+        def name_get(name: str) -> str:
+            stem, ext = os.path.splitext(name)
+            return f"{stem}{suffix}{ext}"
+
+        log_name = name_get(log_filename)
+        self.__log_path = os.path.join(os.getcwd(), log_name)
+        self.__log_path_bkp = os.path.join(self.backup_dir, f"{time_start}-{log_name}")
         if os.path.isfile(self.__log_path):
             os.remove(self.__log_path)
 
-        self.__path_report = os.path.join(os.getcwd(), path_report)
-        self.__path_report_bkp = os.path.join(self.backup_dir, f"{time_start}-{path_report}")
+        path_report_name = name_get(path_report)
+        self.__path_report = os.path.join(os.getcwd(), path_report_name)
+        self.__path_report_bkp = os.path.join(self.backup_dir, f"{time_start}-{path_report_name}")
         if os.path.isfile(self.__path_report):
             os.remove(self.__path_report)
 
-        self.__xlsx_export = os.path.join(os.getcwd(), xlsx_export)
-        self.__xlsx_export_bkp = os.path.join(self.backup_dir, f"{time_start}-{xlsx_export}")
+        self.__xlsx_export = os.path.join(os.getcwd(), name_get(xlsx_export))
+        self.__xlsx = True
+        self.__time_start = time_start
+        self.__report_prefix = os.path.join(os.getcwd(), report_name + suffix)
+        self.__report_prefix_bkp = os.path.join(self.backup_dir, f"{time_start}-{report_name}{suffix}")
+        self.__report_writer: Optional[ReportWriter] = None
+
+        # 日志和far路径由后台线程批量写入, 文件只打开一次
+        self.__log_writer = AsyncLogWriter([self.__log_path, self.__log_path_bkp])
+        self.__path_writer = AsyncLogWriter([self.__path_report, self.__path_report_bkp], echo=False)
 
-    def log_write(self, msg: str) -> None:
+    def is_enabled(self, level: int) -> bool:
+        return level >= self.level
+
+    def log_write(self, msg: str, level: int = INFO) -> None:
         """ 写入日志
         """
-        msg = f"[{time_now_get()}] {msg}"
-        print(msg)
-        with open(self.__log_path, mode="a", encoding="utf-8") as f:
-            f.write(msg + "\n")
-        with open(self.__log_path_bkp, mode="a", encoding="utf-8") as f:
-            f.write(msg + "\n")
+        if level < self.level:
+            return
+        self.__log_writer.write(f"[{time_now_get()}] {msg}")
 
     def path_write(self, far_path: str) -> None:
         """ 记录生成的far文件路径
         """
-        with open(self.__path_report, mode="a", encoding="utf-8") as f:
-            f.write(far_path + "\n")
-        with open(self.__path_report_bkp, mode="a", encoding="utf-8") as f:
-            f.write(far_path + "\n")
+        self.__path_writer.write(far_path)
 
-    def xlsx_write(self, df: pd.DataFrame) -> None:
-        """ far生成报告导出
+    def flush(self) -> None:
+        """ 等待日志和far路径全部写入文件
         """
-        df.to_excel(self.__xlsx_export)
-        df.to_excel(self.__xlsx_export_bkp)
+        self.__log_writer.flush()
+        self.__path_writer.flush()
+
+    def report_open(self, columns: List[str], formats: List[str], xlsx: bool = True) -> None:
+        """
+        打开报告文件, 之后每个任务结束时写入一行
+        :param columns: 报告列名
+        :param formats: 报告格式 csv jsonl parquet
+        :param xlsx: 结束时是否转换为xlsx, xlsx由csv或jsonl报告转换, 两者都没有时同时生成csv报告
+        :return:
+        """
+        formats = list(dict.fromkeys(formats))
+        if xlsx and "csv" not in formats and "jsonl" not in formats:
+            formats.append("csv")
+        self.__xlsx = xlsx
+        self.__report_writer = ReportWriter(self.__report_prefix, columns, formats)
+
+    def report_write(self, row: dict) -> None:
+        """ 写入报告的一行
+        """
+        self.__report_writer.write(row)
+
+    def report_close(self) -> None:
+        """ 关闭报告文件, 复制到备份目录, 需要时转换为xlsx
+        """
+        if self.__report_writer is None:
+            return
+        writer = self.__report_writer
+        self.__report_writer = None
+        writer.close()
+        for path in writer.paths():
+            shutil.copyfile(path, self.__report_prefix_bkp + os.path.splitext(path)[1])
+        if not self.__xlsx:
+            return
+        src = writer.path_get("jsonl") or writer.path_get("csv")
+        for xlsx_path in report_xlsx_export(src, self.__xlsx_export, writer.columns):
+            shutil.copyfile(xlsx_path, os.path.join(self.backup_dir, f"{self.__time_start}-{os.path.basename(xlsx_path)}"))
 
 
 class MediaInfo:
-    __cmd_tpl = "ffprobe {media_path} -show_streams -select_streams v -print_format json"
+    # 一次ffprobe同时获得视频流信息和容器信息(容器时长作为视频流时长的备选)
+    __cmd_tpl = ["ffprobe", "{media_path}", "-show_streams", "-show_format", "-select_streams", "v",
+                 "-print_format", "json"]
 
-    def __init__(self, media_path: str):
+    def __init__(self, media_path: str,
+                 cache: Optional[ProbeCache] = None,
+                 stat: Optional[os.stat_result] = None):
+        """
+        :param media_path: 视频文件路径
+        :param cache: 视频信息缓存, 文件未变化时直接使用缓存结果
+        :param stat: 视频文件的stat信息, 为None时重新获取
+        """
         self.media_path = media_path
-        self.__cmd = sh2bash(self.__cmd_tpl.format(media_path=shlex.quote(media_path)))
+        self.__cmd = [arg.format(media_path=media_path) for arg in self.__cmd_tpl]
 
         self.__sts = -1
-        self.__data = ""
-        if os.path.isfile(media_path):
-            self.__sts, self.__data = getstatusoutput_s(self.__cmd)
-
+        self.__data = {}
+        self.__format = {}
+        if stat is None:
+            try:
+                stat = os.stat(media_path)
+            except OSError:
+                return
+
+        cached = None
+        if cache is not None:
+            cached = cache.get(media_path, stat.st_size, stat.st_mtime_ns)
+        if cached is not None:
+            self.__sts, probe = cached
+        else:
+            res = run(self.__cmd, timeout=probe_timeout)
+            self.__sts = res.status
+            probe = self.__output_parse(res.output)
+            if cache is not None:
+                cache.put(media_path, stat.st_size, stat.st_mtime_ns, self.__sts, probe)
+        self.__data = probe.get("stream", {})
+        self.__format = probe.get("format", {})
+
+    @staticmethod
+    def __output_parse(output: str) -> dict:
+        """
+        从ffprobe的输出中提取第一个视频流信息以及容器信息
+        :param output: ffprobe输出
+        :return:
+        """
         data_ = []
         report = False
-        for line in self.__data.split("\n"):
+        for line in output.split("\n"):
             if line == "{":
                 report = True
             if report:
@@ -133,10 +297,14 @@ class MediaInfo:
                 del data_[i]
 
         data_ = "\n".join(data_)
+        res = {}
         try:
-            self.__data = json.loads(data_)["streams"][0]
+            js = json.loads(data_)
+            res["stream"] = js["streams"][0]
+            res["format"] = js.get("format", {})
         except Exception:
-            self.__data = {}
+            pass
+        return res
 
     @property
     def status(self):
@@ -145,10 +313,12 @@ class MediaInfo:
     @property
     def duration(self):
         duration = self.__meta_info_get("duration")
+        if duration is None:
+            duration = self.__format.get("duration", None)
         if duration is not None:
             duration = int(float(duration))
         else:
-            duration = video_duration_get(self.media_path)
+            duration = -1
         return duration
 
     @property
@@ -181,125 +351,472 @@ class TaskStatus(Enum):
     dnagen_runing = 9
     dnagen_done = 10
     dnagen_error = 11
+    compress_timeout = 12
+    dnagen_timeout = 13
 
 
 class Task:
+    """ 任务记录
+    批量任务数量可以达到百万级, 使用 __slots__ 不为每个任务创建属性字典;
+    不保存命令字符串和Future, 时间保存为时间戳, 只在写日志和报告时格式化
+    """
+    __slots__ = ["status", "media_path", "media_size", "media_mtime_ns", "media_dev", "media_ino", "media_width", "media_height", "media_codec",
+                 "media_duration", "media_hash", "duplicate_of", "fpg_gpu_id", "fpg_device_idx", "fpg_pipe", "compress_key", "compress_path",
+                 "compress_size",
+                 "compress_start_time", "compress_end_time", "compress_time_used", "compress_usage",
+                 "vdg_start_time", "vdg_end_time", "vdg_time_used", "vdg_usage", "far_path", "far_size"]
+
     def __init__(self):
         self.status = TaskStatus.null
         self.media_path = ""
         self.media_size = 0
+        self.media_mtime_ns = 0
+        # 源视频的设备号和inode, 与大小和修改时间一起标识压缩视频缓存中的源文件
+        self.media_dev = 0
+        self.media_ino = 0
         self.media_width = -1
         self.media_height = -1
         self.media_codec = ""
         self.media_duration = -1
+        # 源视频抽样指纹, 只在需要压缩或者去重时计算
+        self.media_hash = ""
+        # 内容相同的视频中第一个视频的路径, 不为空时不生成far, 复用该视频的far
+        self.duplicate_of = ""
 
         # -1表示cpu 0 1 ... 表示gpu 其他无意义
         self.fpg_gpu_id = -2
-        self.fpg_task_proc = None
+        # 执行压缩任务的设备在 SlotAllocator.devices 中的索引
+        self.fpg_device_idx = -1
+        # 是否通过管道把压缩结果交给VDNAGen
+        self.fpg_pipe = False
+        # 压缩视频在 CompressCache 中的键, 为空表示压缩视频不由缓存管理
+        self.compress_key = ""
         self.compress_path = ""
         self.compress_size = -1
-        self.compress_cmd = ""
-        self.compress_start_time = ""
-        self.compress_end_time = ""
+        self.compress_start_time = 0.0
+        self.compress_end_time = 0.0
         self.compress_time_used = -1
+        self.compress_usage: Optional[ProcUsage] = None
 
-        self.vdg_task_proc = None
-        self.vdg_cmd = ""
-        self.vdg_start_time = ""
-        self.vdg_end_time = ""
+        self.vdg_start_time = 0.0
+        self.vdg_end_time = 0.0
         self.vdg_time_used = -1
+        self.vdg_usage: Optional[ProcUsage] = None
         self.far_path = ""
         self.far_size = -1
 
 
+# 报告列名
+report_columns = [
+    "media_path",
+    "media_size",
+    "media_codec",
+    "media_shape",
+    "media_duration(s)",
+    "far_path",
+    "far_size",
+    "status",
+    "gpu_device",
+    "gpu_start_time",
+    "gpu_end_time",
+    "gpu_time_used(s)",
+    "gpu_user_time(s)",
+    "gpu_sys_time(s)",
+    "gpu_max_rss(MB)",
+    "gpu_read(MB)",
+    "gpu_write(MB)",
+    "vdnagen_start_time",
+    "vdnagen_end_time",
+    "vdnagen_time_used(s)",
+    "vdnagen_user_time(s)",
+    "vdnagen_sys_time(s)",
+    "vdnagen_max_rss(MB)",
+    "vdnagen_read(MB)",
+    "vdnagen_write(MB)",
+    "duplicate_of",
+]
+
+
+def far_place(src: str, dst: str) -> None:
+    """
+    把已经生成的far放到另一个路径, 优先使用硬链接, 不在同一个文件系统时复制
+    :param src: 已经生成的far
+    :param dst: 目标路径
+    :return:
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def media_dir_walk(media_dir: str, far_dir: str, walk_filter: Optional[WalkFilter] = None, walk_workers: int = 1,
+                   on_error: Optional[Callable[[str, OSError], None]] = None) \
+        -> Iterator[Tuple[str, str, Optional[os.stat_result]]]:
+    """
+    遍历视频文件夹的视频，在far文件夹创建对应文夹保存far文件, 支持递归
+    :param media_dir: 视频文件文件夹
+    :param far_dir: 生成的far文件文件夹
+    :param walk_filter: 文件过滤条件
+    :param walk_workers: 同时读取目录的线程数
+    :param on_error: 目录无法读取时的回调
+    :return: (视频路径, far文件路径, 视频文件stat信息)
+    """
+    os.makedirs(far_dir, exist_ok=True)
+    media_dir = os.path.abspath(media_dir)
+    far_dir = os.path.abspath(far_dir)
+    far_dirs = {""}
+    walker = Walker(walk_filter, workers=walk_workers, on_error=on_error)
+    for entry in walker.walk(media_dir):
+        if entry.rel_dir not in far_dirs:
+            os.makedirs(os.path.join(far_dir, entry.rel_dir), exist_ok=True)
+            far_dirs.add(entry.rel_dir)
+        media_name, _ = os.path.splitext(entry.name)
+        far_path = os.path.join(far_dir, entry.rel_dir, media_name + ".far")
+        yield entry.path, far_path, entry.stat
+
+
+def media_file_read(file: str, far_dir: str) -> Iterator[Tuple[str, str, Optional[os.stat_result]]]:
+    """
+    读取指明视频路径的文本文件, far文件保存在far文件夹下, 文件名为 序号-视频文件名
+    :param file: 文本文件, 每行一个视频路径
+    :param far_dir: 生成的far文件文件夹
+    :return: (视频路径, far文件路径, None)
+    """
+    if not os.path.isfile(file):
+        return
+    os.makedirs(far_dir, exist_ok=True)
+    with open(file, mode="r", encoding="utf-8") as f:
+        for idx, media_path in enumerate(f):
+            media_path = os.path.abspath(media_path.strip())
+            media_name = os.path.basename(media_path)
+            far_name = f"{idx + 1}-{media_name}"
+            far_path = os.path.abspath(os.path.join(far_dir, far_name))
+            yield media_path, far_path, None
+
+
 class FarCreater:
-    __reporter = Reporter()
 
-    def __init__(self, num_workers: int = 40, fpg_cache: str = "/tmp/far_create/"):
+    def __init__(self, num_workers: int = 40, fpg_cache: str = "/tmp/far_create/", probe_workers: int = 8,
+                 probe_cache: Optional[ProbeCache] = None, pipe: bool = False,
+                 job_db: Optional[JobDB] = None, rebuild: bool = False,
+                 vdg_cost_model: Optional[CostModel] = None, fpg_cost_model: Optional[CostModel] = None,
+                 autoscale: bool = False, min_workers: int = 1, max_workers: Optional[int] = None,
+                 autoscale_interval: float = 30.0, mem_min: int = 1024 * 1024 * 1024,
+                 timeout_base: float = task_timeout_base, timeout_factor: float = task_timeout_factor,
+                 log_level: int = INFO, report_formats: Optional[List[str]] = None, report_xlsx: bool = True,
+                 walk_filter: Optional[WalkFilter] = None, walk_workers: int = 1,
+                 fpg_devices: Optional[List[Tuple[int, int]]] = None, ffmpeg: str = ffmpeg_bin,
+                 ffmpeg_gpu: str = ffmpeg_gpu_bin, compress_policy: Optional[CompressPolicy] = None,
+                 compress_quota: int = compress_cache_quota, dedup: bool = False, report_suffix: str = ""):
+        # report_suffix: 日志和报告文件名的后缀, 分布式模式下每个工作进程使用自己的文件
+        self.__reporter = Reporter(log_level, report_suffix)
+        # 是否压缩的决策表, 由校准模式生成, 为None时按分辨率阈值判断
+        self.__compress_policy = compress_policy
+        # 遍历视频文件夹时的过滤条件和读取目录的线程数, 默认排除far文件
+        self.__walk_filter = walk_filter if walk_filter is not None else WalkFilter(exclude_exts=[".far"])
+        self.__walk_workers = walk_workers
+        # 任务结束时逐行写入报告, report_xlsx 为True时全部任务结束后再转换为xlsx
+        self.__reporter.report_open(report_columns, ["csv"] if report_formats is None else report_formats,
+                                    report_xlsx)
         self.__fpg_cache = fpg_cache
+        # 子进程超时时间 = timeout_base + 视频时长 x timeout_factor, 超时的任务不再占用工作线程
+        self.__timeout_base = timeout_base
+        self.__timeout_factor = timeout_factor
+        self.__probe_cache = probe_cache
+        # 任务数据库: 记录任务状态, 重新运行时跳过已经完成的任务, rebuild 为True时全部重新生成
+        self.__job_db = job_db
+        self.__rebuild = rebuild
+        # 任务耗时模型, 用于任务排序: 预计耗时长的任务先执行, 减少批处理末尾只有少数线程运行的时间
+        self.__vdg_cost_model = vdg_cost_model if vdg_cost_model is not None else CostModel("VDNAGen")
+        self.__fpg_cost_model = fpg_cost_model if fpg_cost_model is not None else CostModel("ffmpeg")
+        # 管道模式: ffmpeg 压缩结果通过命名管道直接交给VDNAGen, 不生成中间文件
+        # VDNAGen不能读取管道时, 自动关闭管道模式, 回退到中间文件
+        self.__pipe = pipe
+        self.__pipe_supported = True
         os.makedirs(self.__fpg_cache, exist_ok=True)
+        # 压缩视频缓存: VDNAGen使用结束后可以被淘汰, 重新运行时直接使用已经压缩完成的视频
+        self.__compress_cache = CompressCache(os.path.join(self.__fpg_cache, "cache"), compress_quota)
+        self.__compress_cache_full = False
+        # 键 -> 等待同一个压缩视频生成或者使用结束的压缩任务, 元素与 __fpg_tasks_wait 相同
+        self.__compress_cache_parked: Dict[str, List[Tuple[float, int]]] = {}
+        # 去重: 内容相同的视频只生成一次far, 其他路径通过硬链接或者复制得到far
+        # 指纹 -> 第一个视频路径, 在解析线程中查询和写入
+        self.__dedup = dedup
+        self.__dedup_lock = threading.Lock()
+        self.__dedup_index: Dict[str, str] = {}
+        # 第一个视频路径 -> 等待它结束的重复视频任务索引; 结束后记录在 __dedup_done 中
+        self.__dedup_waiting: Dict[str, List[int]] = {}
+        self.__dedup_done: Dict[str, Task] = {}
+        self.__dedup_groups: Set[str] = set()
+        self.__dedup_files: int = 0
         self.__tasks: List[Task] = []
-        self.__tasks_init_error: List[Task] = []
+        self.__tasks_init_error: int = 0  # 视频解析失败的任务数量, 任务结束时已经写入报告, 不再保留
 
         self.__num_workers = 1
         if num_workers > 1:
             self.__num_workers = num_workers
 
-        # 放置不同状态的任务索引
-        self.__fpg_devices = ffmpeg_devices
-        # 创建关于fpg的线程池
-        self.__fpg_pools = []
-        # 特殊情况，gpu_id = -1 cpu
-        for gpu_id, gpu_thread in self.__fpg_devices:
-            self.__fpg_pools.append(ThreadPoolExecutor(max_workers=gpu_thread))
-
-        self.__fpg_tasks_wait: List[int] = []  # ffmpeg 还没开始运行的
-        self.__fpg_tasks_running: List[int] = []  # ffmpeg 正在运行的
-        self.__fpg_tasks_done: List[int] = []  # ffmpeg 已经运行结束的
-        self.__fpg_tasks_error: List[int] = []  # ffmpeeg运行出错的任务
+        # 并发数自动调整: 在 [min_workers, max_workers] 范围内根据系统负载调整VDNAGen和ffmpeg的并发数
+        self.__vdg_scaler: Optional[WorkerScaler] = None
+        self.__fpg_scaler: Optional[WorkerScaler] = None
+        vdg_pool_workers = self.__num_workers
+        if autoscale:
+            if max_workers is None:
+                max_workers = max(self.__num_workers, os.cpu_count() or 1)
+            self.__vdg_scaler = WorkerScaler("VDNAGen", self.__num_workers, min_workers, max_workers,
+                                             interval=autoscale_interval, mem_min=mem_min)
+            self.__num_workers = self.__vdg_scaler.workers
+            vdg_pool_workers = self.__vdg_scaler.max_workers
+
+        # 视频信息解析(ffprobe)线程池, 与任务发现并行执行
+        # 信号量限制正在解析的任务数量, 避免任务发现过快时堆积大量待解析任务
+        probe_workers = max(1, probe_workers)
+        self.__probe_pool = ThreadPoolExecutor(max_workers=probe_workers)
+        self.__probe_slots = threading.BoundedSemaphore(probe_workers * 4)
+        self.__probe_submitted: int = 0  # 已提交解析的任务数量, 只在任务发现线程中修改
+        self.__probe_finished: int = 0  # 已解析完成的任务数量, 只在主线程中修改
+        self.__discover_thread: Optional[threading.Thread] = None
+        # 分布式模式下的协调进程任务队列, 以及限制同时持有任务数量的信号量
+        self.__lease_client: Optional[WorkQueueClient] = None
+        self.__lease_slots: Optional[threading.BoundedSemaphore] = None
+
+        # 压缩设备的线程分配, 任务按各设备线程数加权分散到所有设备, 任务结束时归还并记录设备处理速度
+        self.__fpg_slots = SlotAllocator(ffmpeg_devices if fpg_devices is None else fpg_devices)
+        self.__ffmpeg_bins = (ffmpeg, ffmpeg_gpu)
+        # 所有设备共用一个线程池, 线程数为设备线程总数
+        self.__fpg_pool: Optional[ThreadPoolExecutor] = None
+        if self.__fpg_slots.slots > 0:
+            self.__fpg_pool = ThreadPoolExecutor(max_workers=self.__fpg_slots.slots)
+        # 同时运行的压缩任务数量上限, 自动调整并发数时在 [1, 设备线程总数] 范围内变化
+        self.__fpg_limit: int = self.__fpg_slots.slots
+        if autoscale and self.__fpg_limit > 0:
+            self.__fpg_scaler = WorkerScaler("ffmpeg", self.__fpg_limit, 1, self.__fpg_limit,
+                                             interval=autoscale_interval, mem_min=mem_min)
+
+        # 任务事件队列, 线程池中的任务结束时通过回调写入 (stage, data)
+        self.__events: "queue.Queue[Tuple[str, Any]]" = queue.Queue()
+
+        # 等待队列为堆, 元素为 (-预计耗时, task_id), 先运行预计耗时长的任务
+        self.__fpg_tasks_wait: List[Tuple[float, int]] = []  # ffmpeg 还没开始运行的
+        self.__fpg_tasks_running: Set[int] = set()  # ffmpeg 正在运行的
+        # 结束的任务索引只追加, 使用紧凑的整数数组
+        self.__fpg_tasks_done: "array[int]" = array("q")  # ffmpeg 已经运行结束的
+        self.__fpg_tasks_error: "array[int]" = array("q")  # ffmpeeg运行出错的任务
 
         # ffmpeg 结果查询的控制变量
         self.__fpg_tasks_done_tr: int = 0  # ffmpeg 已经运行结束的 上次遍历结束的位置
         self.__fpg_tasks_error_tr: int = 0  # ffmpeg 运行错误的 上次遍历结束的位置
 
-        self.__vdg_pool = ThreadPoolExecutor(max_workers=self.__num_workers)
-        self.__vdg_tasks_wait: List[int] = []  # VDNAGen 还没开始运行的
-        self.__vdg_tasks_running: List[int] = []  # VDNAGen 正在运行的
-        self.__vdg_tasks_done: List[int] = []  # VDNAGen 已经运行结束的
-        self.__vdg_tasks_error: List[int] = []  # VDNAGen 运行出错的任务
+        self.__vdg_pool = ThreadPoolExecutor(max_workers=vdg_pool_workers)
+        self.__vdg_tasks_wait: List[Tuple[float, int]] = []  # VDNAGen 还没开始运行的
+        self.__vdg_tasks_running: Set[int] = set()  # VDNAGen 正在运行的
+        self.__vdg_tasks_done: "array[int]" = array("q")  # VDNAGen 已经运行结束的
+        self.__vdg_tasks_error: "array[int]" = array("q")  # VDNAGen 运行出错的任务
 
         # VDNAGen 结果查询的控制变量
         self.__vdg_tasks_done_tr: int = 0  # VDNAGen 已经运行结束的 上次遍历结束的位置
         self.__vdg_tasks_error_tr: int = 0  # VDNAGen 运行错误的 上次遍历结束的位置
 
+        self.__tasks_skip: int = 0  # 上次运行已经完成而跳过的任务数量
+
     def _is_need_compress(self, task: Task, th: int = compress_threshold) -> bool:
         """
-        判断视频是否需要进行压缩，判断逻辑是视频的宽高
+        判断视频是否需要进行压缩, 优先使用校准得到的决策表, 决策表中没有对应的编码和分辨率时按视频的宽高判断
         :param task:
         :param th: media width x height < th
         :return:
         """
-        if len(self.__fpg_pools) > 0:
+        if self.__fpg_slots.slots > 0:
             width = task.media_width
             height = task.media_height
-            return width > 0 and height > 0 and (th / width) < height
+            if width <= 0 or height <= 0:
+                return False
+            if self.__compress_policy is not None:
+                decision = self.__compress_policy.decide(task.media_codec, width, height)
+                if decision is not None:
+                    return decision
+            return (th / width) < height
         return False
 
+    def __task_timeout_get(self, task: Task) -> Optional[float]:
+        """
+        获得任务中单个子进程(ffmpeg/VDNAGen)的超时时间
+        :param task: 任务
+        :return: 超时时间(秒), 不限制时返回None
+        """
+        if self.__timeout_factor <= 0:
+            return None
+        duration = task.media_duration
+        if duration is None or duration <= 0:
+            duration = task_timeout_duration_unknown
+        return self.__timeout_base + duration * self.__timeout_factor
+
+    def __task_probe(self, media_path: str, far_path: str, stat: os.stat_result) -> Task:
+        """
+        解析视频信息并创建任务, 在解析线程池中运行
+        :param media_path: 视频文件路径
+        :param far_path: 生成的far文件路径
+        :param stat: 视频文件的stat信息
+        :return:
+        """
+        meta = MediaInfo(media_path, cache=self.__probe_cache, stat=stat)
+
+        res = Task()
+        res.media_path = media_path
+        res.far_path = far_path
+        res.media_size = stat.st_size
+        res.media_mtime_ns = stat.st_mtime_ns
+        res.media_dev = stat.st_dev
+        res.media_ino = stat.st_ino
+        if meta.status != 0:
+            res.status = TaskStatus.parse_error
+        else:
+            try:
+                res.media_duration = meta.duration
+                res.media_width = meta.width
+                res.media_height = meta.height
+                # 编码名称只有少数几种, 所有任务共用同一个字符串对象
+                res.media_codec = sys.intern(meta.codec) if isinstance(meta.codec, str) else meta.codec
+                res.status = TaskStatus.task_create
+            except Exception:
+                res.status = TaskStatus.parse_error
+        if res.status == TaskStatus.task_create and (self.__dedup or self._is_need_compress(res)):
+            # 压缩视频缓存的键和去重使用源视频内容指纹, 在解析线程中计算, 不占用主线程
+            # 管道模式下VDNAGen不能读取管道时回退为中间文件, 同样需要指纹
+            try:
+                res.media_hash = file_hash_cached_get(media_path, "sample", stat=stat)
+            except OSError:
+                res.media_hash = f"{media_path}:{stat.st_size}:{stat.st_mtime_ns}"
+            if self.__dedup:
+                res.duplicate_of = self.__duplicate_find(res)
+        return res
+
+    def __duplicate_find(self, task: Task) -> str:
+        """
+        查找内容相同并且更早发现的视频, 在解析线程中运行
+        抽样指纹相同时逐字节比较, 确认内容完全相同
+        :param task: 已经计算指纹的任务
+        :return: 内容相同的视频路径, 没有时返回空字符串
+        """
+        with self.__dedup_lock:
+            primary = self.__dedup_index.setdefault(task.media_hash, task.media_path)
+        if primary == task.media_path:
+            return ""
+        try:
+            if filecmp.cmp(primary, task.media_path, shallow=False):
+                return primary
+        except OSError:
+            pass
+        return ""
+
+    def __task_probe_done(self, media_path: str, future) -> None:
+        """ 视频解析结束回调, 释放解析名额并通知主线程
+        """
+        self.__probe_slots.release()
+        try:
+            task = future.result()
+        except Exception:
+            task = Task()
+            task.media_path = media_path
+            task.status = TaskStatus.parse_error
+        self.__event_post("probe", task)
+
     def task_add(self, media_path: str,
-                 far_path: str) -> None:
+                 far_path: str, stat: Optional[os.stat_result] = None) -> bool:
         """
-        添加任务信息
+        添加任务信息, 视频信息在解析线程池中异步获取, 解析完成后任务直接进入执行队列
         :param media_path: 视频/far文件路径
         :param far_path: 生成的far文件路径
-        :return:
+        :param stat: 视频文件的stat信息, 遍历目录时已经获取, 为None时重新获取
+        :return: 视频文件不存在时返回False
         """
         media_path = os.path.abspath(media_path)
         far_path = os.path.abspath(far_path)
-        if os.path.isfile(media_path):
-            # 通过文件后缀名过滤
-            meta = MediaInfo(media_path)
-
-            res = Task()
-            res.media_path = media_path
-            res.far_path = far_path
-            res.media_size = os.path.getsize(media_path)
-            if meta.status != 0:
-                self.__reporter.log_write(f"{media_path} ffmpeg get meta info failed.")
-                res.status = TaskStatus.parse_error
-                self.__tasks_init_error.append(res)
-            else:
-                try:
-                    res.media_duration = meta.duration
-                    res.media_width = meta.width
-                    res.media_height = meta.height
-                    res.media_codec = meta.codec
-                    res.status = TaskStatus
-                    self.__tasks.append(res)
-                except Exception:
-                    self.__reporter.log_write(f"{media_path} ffmpeg get meta info failed.")
-                    self.__tasks_init_error.append(res)
-        else:
-            self.__reporter.log_write(f"{media_path} not exists.")
+        if stat is None:
+            try:
+                stat = os.stat(media_path)
+            except OSError:
+                stat = None
+        if stat is None or not stat_mode.S_ISREG(stat.st_mode):
+            self.__reporter.log_write(f"{media_path} not exists.", WARNING)
+            return False
+
+        task = self.__task_done_get(media_path, far_path, stat)
+        if task is not None:
+            # 上次运行已经完成, 不需要重新解析和生成
+            self.__event_post("skip", task)
+            return True
+
+        # 正在解析的任务过多时阻塞任务发现
+        self.__probe_slots.acquire()
+        self.__probe_submitted += 1
+        future = self.__probe_pool.submit(self.__task_probe, media_path, far_path, stat)
+        future.add_done_callback(lambda f, path=media_path: self.__task_probe_done(path, f))
+        return True
+
+    def __task_done_get(self, media_path: str, far_path: str, stat: os.stat_result) -> Optional[Task]:
+        """
+        从任务数据库中查询上次运行已经完成的任务
+        :param media_path: 视频文件路径
+        :param far_path: 生成的far文件路径
+        :param stat: 视频文件的stat信息
+        :return: 已完成的任务, 视频文件发生变化、far文件不存在或者未完成时返回None
+        """
+        if self.__job_db is None or self.__rebuild:
+            return None
+        job = self.__job_db.job_done_get(media_path, stat.st_size, stat.st_mtime_ns, far_path,
+                                         TaskStatus.dnagen_done.value)
+        if job is None:
+            return None
+        try:
+            if os.path.getsize(far_path) != job["far_size"]:
+                return None
+        except OSError:
+            return None
+        task = Task()
+        for field in JobDB.job_fields:
+            if field != "status":
+                setattr(task, field, job[field])
+        if isinstance(task.media_codec, str):
+            task.media_codec = sys.intern(task.media_codec)
+        task.status = TaskStatus.no_need_dnagen
+        return task
+
+    def __job_update(self, task: Task, status: Optional[TaskStatus] = None) -> None:
+        """
+        在任务数据库中记录任务状态
+        :param task: 任务
+        :param status: 记录的状态, 为None时使用任务的当前状态
+        :return:
+        """
+        if self.__job_db is None:
+            return
+        job = {field: getattr(task, field) for field in JobDB.job_fields}
+        job["status"] = (task.status if status is None else status).value
+        self.__job_db.job_update(job)
+
+    def tasks_discover(self, input: str, far_dir: str) -> None:
+        """
+        在后台线程中发现任务, 与视频解析以及far生成同时进行
+        :param input: 视频文件所在路径或指明视频路径的文本文件
+        :param far_dir: far文件所在路径
+        :return:
+        """
+
+        def discover():
+            try:
+                if os.path.isfile(input):
+                    self.tasks_add_from_file(input, far_dir)
+                else:
+                    self.tasks_add_from_dir(input, far_dir)
+            finally:
+                self.__event_post("discover", self.__probe_submitted)
+
+        self.__discover_thread = threading.Thread(target=discover, name="far-create-discover", daemon=True)
+        self.__discover_thread.start()
 
     def tasks_add_from_dir(self, media_dir: str, far_dir: str) -> None:
         """
@@ -308,31 +825,81 @@ class FarCreater:
         :param far_dir: 生成的far文件文件夹
         :return:
         """
-        os.makedirs(far_dir, exist_ok=True)
 
-        for sub in os.listdir(media_dir):
-            sub_path = os.path.join(media_dir, sub)
-            if os.path.isdir(sub_path):
-                sub_media_dir = sub_path
-                sub_far_dir = os.path.join(far_dir, sub)
-                self.tasks_add_from_dir(sub_media_dir, sub_far_dir)
-            elif os.path.isfile(sub_path) and not sub_path.endswith(".far"):
-                media_path = sub_path
-                media_name, _ = os.path.splitext(sub)
-                far_path = os.path.join(far_dir, media_name + ".far")
-                self.task_add(media_path, far_path)
+        def on_error(path: str, e: OSError):
+            self.__reporter.log_write(f"{path} can not be read: {e}", WARNING)
+
+        for media_path, far_path, stat in media_dir_walk(media_dir, far_dir, self.__walk_filter, self.__walk_workers,
+                                                         on_error):
+            self.task_add(media_path, far_path, stat)
 
     def tasks_add_from_file(self, file: str, far_dir: str):
-        if not os.path.isfile(file):
-            return
-        os.makedirs(far_dir, exist_ok=True)
-        with open(file, mode="r", encoding="utf-8") as f:
-            for idx, media_path in enumerate(f.readlines()):
-                media_path = media_path.strip()
-                media_name = os.path.basename(media_path)
-                far_name = f"{idx + 1}-{media_name}"
-                far_path = os.path.join(far_dir, far_name)
-                self.task_add(media_path, far_path)
+        for media_path, far_path, _ in media_file_read(file, far_dir):
+            self.task_add(media_path, far_path)
+
+    def tasks_lease(self, client: WorkQueueClient) -> None:
+        """
+        分布式模式: 在后台线程中从协调进程租用任务, 任务结束时把报告行提交给协调进程
+        同时持有的任务数量不超过工作线程数的2倍, 其余任务留给其他工作进程
+        :param client: 协调进程任务队列
+        :return:
+        """
+        self.__lease_client = client
+        self.__lease_slots = threading.BoundedSemaphore(self.__num_workers * 2)
+
+        def discover():
+            try:
+                while True:
+                    self.__lease_slots.acquire()
+                    items = client.lease(1)
+                    if len(items) == 0:
+                        self.__lease_slots.release()
+                        if client.finished():
+                            break
+                        # 其他工作进程的租约到期后任务会重新放回队列
+                        time.sleep(client.poll_interval)
+                        continue
+                    media_path = items[0]["task"]["media_path"]
+                    far_path = items[0]["task"]["far_path"]
+                    if not self.task_add(media_path, far_path):
+                        # 本机无法访问视频文件, 同样作为解析错误提交结果
+                        task = Task()
+                        task.media_path = media_path
+                        task.far_path = far_path
+                        task.status = TaskStatus.parse_error
+                        self.__probe_submitted += 1
+                        self.__event_post("probe", task)
+            except (OSError, xmlrpc.client.Error) as e:
+                self.__reporter.log_write(f"coordinator not available: {e}", WARNING)
+            finally:
+                self.__event_post("discover", self.__probe_submitted)
+
+        self.__discover_thread = threading.Thread(target=discover, name="far-create-lease", daemon=True)
+        self.__discover_thread.start()
+
+    def __fpg_cmd_get(self, task: Task, dst: str, tpls: List[List[str]]) -> List[str]:
+        """
+        生成压缩命令
+        :param task: 任务
+        :param dst: 压缩视频保存路径
+        :param tpls: 命令模板 [CPU模板, GPU模板]
+        :return: 命令参数列表
+        """
+        gpu_id = task.fpg_gpu_id
+        # 判断使用什么方式进行压缩 -1 CPU <=1 GPU
+        tpl = tpls[0] if gpu_id < 0 else tpls[1]
+        ffmpeg = self.__ffmpeg_bins[0] if gpu_id < 0 else self.__ffmpeg_bins[1]
+        return [arg.format(ffmpeg=ffmpeg, src=task.media_path, dst=dst, gpu_id=gpu_id, codec=task.media_codec)
+                for arg in tpl]
+
+    @staticmethod
+    def __vdg_cmd_get(task: Task) -> List[str]:
+        """
+        生成基因生成命令, 压缩过的视频使用压缩结果(压缩文件或者命名管道)
+        :param task: 任务
+        :return: 命令参数列表
+        """
+        return ["VDNAGen", task.compress_path or task.media_path, "-o", task.far_path]
 
     def __fpg_runner(self, task_id: int) -> None:
         if 0 <= task_id < len(self.__tasks):
@@ -344,111 +911,261 @@ class FarCreater:
             task.status = TaskStatus.compress_error
             return
         task.status = TaskStatus.compress_running
-        media_path = task.media_path
-        media_name = os.path.basename(media_path)
-        cache_dir = os.path.join(self.__fpg_cache, str_md5_get(media_path.encode("utf-8")))
-        os.makedirs(cache_dir, exist_ok=True)
-        # 压缩视频保存路径
-        compress_path = os.path.join(cache_dir, media_name)
-        task.compress_path = compress_path
-
-        gpu_id = task.fpg_gpu_id
-        codec = task.media_codec
-        # 判断使用什么方式进行压缩 -1 CPU <=1 GPU
-        if gpu_id < 0:
-            tpl = ffmpeg_shell_tpl[0]
-            cmd = sh2bash(tpl.format(src=shlex.quote(media_path), dst=shlex.quote(compress_path)))
+        if task.compress_key:
+            # 压缩视频由缓存管理, 先写入临时文件, 压缩成功后由主线程提交到缓存
+            compress_path = CompressCache.tmp_path_get(task.compress_path)
         else:
-            tpl = ffmpeg_shell_tpl[1]
-            cmd = sh2bash(
-                tpl.format(src=shlex.quote(media_path), dst=shlex.quote(compress_path), gpu_id=gpu_id, codec=codec))
-        task.compress_cmd = cmd
-
-        if ffmpeg_rebuild and os.path.isfile(compress_path):
-            # 删除早期压缩的视频文件
+            media_path = task.media_path
+            media_name = os.path.basename(media_path)
+            cache_dir = os.path.join(self.__fpg_cache, str_md5_get(media_path.encode("utf-8")))
+            os.makedirs(cache_dir, exist_ok=True)
+            # 压缩视频保存路径
+            compress_path = os.path.join(cache_dir, media_name)
+            task.compress_path = compress_path
+
+        task.fpg_pipe = False
+        cmd = self.__fpg_cmd_get(task, compress_path, ffmpeg_shell_tpl)
+
+        if os.path.isfile(compress_path):
+            # 删除上次没有完成的压缩结果, 缓存中已经压缩完成的视频在分配任务时由 CompressCache.get 直接使用
             os.remove(compress_path)
 
-        time_used = 0
-        status = 0
-        time_begin = time_now_get()
-        if not os.path.isfile(compress_path):
-            status, output = getstatusoutput_s(cmd)
-            time_used = user_time_get(output)
-        time_end = time_now_get()
+        time_begin = time.time()
+        res = run(cmd, timeout=self.__task_timeout_get(task))
+        status, usage, timed_out = res.status, res.usage, res.timed_out
+        time_end = time.time()
 
         task.compress_start_time = time_begin
         task.compress_end_time = time_end
-        task.compress_time_used = time_used
-        if status == 0 and os.path.isfile(compress_path):
+        task.compress_time_used = usage.wall_time
+        task.compress_usage = usage
+        if timed_out:
+            task.status = TaskStatus.compress_timeout
+        elif status == 0 and os.path.isfile(compress_path):
             task.compress_size = os.path.getsize(compress_path)
             task.status = TaskStatus.compress_done
         else:
             task.status = TaskStatus.compress_error
 
-    def __fpg_tasks_queue_update(self) -> None:
-        # 1 统计ffmpeg已经完成的任务
-        tasks = []
-        for task_id in self.__fpg_tasks_running:
-            task: Task = self.__tasks[task_id]
-            task_proc = task.fpg_task_proc
-            if task_proc.done():
-                # task_proc.result()
-                tasks.append(task_id)
-
-        # 2 删除ffmpeg已经完成的任务
-        for task_id in tasks:
-            self.__fpg_tasks_running.remove(task_id)
-            task: Task = self.__tasks[task_id]
-            # 注意在compress_error状态下的任务是不会被添加到vndgen执行队列的
-            # 但是compress_done的任务可能在当前ffmpeg队列还没被更新的时候已经添加到了vdnagen队列
-            if task.status == TaskStatus.compress_done:
-                self.__fpg_tasks_done.append(task_id)
-                # 把压缩视频已经生成，加入到VDNAGen执行队列中
-                self.__vdg_tasks_wait.append(task_id)
+    def __event_post(self, stage: str, data: Any) -> None:
+        """ 线程池任务结束回调, 通知主线程回收资源
+        """
+        self.__events.put((stage, data))
+
+    def __vdg_cost_get(self, task: Task, compressed: bool) -> float:
+        """
+        预测VDNAGen耗时
+        :param task: 任务
+        :param compressed: VDNAGen是否使用压缩后的视频
+        :return:
+        """
+        if compressed:
+            x = cost_feature_get(task.media_duration, compress_pixels, 1)
+        else:
+            x = cost_feature_get(task.media_duration, task.media_width, task.media_height)
+        return self.__vdg_cost_model.predict(task.media_codec, x)
+
+    def __fpg_cost_get(self, task: Task) -> float:
+        """
+        预测压缩任务耗时, 包括压缩以及之后对压缩视频的VDNAGen
+        :param task: 任务
+        :return:
+        """
+        x = cost_feature_get(task.media_duration, task.media_width, task.media_height)
+        return self.__fpg_cost_model.predict(task.media_codec, x) + self.__vdg_cost_get(task, True)
+
+    def __task_schedule(self, task: Task) -> None:
+        """ 解析完成的任务分拣
+        确定任务是否需要进行视频压缩，并加入对应的执行队列
+        """
+        self.__probe_finished += 1
+        if task.status != TaskStatus.task_create:
+            self.__reporter.log_write(f"{task.media_path} ffmpeg get meta info failed.", WARNING)
+            self.__tasks_init_error += 1
+            if task.far_path:
+                self.__job_update(task)
+            self.__task_report_write(task)
+            return
+        task_id = len(self.__tasks)
+        self.__tasks.append(task)
+        if task.duplicate_of:
+            # 重复的视频不进入执行队列, 等待内容相同的视频生成far
+            primary = self.__dedup_done.get(task.duplicate_of)
+            if primary is None:
+                self.__dedup_waiting.setdefault(task.duplicate_of, []).append(task_id)
             else:
-                self.__fpg_tasks_error.append(task_id)
+                self.__duplicate_finish(task_id, primary)
+            return
+        # 不管是否需要压缩，都按照预计耗时从长到短排列
+        if self._is_need_compress(task, compress_threshold):
+            task.status = TaskStatus.need_compress
+            heapq.heappush(self.__fpg_tasks_wait, (-self.__fpg_cost_get(task), task_id))
+        else:
+            task.status = TaskStatus.no_need_compress
+            heapq.heappush(self.__vdg_tasks_wait, (-self.__vdg_cost_get(task, False), task_id))
+        self.__job_update(task)
 
-        # 3. 统计每个GPU可以继续装载的任务数量
-        devices = deepcopy(self.__fpg_devices)
-        for task_id in self.__fpg_tasks_running:
-            task: Task = self.__tasks[task_id]
-            gpu_id = task.fpg_gpu_id
-            for device in devices:
-                if device[0] == gpu_id and device[1] > 0:
-                    device[1] -= 1
-                    break
-        # 统计总共需要任务数量
-        new_tasks_cnt = 0
-        for gpu_id, gpu_thread in devices:
-            new_tasks_cnt += gpu_thread
-
-        # 4 根据需要任务的数量获得任务
-        tasks = []  # 新的需要运行的任务
-        for task_id in self.__fpg_tasks_wait:
-            if len(tasks) >= new_tasks_cnt:
-                break
-            tasks.append(task_id)
+    def __duplicates_resolve(self, primary: Task) -> None:
+        """ 任务结束时, 把far放到等待它的重复视频的路径
+        """
+        self.__dedup_done[primary.media_path] = primary
+        for task_id in self.__dedup_waiting.pop(primary.media_path, []):
+            self.__duplicate_finish(task_id, primary)
 
-        # 5 启动新任务
-        device_idx = 0
-        for task_id in tasks:
-            task: Task = self.__tasks[task_id]
-            device = devices[0]
-            if device[1] == 0:
-                device_idx += 1
-                device = devices[1]
-                del devices[0]
+    def __duplicate_finish(self, task_id: int, primary: Task) -> None:
+        """
+        重复视频使用内容相同的视频的far, 内容相同的视频生成失败时同样按失败处理
+        :param task_id: 重复视频的任务索引
+        :param primary: 内容相同并且已经结束的任务
+        """
+        task: Task = self.__tasks[task_id]
+        task.status = TaskStatus.dnagen_error
+        if primary.status == TaskStatus.dnagen_done:
+            try:
+                far_place(primary.far_path, task.far_path)
+                task.far_size = primary.far_size
+                task.status = TaskStatus.dnagen_done
+            except OSError as e:
+                self.__reporter.log_write(f"{task.far_path} can not be created from {primary.far_path}: {e}",
+                                          WARNING)
+        self.__dedup_groups.add(primary.media_path)
+        self.__dedup_files += 1
+        if task.status == TaskStatus.dnagen_done:
+            self.__reporter.path_write(task.far_path)
+            self.__reporter.log_write(f"Duplicate of {primary.media_path}: {task.far_path}")
+        else:
+            self.__reporter.log_write(f"Duplicate of failed {primary.media_path}: {task.media_path}", WARNING)
+        self.__job_update(task)
+        self.__task_report_write(task)
 
-            device[1] -= 1
+    def __task_skip(self, task: Task) -> None:
+        """ 上次运行已经完成的任务, 只记录far文件路径
+        """
+        self.__tasks.append(task)
+        self.__tasks_skip += 1
+        self.__reporter.path_write(task.far_path)
+        self.__task_report_write(task)
 
-            task.fpg_gpu_id = device[0]
+    def __fpg_task_finish(self, task_id: int) -> None:
+        """ ffmpeg 任务结束, 归还设备线程并把压缩完成的任务加入VDNAGen队列
+        """
+        self.__fpg_tasks_running.discard(task_id)
+        task: Task = self.__tasks[task_id]
+        self.__fpg_slots.release(task.fpg_device_idx, task.compress_time_used, task.media_duration,
+                                 task.status == TaskStatus.compress_done)
+        if self.__fpg_scaler is not None:
+            self.__fpg_scaler.task_done()
+        if task.compress_key:
+            self.__compress_cache_unpark(task.compress_key)
+            if task.status == TaskStatus.compress_done:
+                task.compress_size = self.__compress_cache.commit(task.compress_key)
+            else:
+                self.__compress_cache.discard(task.compress_key)
+                task.compress_key = ""
+        self.__job_update(task)
+        # 注意在compress_error状态下的任务是不会被添加到vndgen执行队列的
+        if task.status == TaskStatus.compress_done:
+            self.__fpg_tasks_done.append(task_id)
+            # 把压缩视频已经生成，加入到VDNAGen执行队列中
+            heapq.heappush(self.__vdg_tasks_wait, (-self.__vdg_cost_get(task, True), task_id))
+        else:
+            self.__fpg_tasks_error.append(task_id)
+            self.__task_report_write(task)
+
+    def __fpg_tasks_dispatch(self) -> None:
+        """ 把等待中的压缩任务分配给有空闲线程的设备
+        """
+        while len(self.__fpg_tasks_wait) > 0 and len(self.__fpg_tasks_running) < self.__fpg_limit:
+            pipe = self.__pipe and self.__pipe_supported
+            if pipe and len(self.__vdg_tasks_running) >= self.__num_workers:
+                # 管道模式下压缩任务同时需要一个空闲的VDNAGen线程
+                return
+            device_idx = self.__fpg_slots.acquire()
+            if device_idx < 0:
+                return
+            item = heapq.heappop(self.__fpg_tasks_wait)
+            task_id = item[1]
+            task: Task = self.__tasks[task_id]
+
+            task.fpg_gpu_id = self.__fpg_slots.devices[device_idx].gpu_id
+            task.fpg_device_idx = device_idx
+            if not pipe and task.media_hash:
+                state = self.__compress_cache_prepare(task)
+                if state == _compress_cache_busy:
+                    # 相同的压缩视频正在生成或者使用中, 任务挂在该键上, 结束后重新加入等待队列, 其他任务继续分配
+                    self.__fpg_slots.cancel(device_idx)
+                    task.fpg_gpu_id = -2
+                    task.fpg_device_idx = -1
+                    self.__compress_cache_parked.setdefault(task.compress_key, []).append(item)
+                    task.compress_key = ""
+                    continue
+                if state == _compress_cache_full:
+                    # 正在使用的压缩视频占满缓存配额, VDNAGen使用结束释放后再继续压缩
+                    self.__fpg_slots.cancel(device_idx)
+                    heapq.heappush(self.__fpg_tasks_wait, item)
+                    if not self.__compress_cache_full:
+                        self.__compress_cache_full = True
+                        self.__reporter.log_write(f"{self.__compress_cache.summary()}, waiting for space.", DEBUG)
+                    return
+                self.__compress_cache_full = False
+                if task.status == TaskStatus.compress_done:
+                    # 缓存中已经有压缩完成的视频, 直接进入VDNAGen队列
+                    self.__fpg_slots.cancel(device_idx)
+                    task.fpg_gpu_id = -2
+                    task.fpg_device_idx = -1
+                    self.__fpg_tasks_done.append(task_id)
+                    heapq.heappush(self.__vdg_tasks_wait, (-self.__vdg_cost_get(task, True), task_id))
+                    self.__job_update(task)
+                    continue
             task.status = TaskStatus.need_compress
-            pool = self.__fpg_pools[device_idx]
-            task_proc = pool.submit(self.__fpg_runner, task_id)
-            task.fpg_task_proc = task_proc
+            self.__fpg_tasks_running.add(task_id)
+            if pipe:
+                self.__vdg_tasks_running.add(task_id)
+                task_proc = self.__fpg_pool.submit(self.__pipe_runner, task_id)
+                stage = "pipe"
+            else:
+                task_proc = self.__fpg_pool.submit(self.__fpg_runner, task_id)
+                stage = "fpg"
+            task_proc.add_done_callback(lambda _, tid=task_id, st=stage: self.__event_post(st, tid))
+            self.__job_update(task, TaskStatus.compress_running)
 
-            self.__fpg_tasks_running.append(task_id)
-            self.__fpg_tasks_wait.remove(task_id)
+    def __compress_cache_prepare(self, task: Task) -> int:
+        """
+        在压缩视频缓存中查找或者预留压缩视频, 找到时任务状态设置为压缩完成
+        :param task: 已经分配压缩设备的任务
+        :return: _compress_cache_ready 命中或者已预留空间, _compress_cache_full 缓存空间不足,
+                 _compress_cache_busy 相同的压缩视频正在生成或者使用中, 此时 task.compress_key 为该键
+        """
+        tpl = ffmpeg_shell_tpl[0] if task.fpg_gpu_id < 0 else ffmpeg_shell_tpl[1]
+        ffmpeg = self.__ffmpeg_bins[0] if task.fpg_gpu_id < 0 else self.__ffmpeg_bins[1]
+        key = CompressCache.key_get(task.media_hash, [ffmpeg] + tpl,
+                                    (task.media_dev, task.media_ino, task.media_size, task.media_mtime_ns))
+        path = None if ffmpeg_rebuild else self.__compress_cache.get(key)
+        if path is not None:
+            task.compress_key = key
+            task.compress_path = path
+            task.compress_size = os.path.getsize(path)
+            task.compress_time_used = 0
+            task.status = TaskStatus.compress_done
+            return _compress_cache_ready
+        if self.__compress_cache.busy(key):
+            task.compress_key = key
+            return _compress_cache_busy
+        size = task.media_size
+        if task.media_duration is not None and task.media_duration > 0:
+            size = min(size, int(task.media_duration * compress_bytes_per_sec))
+        path = self.__compress_cache.reserve(key, os.path.basename(task.media_path), max(size, 1))
+        if path is None:
+            return _compress_cache_full
+        task.compress_key = key
+        task.compress_path = path
+        return _compress_cache_ready
+
+    def __compress_cache_unpark(self, key: str) -> None:
+        """ 压缩视频生成结束或者使用结束, 等待该键的任务重新加入压缩等待队列
+        """
+        for item in self.__compress_cache_parked.pop(key, []):
+            heapq.heappush(self.__fpg_tasks_wait, item)
 
     def __vdg_runner(self, task_id: int):
         if 0 <= task_id < len(self.__tasks):
@@ -460,114 +1177,271 @@ class FarCreater:
         if task.status != TaskStatus.need_dnagen:
             task.status = TaskStatus.dnagen_error
             return
-        if os.path.isfile(task.compress_path):
-            media_path = task.compress_path
-        else:
-            media_path = task.media_path
-
         far_path = task.far_path
         task.status = TaskStatus.dnagen_runing
-        cmd = sh2bash(f"time VDNAGen {shlex.quote(media_path)} -o {shlex.quote(far_path)}")
-        task.vdg_cmd = cmd
+        cmd = self.__vdg_cmd_get(task)
 
         if vdnagen_rebuild and os.path.isfile(far_path):
             os.remove(far_path)
 
-        time_used = 0
+        usage = ProcUsage(wall_time=0)
         status = 0
-        time_begin = time_now_get()
+        timed_out = False
+        time_begin = time.time()
         if not os.path.isfile(far_path):
-            status, output = getstatusoutput_s(cmd)
-            time_used = user_time_get(output)
-        time_end = time_now_get()
+            res = run(cmd, timeout=self.__task_timeout_get(task))
+            status, usage, timed_out = res.status, res.usage, res.timed_out
+        time_end = time.time()
         task.vdg_start_time = time_begin
         task.vdg_end_time = time_end
-        task.vdg_time_used = time_used
-        if status == 0 and os.path.isfile(far_path):
+        task.vdg_time_used = usage.wall_time
+        task.vdg_usage = usage
+        if timed_out:
+            task.status = TaskStatus.dnagen_timeout
+            if os.path.isfile(far_path):
+                # 删除不完整的far文件
+                os.remove(far_path)
+        elif status == 0 and os.path.isfile(far_path):
             task.far_size = os.path.getsize(far_path)
             task.status = TaskStatus.dnagen_done
         else:
             task.status = TaskStatus.dnagen_error
 
-    def __vdg_tasks_queue_update(self):
-
-        # 1 统计VDNAGen已经完成的任务
-        tasks = []
-        for task_id in self.__vdg_tasks_running:
-            task: Task = self.__tasks[task_id]
-            task_proc = task.vdg_task_proc
-            if task_proc.done():
-                # task_proc.result()
-                tasks.append(task_id)
-
-        # 2 删除VDNAGen已经完成的任务
-        for task_id in tasks:
-            self.__vdg_tasks_running.remove(task_id)
-            task: Task = self.__tasks[task_id]
-            if task.status == TaskStatus.dnagen_done:
-                self.__vdg_tasks_done.append(task_id)
+    @staticmethod
+    def __fifo_unblock(fifo: str, reader_exited: bool) -> None:
+        """
+        管道一端的进程退出后, 从另一端打开一次管道, 避免对端进程阻塞在open上
+        :param fifo: 命名管道路径
+        :param reader_exited: True 读端(VDNAGen)已退出, False 写端(ffmpeg)已退出
+        :return:
+        """
+        try:
+            if reader_exited:
+                fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
             else:
-                self.__vdg_tasks_error.append(task_id)
+                fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+            os.close(fd)
+        except OSError:
+            # 对端没有阻塞在open上
+            pass
 
-        # 3 获得新任务
-        tasks = []
-        for task_id in self.__vdg_tasks_wait:
-            if len(tasks) + len(self.__vdg_tasks_running) >= self.__num_workers:
+    def __pipe_run(self, task: Task) -> Tuple[int, int]:
+        """
+        通过命名管道同时运行ffmpeg和VDNAGen, 任一进程超时时任务状态设置为对应的超时状态
+        :param task: 任务
+        :return: (ffmpeg退出状态, VDNAGen退出状态)
+        """
+        media_path = task.media_path
+        media_name, _ = os.path.splitext(os.path.basename(media_path))
+        cache_dir = os.path.join(self.__fpg_cache, str_md5_get(media_path.encode("utf-8")))
+        os.makedirs(cache_dir, exist_ok=True)
+        fifo = os.path.join(cache_dir, media_name + ".fifo.ts")
+        if os.path.exists(fifo):
+            os.remove(fifo)
+        os.mkfifo(fifo)
+
+        task.compress_path = fifo
+        task.fpg_pipe = True
+        fpg_cmd = self.__fpg_cmd_get(task, fifo, ffmpeg_pipe_tpl)
+        vdg_cmd = self.__vdg_cmd_get(task)
+
+        results = {}
+        exited: "queue.Queue[str]" = queue.Queue()
+        # 两个进程同时运行, 使用相同的超时时间
+        timeout = self.__task_timeout_get(task)
+
+        def runner(name: str, cmd: List[str]):
+            try:
+                results[name] = run(cmd, timeout=timeout)
+            finally:
+                exited.put(name)
+
+        task.status = TaskStatus.compress_running
+        time_begin = time.time()
+        threads = [threading.Thread(target=runner, args=("vdg", vdg_cmd), daemon=True),
+                   threading.Thread(target=runner, args=("fpg", fpg_cmd), daemon=True)]
+        for thread in threads:
+            thread.start()
+        first = exited.get()
+        if first == "fpg":
+            task.compress_end_time = time.time()
+        while True:
+            # 对端进程可能在之后才打开管道, 需要反复解除阻塞直到它退出
+            self.__fifo_unblock(fifo, reader_exited=first == "vdg")
+            try:
+                exited.get(timeout=0.2)
                 break
-            tasks.append(task_id)
+            except queue.Empty:
+                pass
+        time_end = time.time()
+        if first == "vdg":
+            task.compress_end_time = time_end
+        os.remove(fifo)
+
+        fpg_status, fpg_usage = -1, ProcUsage()
+        if "fpg" in results:
+            fpg_status, fpg_usage = results["fpg"].status, results["fpg"].usage
+        vdg_status, vdg_usage = -1, ProcUsage()
+        if "vdg" in results:
+            vdg_status, vdg_usage = results["vdg"].status, results["vdg"].usage
+        task.compress_start_time = time_begin
+        task.compress_time_used = fpg_usage.wall_time
+        task.compress_usage = fpg_usage
+        task.vdg_start_time = time_begin
+        task.vdg_end_time = time_end
+        task.vdg_time_used = vdg_usage.wall_time
+        task.vdg_usage = vdg_usage
+        if "fpg" in results and results["fpg"].timed_out:
+            task.status = TaskStatus.compress_timeout
+        elif "vdg" in results and results["vdg"].timed_out:
+            task.status = TaskStatus.dnagen_timeout
+        return fpg_status, vdg_status
+
+    def __pipe_runner(self, task_id: int) -> None:
+        """
+        管道模式下的压缩和基因生成任务, 同时占用一个ffmpeg线程和一个VDNAGen线程
+        管道运行失败时, 使用中间文件重新执行一次, 如果成功说明VDNAGen不支持读取管道, 关闭管道模式
+        :param task_id: 任务索引
+        :return:
+        """
+        if 0 <= task_id < len(self.__tasks):
+            task: Task = self.__tasks[task_id]
+        else:
+            return
+        if task.status != TaskStatus.need_compress:
+            task.status = TaskStatus.compress_error
+            return
+
+        far_path = task.far_path
+        if vdnagen_rebuild and os.path.isfile(far_path):
+            os.remove(far_path)
+        if os.path.isfile(far_path):
+            # far文件已经存在, 不需要压缩和基因生成
+            task.status = TaskStatus.dnagen_done
+            task.far_size = os.path.getsize(far_path)
+            return
+
+        if self.__pipe_supported:
+            fpg_status, vdg_status = self.__pipe_run(task)
+            if fpg_status == 0 and vdg_status == 0 and os.path.isfile(far_path):
+                task.far_size = os.path.getsize(far_path)
+                task.status = TaskStatus.dnagen_done
+                return
+            if os.path.isfile(far_path):
+                os.remove(far_path)
+            if task.status in [TaskStatus.compress_timeout, TaskStatus.dnagen_timeout]:
+                # 超时不是管道导致的, 不再使用中间文件重试
+                return
+
+        # 回退到中间文件, 中间文件不由缓存管理, 使用后删除
+        task.status = TaskStatus.need_compress
+        self.__fpg_runner(task_id)
+        if task.status != TaskStatus.compress_done:
+            return
+        task.status = TaskStatus.need_dnagen
+        self.__vdg_runner(task_id)
+        if os.path.isfile(task.compress_path):
+            os.remove(task.compress_path)
+        if task.status == TaskStatus.dnagen_done and self.__pipe_supported:
+            self.__pipe_supported = False
+            self.__reporter.log_write(f"VDNAGen can not read from pipe, fall back to compress file.", WARNING)
+
+    def __pipe_task_finish(self, task_id: int) -> None:
+        """ 管道模式任务结束, 同时归还ffmpeg线程和VDNAGen线程
+        """
+        self.__fpg_tasks_running.discard(task_id)
+        self.__vdg_tasks_running.discard(task_id)
+        task: Task = self.__tasks[task_id]
+        compress_failed = task.status in [TaskStatus.need_compress, TaskStatus.compress_running,
+                                          TaskStatus.compress_error, TaskStatus.compress_timeout]
+        self.__fpg_slots.release(task.fpg_device_idx, task.compress_time_used, task.media_duration,
+                                 not compress_failed)
+        for scaler in [self.__fpg_scaler, self.__vdg_scaler]:
+            if scaler is not None:
+                scaler.task_done()
+        if compress_failed:
+            if task.status != TaskStatus.compress_timeout:
+                task.status = TaskStatus.compress_error
+            self.__fpg_tasks_error.append(task_id)
+            self.__job_update(task)
+            self.__task_report_write(task)
+            return
+        self.__fpg_tasks_done.append(task_id)
+        if task.status == TaskStatus.dnagen_done:
+            self.__vdg_tasks_done.append(task_id)
+        else:
+            if task.status != TaskStatus.dnagen_timeout:
+                task.status = TaskStatus.dnagen_error
+            self.__vdg_tasks_error.append(task_id)
+        self.__job_update(task)
+        self.__task_report_write(task)
+
+    def __vdg_task_finish(self, task_id: int) -> None:
+        """ VDNAGen 任务结束, 记录任务结果
+        """
+        self.__vdg_tasks_running.discard(task_id)
+        task: Task = self.__tasks[task_id]
+        if self.__vdg_scaler is not None:
+            self.__vdg_scaler.task_done()
+        if task.compress_key:
+            # 压缩视频使用结束, 可以被淘汰
+            self.__compress_cache.release(task.compress_key)
+            self.__compress_cache_unpark(task.compress_key)
+            task.compress_key = ""
+        if task.status == TaskStatus.dnagen_done:
+            self.__vdg_tasks_done.append(task_id)
+        else:
+            self.__vdg_tasks_error.append(task_id)
+        self.__job_update(task)
+        self.__task_report_write(task)
 
-        # 4 启动新任务
-        for task_id in tasks:
+    def __vdg_tasks_dispatch(self) -> None:
+        """ 在工作线程有空闲时启动等待中的VDNAGen任务
+        """
+        while len(self.__vdg_tasks_running) < self.__num_workers and len(self.__vdg_tasks_wait) > 0:
+            _, task_id = heapq.heappop(self.__vdg_tasks_wait)
             task: Task = self.__tasks[task_id]
             task.status = TaskStatus.need_dnagen
+            self.__vdg_tasks_running.add(task_id)
             task_proc = self.__vdg_pool.submit(self.__vdg_runner, task_id)
-            task.vdg_task_proc = task_proc
-            self.__vdg_tasks_running.append(task_id)
-            self.__vdg_tasks_wait.remove(task_id)
+            task_proc.add_done_callback(lambda _, tid=task_id: self.__event_post("vdg", tid))
+            self.__job_update(task, TaskStatus.dnagen_runing)
+
+    def __workers_scale(self) -> None:
+        """ 到达调整周期时, 根据系统负载调整VDNAGen和ffmpeg的并发数
+        """
+        if self.__vdg_scaler is not None and self.__vdg_scaler.is_due():
+            backlog = len(self.__vdg_tasks_wait) > 0 and len(self.__vdg_tasks_running) >= self.__num_workers
+            if self.__vdg_scaler.update(backlog):
+                self.__reporter.log_write(self.__vdg_scaler.status)
+            self.__num_workers = self.__vdg_scaler.workers
+        if self.__fpg_scaler is not None and self.__fpg_scaler.is_due():
+            backlog = len(self.__fpg_tasks_wait) > 0 and len(self.__fpg_tasks_running) >= self.__fpg_limit
+            if self.__fpg_scaler.update(backlog):
+                self.__reporter.log_write(self.__fpg_scaler.status)
+            self.__fpg_limit = self.__fpg_scaler.workers
 
     def __tasks_init(self):
-        """任务分拣
-        确定那些需要采用那些任务需要进行视频压缩，那些任务不需要
+        """任务队列初始化
         """
 
         self.__fpg_tasks_wait = []
-        self.__fpg_tasks_running = []
-        self.__fpg_tasks_done = []
-        self.__fpg_tasks_error = []
+        self.__fpg_tasks_running = set()
+        self.__fpg_tasks_done = array("q")
+        self.__fpg_tasks_error = array("q")
 
         self.__fpg_tasks_done_tr = 0
         self.__fpg_tasks_error_tr = 0
 
         self.__vdg_tasks_wait = []
-        self.__vdg_tasks_running = []
-        self.__vdg_tasks_done = []
-        self.__vdg_tasks_error = []
+        self.__vdg_tasks_running = set()
+        self.__vdg_tasks_done = array("q")
+        self.__vdg_tasks_error = array("q")
 
         self.__vdg_tasks_done_tr = 0
         self.__vdg_tasks_error_tr = 0
 
-        tasks_a = []  # 需要视频压缩的任务
-        tasks_b = []  # 不需要视频压缩的任务
-        # 先把视频分为需要压缩和不需要压缩的
-        for idx, task in enumerate(self.__tasks):
-            if self._is_need_compress(task, compress_threshold):
-                task.status = TaskStatus.need_compress
-                tasks_a.append(idx)
-            else:
-                task.status = TaskStatus.no_need_compress
-                tasks_b.append(idx)
-        # 不管是否需要压缩，都按照从大到小排列
-        sort_by_size = lambda task_id: self.__tasks[task_id].media_size
-        tasks_a.sort(key=sort_by_size, reverse=True)
-        tasks_b.sort(key=sort_by_size, reverse=True)
-
-        # 记录需要进行视频压缩的
-        self.__fpg_tasks_wait.extend(tasks_a)
-        # VDNAGen先处理不需要视频压缩的，后处理需要视频压缩的
-        self.__vdg_tasks_wait.extend(tasks_b)
-        # 这里需要先使用ffmpeg进行压缩，然后使用VDNAGen生成基因的
-        # 等后面ffmpeg执行完成后，由主线程后期加入
-        # self.__vdg_tasks_wait.extend(tasks_a)
+        self.__tasks_skip = 0
 
     def __far_path_log_update(self):
         for i in range(len(self.__vdg_tasks_done) - self.__vdg_tasks_done_tr):
@@ -575,191 +1449,584 @@ class FarCreater:
             task: Task = self.__tasks[task_id]  # 这就等于获得当面任务的执行结果
             self.__reporter.path_write(task.far_path)
 
-    def __vdg_task_log_update_op(self, task_id: int):
+    def __usage_log_write(self, name: str, usage: Optional[ProcUsage], level: int) -> None:
+        """ 打印子进程资源使用情况
+        :param name: 日志前缀
+        :param usage: 资源使用情况, 为None时不打印
+        :param level: 日志级别
+        :return:
+        """
+        if usage is None:
+            return
+        self.__reporter.log_write(f"{name} cpu time: user {usage.user_time} sec, sys {usage.sys_time} sec", level)
+        self.__reporter.log_write(f"{name} max rss: {file_size_format(max(usage.max_rss, 0))}", level)
+        self.__reporter.log_write(f"{name} disk io: read {file_size_format(max(usage.read_bytes, 0))}, "
+                                  f"write {file_size_format(max(usage.write_bytes, 0))}", level)
+
+    def __vdg_task_log_update_op(self, task_id: int, level: int):
         """ VDNAGen 日志打印内容
         :param task_id: 任务索引
+        :param level: 日志级别
         :return:
         """
+        if not self.__reporter.is_enabled(level):
+            return
         task = self.__tasks[task_id]  # 这就等于获得当面任务的执行结果
-        self.__reporter.log_write(f"media path: {task.media_path}")
-        self.__reporter.log_write(f"media size: {file_size_format(task.media_size)}")
-        self.__reporter.log_write(f"media shape: {task.media_width}x{task.media_height}")
-        self.__reporter.log_write(f"media codec: {task.media_codec}")
-        self.__reporter.log_write(f"media duration : {task.media_duration} sec")
+        self.__reporter.log_write(f"media path: {task.media_path}", level)
+        self.__reporter.log_write(f"media size: {file_size_format(task.media_size)}", level)
+        self.__reporter.log_write(f"media shape: {task.media_width}x{task.media_height}", level)
+        self.__reporter.log_write(f"media codec: {task.media_codec}", level)
+        self.__reporter.log_write(f"media duration : {task.media_duration} sec", level)
         if os.path.isfile(task.compress_path):
-            self.__reporter.log_write(f"compress path: {task.compress_path}")
-            self.__reporter.log_write(f"compress size: {file_size_format(task.compress_size)}")
-        self.__reporter.log_write(f"far path: {task.far_path}")
-        self.__reporter.log_write(f"far size: {file_size_format(task.far_size)}")
-        self.__reporter.log_write(f"vdnagen command: {task.vdg_cmd}")
-        self.__reporter.log_write(f"vdnagen start time: {task.vdg_start_time}")
-        self.__reporter.log_write(f"vdnagen end time: {task.vdg_end_time}")
-        self.__reporter.log_write(f"vdnagen time used {task.vdg_time_used} sec")
-        self.__reporter.log_write("done.")
+            self.__reporter.log_write(f"compress path: {task.compress_path}", level)
+            self.__reporter.log_write(f"compress size: {file_size_format(task.compress_size)}", level)
+        self.__reporter.log_write(f"far path: {task.far_path}", level)
+        self.__reporter.log_write(f"far size: {file_size_format(task.far_size)}", level)
+        self.__reporter.log_write(f"vdnagen command: {shlex.join(self.__vdg_cmd_get(task))}", level)
+        self.__reporter.log_write(f"vdnagen start time: {time_format(task.vdg_start_time)}", level)
+        self.__reporter.log_write(f"vdnagen end time: {time_format(task.vdg_end_time)}", level)
+        self.__reporter.log_write(f"vdnagen time used {task.vdg_time_used} sec", level)
+        self.__usage_log_write("vdnagen", task.vdg_usage, level)
+        if task.status == TaskStatus.dnagen_timeout:
+            self.__reporter.log_write(f"vdnagen timeout: killed after {self.__task_timeout_get(task)} sec", level)
+        self.__reporter.log_write("done.", level)
 
     def __vdg_tasks_log_update(self):
         """ VDNAGen 日志更新
         打印新完成的任务日志
         """
         for i in range(len(self.__vdg_tasks_done) - self.__vdg_tasks_done_tr):
-            self.__reporter.log_write(
-                f"=============== Success VDNAGen task {self.__vdg_tasks_done_tr + i + 1} ===============")
+            # 成功的任务只打印一行摘要, 详细信息为DEBUG级别
             task_id = self.__vdg_tasks_done[self.__vdg_tasks_done_tr + i]
-            self.__vdg_task_log_update_op(task_id)
+            task: Task = self.__tasks[task_id]
+            self.__reporter.log_write(f"Success VDNAGen task {self.__vdg_tasks_done_tr + i + 1}: "
+                                      f"{task.far_path} ({task.vdg_time_used} sec)")
+            self.__vdg_task_log_update_op(task_id, DEBUG)
         self.__far_path_log_update()
         self.__vdg_tasks_done_tr = len(self.__vdg_tasks_done)
 
         for i in range(len(self.__vdg_tasks_error) - self.__vdg_tasks_error_tr):
             self.__reporter.log_write(
-                f"=============== Error VDNAGen task {self.__vdg_tasks_error_tr + i + 1} ===============")
+                f"=============== Error VDNAGen task {self.__vdg_tasks_error_tr + i + 1} ===============", WARNING)
             task_id = self.__vdg_tasks_error[self.__vdg_tasks_error_tr + i]
-            self.__vdg_task_log_update_op(task_id)
+            self.__vdg_task_log_update_op(task_id, WARNING)
         self.__vdg_tasks_error_tr = len(self.__vdg_tasks_error)
 
-    def __fpg_log_update_op(self, task_id: int):
+    def __fpg_log_update_op(self, task_id: int, level: int):
         """ 打印日志日志的基本内容
         :param task_id: 任务索引
+        :param level: 日志级别
         :return:
         """
+        if not self.__reporter.is_enabled(level):
+            return
         task: Task = self.__tasks[task_id]  # 这就等于获得当面任务的执行结果
-        self.__reporter.log_write(f"media path: {task.media_path}")
-        self.__reporter.log_write(f"media size: {file_size_format(task.media_size)}")
-        self.__reporter.log_write(f"media shape: {task.media_width}x{task.media_height}")
-        self.__reporter.log_write(f"media codec: {task.media_codec}")
-        self.__reporter.log_write(f"media duration : {task.media_duration} sec")
+        self.__reporter.log_write(f"media path: {task.media_path}", level)
+        self.__reporter.log_write(f"media size: {file_size_format(task.media_size)}", level)
+        self.__reporter.log_write(f"media shape: {task.media_width}x{task.media_height}", level)
+        self.__reporter.log_write(f"media codec: {task.media_codec}", level)
+        self.__reporter.log_write(f"media duration : {task.media_duration} sec", level)
         if os.path.isfile(task.compress_path):
-            self.__reporter.log_write(f"compress path: {task.compress_path}")
-            self.__reporter.log_write(f"compress size: {file_size_format(task.compress_size)}")
-        self.__reporter.log_write(f"compress command: {task.compress_cmd}")
-        self.__reporter.log_write(f"compress start time: {task.compress_start_time}")
-        self.__reporter.log_write(f"compress end time: {task.compress_end_time}")
-        self.__reporter.log_write(f"compress time used {task.compress_time_used} sec")
-        gpu_id = task.fpg_gpu_id
-        device = "Error Device"
-        if gpu_id == -1:
-            device = "CPU"
-        elif gpu_id >= 0:
-            device = f"GPU:{gpu_id}"
-        self.__reporter.log_write(f"ffmpeg use device: {device}")
-        self.__reporter.log_write("done.")
+            self.__reporter.log_write(f"compress path: {task.compress_path}", level)
+            self.__reporter.log_write(f"compress size: {file_size_format(task.compress_size)}", level)
+        tpls = ffmpeg_pipe_tpl if task.fpg_pipe else ffmpeg_shell_tpl
+        self.__reporter.log_write(f"compress command: {shlex.join(self.__fpg_cmd_get(task, task.compress_path, tpls))}",
+                                  level)
+        self.__reporter.log_write(f"compress start time: {time_format(task.compress_start_time)}", level)
+        self.__reporter.log_write(f"compress end time: {time_format(task.compress_end_time)}", level)
+        self.__reporter.log_write(f"compress time used {task.compress_time_used} sec", level)
+        self.__usage_log_write("compress", task.compress_usage, level)
+        if task.status == TaskStatus.compress_timeout:
+            self.__reporter.log_write(f"compress timeout: killed after {self.__task_timeout_get(task)} sec", level)
+        self.__reporter.log_write(f"ffmpeg use device: {device_name_get(task.fpg_gpu_id)}", level)
+        self.__reporter.log_write("done.", level)
 
     def __fpg_tasks_log_update(self):
         """ ffmpeg 视频压缩日志更新
         打印新完成的任务日志
         """
         for i in range(len(self.__fpg_tasks_done) - self.__fpg_tasks_done_tr):
-            self.__reporter.log_write(
-                f"=============== Success ffmpeg task {self.__fpg_tasks_done_tr + i + 1} ===============")
+            # 成功的任务只打印一行摘要, 详细信息为DEBUG级别
             task_id = self.__fpg_tasks_done[self.__fpg_tasks_done_tr + i]
-            self.__fpg_log_update_op(task_id)
+            task: Task = self.__tasks[task_id]
+            self.__reporter.log_write(f"Success ffmpeg task {self.__fpg_tasks_done_tr + i + 1}: "
+                                      f"{task.media_path} ({task.compress_time_used} sec)")
+            self.__fpg_log_update_op(task_id, DEBUG)
         self.__fpg_tasks_done_tr = len(self.__fpg_tasks_done)
 
         for i in range(len(self.__fpg_tasks_error) - self.__fpg_tasks_error_tr):
             task_id = self.__fpg_tasks_error[self.__fpg_tasks_error_tr + i]
             self.__reporter.log_write(
-                f"=============== Error ffmpeg task {self.__fpg_tasks_error_tr + i + 1} ===============")
-            self.__fpg_log_update_op(task_id)
+                f"=============== Error ffmpeg task {self.__fpg_tasks_error_tr + i + 1} ===============", WARNING)
+            self.__fpg_log_update_op(task_id, WARNING)
         self.__fpg_tasks_error_tr = len(self.__fpg_tasks_error)
 
-    def __tasks_report_export(self):
-        """ 将任务运行结果导出为报告
-        """
-        tpl = {
-            "media_path": "",
-            "media_size": "",
-            "media_codec": "",
-            "media_shape": "",
-            "media_duration(s)": "",
-            "far_path": "",
-            "far_size": "",
-            "status": "",
-            "gpu_device": "",
-            "gpu_start_time": "",
-            "gpu_end_time": "",
-            "gpu_time_used(s)": "",
-            "vdnagen_start_time": "",
-            "vdnagen_end_time": "",
-            "vdnagen_time_used(s)": ""
-        }
-        reports = []
-        for task in self.__tasks:
-            report = deepcopy(tpl)
-            report["media_path"] = task.media_path
-            report["media_size"] = file_size_format(task.media_size)
-            report["far_path"] = task.far_path
-            report["media_duration(s)"] = task.media_duration
-            if task.status in [TaskStatus.null, TaskStatus.parse_error]:
-                report["status"] = "视频解析错误"
-                reports.append(report)
-                continue
-
-            report["media_codec"] = task.media_codec
-            report["media_shape"] = f"{task.media_width}x{task.media_height}"
-
-            gpu_id = task.fpg_gpu_id
-            if gpu_id >= -1:
-                # 有进行视频压缩，记录信息
-                if gpu_id == -1:
-                    report["gpu_device"] = "CPU"
-                elif gpu_id >= 0:
-                    report["gpu_device"] = f"GPU:{gpu_id}"
-                report["gpu_start_time"] = task.compress_start_time
-                report["gpu_end_time"] = task.compress_end_time
-                report["gpu_time_used(s)"] = task.compress_time_used
-                if task.status == TaskStatus.compress_error:
-                    report["status"] = "视频压缩错误"
-                    reports.append(report)
-                    continue
-            report["vdnagen_start_time"] = task.vdg_start_time
-            report["vdnagen_end_time"] = task.vdg_end_time
-            report["vdnagen_time_used(s)"] = task.vdg_time_used
-            if task.status == TaskStatus.dnagen_error:
+    @staticmethod
+    def __usage_report_fill(report: dict, prefix: str, usage: Optional[ProcUsage]) -> None:
+        """
+        把子进程资源使用情况填入报告
+        :param report: 报告的一行
+        :param prefix: 列名前缀
+        :param usage: 资源使用情况, 为None或者没有运行子进程时不填写
+        :return:
+        """
+        if usage is None or usage.user_time < 0:
+            return
+        mb = 1024 * 1024
+        report[f"{prefix}_user_time(s)"] = usage.user_time
+        report[f"{prefix}_sys_time(s)"] = usage.sys_time
+        report[f"{prefix}_max_rss(MB)"] = round(usage.max_rss / mb, 1)
+        report[f"{prefix}_read(MB)"] = round(usage.read_bytes / mb, 1)
+        report[f"{prefix}_write(MB)"] = round(usage.write_bytes / mb, 1)
+
+    def __task_report_get(self, task: Task) -> dict:
+        """
+        结束的任务转换为报告的一行
+        :param task: 已经结束的任务
+        :return:
+        """
+        report = dict.fromkeys(report_columns, "")
+        report["media_path"] = task.media_path
+        report["media_size"] = file_size_format(task.media_size)
+        report["far_path"] = task.far_path
+        report["media_duration(s)"] = task.media_duration
+        if task.status in [TaskStatus.null, TaskStatus.parse_error]:
+            report["status"] = "视频解析错误"
+            return report
+
+        report["media_codec"] = task.media_codec
+        report["media_shape"] = f"{task.media_width}x{task.media_height}"
+        if task.duplicate_of:
+            # 重复视频没有执行压缩和基因生成
+            report["duplicate_of"] = task.duplicate_of
+            if task.status == TaskStatus.dnagen_done:
+                report["far_size"] = file_size_format(task.far_size)
+                report["status"] = "执行成功"
+            else:
                 report["status"] = "基因生成错误"
-                reports.append(report)
-                continue
+            return report
+        if task.status == TaskStatus.no_need_dnagen:
             report["far_size"] = file_size_format(task.far_size)
-            report["status"] = "执行成功"
-            reports.append(report)
-        task_report = pd.DataFrame(reports)
-        self.__reporter.xlsx_write(task_report)
+            report["status"] = "已完成(跳过)"
+            return report
+
+        gpu_id = task.fpg_gpu_id
+        if gpu_id >= -1:
+            # 有进行视频压缩，记录信息
+            report["gpu_device"] = device_name_get(gpu_id)
+            report["gpu_start_time"] = time_format(task.compress_start_time)
+            report["gpu_end_time"] = time_format(task.compress_end_time)
+            report["gpu_time_used(s)"] = task.compress_time_used
+            self.__usage_report_fill(report, "gpu", task.compress_usage)
+            if task.status == TaskStatus.compress_error:
+                report["status"] = "视频压缩错误"
+                return report
+            if task.status == TaskStatus.compress_timeout:
+                report["status"] = "视频压缩超时"
+                return report
+        report["vdnagen_start_time"] = time_format(task.vdg_start_time)
+        report["vdnagen_end_time"] = time_format(task.vdg_end_time)
+        report["vdnagen_time_used(s)"] = task.vdg_time_used
+        self.__usage_report_fill(report, "vdnagen", task.vdg_usage)
+        if task.status == TaskStatus.dnagen_error:
+            report["status"] = "基因生成错误"
+            return report
+        if task.status == TaskStatus.dnagen_timeout:
+            report["status"] = "基因生成超时"
+            return report
+        report["far_size"] = file_size_format(task.far_size)
+        report["status"] = "执行成功"
+        return report
+
+    def __task_report_write(self, task: Task) -> None:
+        """ 任务结束时立即写入报告, 不需要等待全部任务结束
+        分布式模式下同时把报告行提交给协调进程
+        """
+        if self.__dedup and task.media_hash and not task.duplicate_of:
+            self.__duplicates_resolve(task)
+        report = self.__task_report_get(task)
+        self.__reporter.report_write(report)
+        if self.__lease_client is None:
+            return
+        try:
+            self.__lease_client.complete(task.media_path, report)
+        except (OSError, xmlrpc.client.Error) as e:
+            # 租约到期后任务由其他工作进程重新执行
+            self.__reporter.log_write(f"{task.media_path} result submit failed: {e}", WARNING)
+        self.__lease_slots.release()
+
+    def __calibrate_sample(self, task: Task, device: DeviceSlots, calib_dir: str) -> Optional[Tuple[float, float, float]]:
+        """
+        在同一个视频上测量直接生成far以及压缩后生成far的耗时
+        :param task: 视频解析完成的任务
+        :param device: 压缩使用的设备
+        :param calib_dir: 临时文件目录
+        :return: (直接生成far耗时, 压缩耗时, 使用压缩结果生成far耗时), 任意一步失败时返回None
+        """
+        timeout = self.__task_timeout_get(task)
+        name = str_md5_get(task.media_path.encode("utf-8"))
+        compress_path = os.path.join(calib_dir, name + os.path.splitext(task.media_path)[1])
+        task.fpg_gpu_id = device.gpu_id
+        task.compress_path = ""
+        task.far_path = os.path.join(calib_dir, name + ".direct.far")
+        temp_paths = [task.far_path, compress_path, os.path.join(calib_dir, name + ".compress.far")]
+        try:
+            direct = run(self.__vdg_cmd_get(task), timeout=timeout)
+            if direct.status != 0 or not os.path.isfile(task.far_path):
+                return None
+            compress = run(self.__fpg_cmd_get(task, compress_path, ffmpeg_shell_tpl), timeout=timeout)
+            if compress.status != 0 or not os.path.isfile(compress_path):
+                return None
+            task.compress_path = compress_path
+            task.far_path = temp_paths[2]
+            compressed = run(self.__vdg_cmd_get(task), timeout=timeout)
+            if compressed.status != 0 or not os.path.isfile(task.far_path):
+                return None
+            return direct.usage.wall_time, compress.usage.wall_time, compressed.usage.wall_time
+        finally:
+            for path in temp_paths:
+                if os.path.isfile(path):
+                    os.remove(path)
+
+    def tasks_calibrate(self, input: str, policy_path: str, samples: int = 3,
+                        max_probe: int = 2000) -> Optional[CompressPolicy]:
+        """
+        校准模式: 按 (视频编码, 分辨率分档) 从输入视频中抽样, 分别测量 直接生成far 与 压缩+使用压缩结果生成far 的耗时,
+        生成是否压缩的决策表, 之后的运行中由 _is_need_compress 使用
+        校准使用第一个压缩设备, 样本逐个测量, 耗时不受其他样本争用CPU/GPU的影响
+        :param input: 视频文件所在路径或指明视频路径的文本文件
+        :param policy_path: 决策表保存路径
+        :param samples: 每个分档的样本数
+        :param max_probe: 抽样时最多解析的视频数量
+        :return: 决策表, 没有压缩设备或者没有可用的样本时返回None
+        """
+        if len(self.__fpg_slots.devices) == 0:
+            self.__reporter.log_write("no ffmpeg device, calibration skipped.", WARNING)
+            return None
+        device = self.__fpg_slots.devices[0]
+        calib_dir = os.path.join(self.__fpg_cache, "calibrate")
+        os.makedirs(calib_dir, exist_ok=True)
+
+        def on_error(path: str, e: OSError):
+            self.__reporter.log_write(f"{path} can not be read: {e}", WARNING)
+
+        if os.path.isfile(input):
+            items = media_file_read(input, calib_dir)
+        else:
+            items = media_dir_walk(input, calib_dir, self.__walk_filter, self.__walk_workers, on_error)
+        calibration = CompressCalibration()
+        selected: List[Task] = []
+        counts: Dict[str, int] = {}
+        for idx, (media_path, far_path, stat) in enumerate(items):
+            if idx >= max_probe:
+                break
+            try:
+                stat = os.stat(media_path) if stat is None else stat
+            except OSError:
+                continue
+            task = self.__task_probe(media_path, far_path, stat)
+            if task.status != TaskStatus.task_create or task.media_width <= 0 or task.media_height <= 0:
+                continue
+            key = policy_key_get(task.media_codec, task.media_width, task.media_height)
+            if counts.get(key, 0) >= samples:
+                continue
+            counts[key] = counts.get(key, 0) + 1
+            selected.append(task)
+        self.__reporter.log_write(f"calibrate {len(selected)} samples on {device.name}, {len(counts)} buckets.")
+
+        for task in selected:
+            res = self.__calibrate_sample(task, device, calib_dir)
+            if res is None:
+                self.__reporter.log_write(f"{task.media_path} calibration failed.", WARNING)
+                continue
+            calibration.add(task.media_codec, task.media_width, task.media_height, task.media_duration, *res)
+            self.__reporter.log_write(f"{task.media_path} direct {res[0]} sec, compress {res[1]} sec, "
+                                      f"compressed VDNAGen {res[2]} sec", DEBUG)
+        shutil.rmtree(calib_dir, ignore_errors=True)
+        policy = calibration.policy_get(device.name)
+        if len(policy.entries) == 0:
+            self.__reporter.log_write("no calibration sample succeeded.", WARNING)
+            return None
+        policy.save(policy_path)
+        for line in policy.summary():
+            self.__reporter.log_write(f"compress policy {line}")
+        self.__reporter.log_write(f"compress policy saved to {policy_path}")
+        self.__compress_policy = policy
+        self.__reporter.flush()
+        return policy
 
     def tasks_run(self):
         """ 采用多线程执行任务
+        任务发现、视频解析、视频压缩和基因生成同时进行, 视频解析完成的任务立即进入执行队列
         """
 
-        # self.__tasks = self.__tasks[:3]
         self.__tasks_init()
-        self.__reporter.log_write(f"start {self.__num_workers} thread to running {len(self.__tasks)} task...")
-        self.__reporter.log_write(f"{len(self.__fpg_tasks_wait)} tasks need to compressed.")
-
-        while len(self.__vdg_tasks_wait) + \
+        if self.__discover_thread is None:
+            # 任务已经通过 task_add 同步添加完毕
+            self.__event_post("discover", self.__probe_submitted)
+        self.__reporter.log_write(f"start {self.__num_workers} thread to running tasks...")
+        self.__reporter.log_write(self.__vdg_cost_model.summary())
+        self.__reporter.log_write(self.__fpg_cost_model.summary())
+        if self.__compress_policy is not None:
+            self.__reporter.log_write(f"use compress policy calibrated on {self.__compress_policy.device} at "
+                                      f"{self.__compress_policy.created}, {len(self.__compress_policy.entries)} buckets")
+
+        discover_done = False
+        probe_total = 0
+        while not discover_done or \
+                self.__probe_finished < probe_total or \
+                len(self.__vdg_tasks_wait) + \
                 len(self.__fpg_tasks_running) + \
                 len(self.__vdg_tasks_running) + \
-                len(self.__fpg_tasks_wait) > 0:
-            self.__fpg_tasks_queue_update()
+                len(self.__fpg_tasks_wait) + \
+                len(self.__compress_cache_parked) > 0:
+            # 阻塞等待任务事件, 一个任务结束后立即把空闲线程交给下一个任务
+            # 自动调整并发数时, 最多等待一个调整周期
+            timeout = None
+            scalers = [scaler for scaler in [self.__vdg_scaler, self.__fpg_scaler] if scaler is not None]
+            if len(scalers) > 0:
+                timeout = min(scaler.interval for scaler in scalers)
+            try:
+                stage, data = self.__events.get(timeout=timeout)
+            except queue.Empty:
+                stage, data = None, None
+            while stage is not None:
+                if stage == "probe":
+                    self.__task_schedule(data)
+                elif stage == "skip":
+                    self.__task_skip(data)
+                elif stage == "discover":
+                    discover_done = True
+                    probe_total = data
+                    self.__reporter.log_write(f"{probe_total} tasks discovered.")
+                elif stage == "fpg":
+                    self.__fpg_task_finish(data)
+                elif stage == "pipe":
+                    self.__pipe_task_finish(data)
+                else:
+                    self.__vdg_task_finish(data)
+                try:
+                    stage, data = self.__events.get_nowait()
+                except queue.Empty:
+                    stage, data = None, None
+            self.__workers_scale()
+            self.__fpg_tasks_dispatch()
+            self.__vdg_tasks_dispatch()
             self.__fpg_tasks_log_update()
-            self.__vdg_tasks_queue_update()
             self.__vdg_tasks_log_update()
-            time.sleep(1)
+        self.__reporter.log_write(
+            f"{len(self.__fpg_tasks_done) + len(self.__fpg_tasks_error)} tasks need to compressed.")
+        if self.__tasks_skip > 0:
+            self.__reporter.log_write(f"{self.__tasks_skip} tasks already done in last run, skipped.")
         self.__reporter.log_write(f"{self.__num_workers} thread to running {len(self.__tasks)} task done.")
-        self.__tasks_report_export()
-
-
-def batch_far_create(input: str, output: str, num_workers: int, cache: str = "/tmp/batch_far_create"):
+        for line in self.__fpg_slots.summary():
+            self.__reporter.log_write(f"ffmpeg device {line}")
+        if len(self.__fpg_slots.devices) > 0:
+            self.__reporter.log_write(self.__compress_cache.summary())
+        self.__compress_cache.close()
+        if self.__dedup_files > 0:
+            self.__reporter.log_write(f"{self.__dedup_files} duplicate videos in {len(self.__dedup_groups)} groups, "
+                                      f"far generated once per group.")
+        self.__reporter.report_close()
+        self.__reporter.flush()
+
+
+def cost_models_fit(job_db: JobDB) -> Tuple[CostModel, CostModel]:
+    """
+    使用任务数据库中已完成任务的耗时拟合VDNAGen和ffmpeg的耗时模型
+    :param job_db: 任务数据库
+    :return: (VDNAGen耗时模型, ffmpeg耗时模型)
+    """
+    vdg_samples = []
+    fpg_samples = []
+    for job in job_db.jobs_get(TaskStatus.dnagen_done.value, cost_model_samples):
+        duration = job["media_duration"]
+        x = cost_feature_get(duration, job["media_width"], job["media_height"])
+        compress_time_used = job["compress_time_used"]
+        if compress_time_used is not None and compress_time_used >= 0:
+            # 压缩过的视频, VDNAGen使用的是压缩后的视频
+            fpg_samples.append((job["media_codec"], x, compress_time_used))
+            x = cost_feature_get(duration, compress_pixels, 1)
+        vdg_samples.append((job["media_codec"], x, job["vdg_time_used"]))
+    vdg_cost_model = CostModel("VDNAGen")
+    vdg_cost_model.fit(vdg_samples)
+    fpg_cost_model = CostModel("ffmpeg")
+    fpg_cost_model.fit(fpg_samples)
+    return vdg_cost_model, fpg_cost_model
+
+
+def batch_far_create(input: str, output: str, num_workers: int, cache: str = "/tmp/batch_far_create",
+                     probe_workers: int = 8, pipe: bool = False, rebuild: bool = False,
+                     autoscale: bool = False, min_workers: int = 1, max_workers: Optional[int] = None,
+                     timeout_base: float = task_timeout_base, timeout_factor: float = task_timeout_factor,
+                     log_level: str = "info", report_format: str = "csv", xlsx: bool = True,
+                     include_ext: str = "", exclude_ext: str = ".far", min_size: int = 0,
+                     max_size: Optional[int] = None, walk_workers: int = 4, coordinator: Optional[str] = None,
+                     ffmpeg_device: Optional[List[Tuple[int, int]]] = None, ffmpeg: str = ffmpeg_bin,
+                     ffmpeg_gpu: str = ffmpeg_gpu_bin, calibrate: int = 0,
+                     compress_quota: float = compress_cache_quota / 1024 ** 3, dedup: bool = False):
     """
     批量far文件生成入口函数
     :param input: 视频文件所在路径或指明视频路径的文本文件
     :param output: far文件所在路径
     :param num_workers: 工作线程数
     :param cache: 中间结果缓存路径
+    :param probe_workers: 视频信息解析线程数
+    :param pipe: 压缩结果通过管道直接交给VDNAGen, 不生成中间文件
+    :param rebuild: 忽略上次运行记录, 重新生成所有far文件
+    :param autoscale: 根据系统负载自动调整VDNAGen和ffmpeg的并发数
+    :param min_workers: 自动调整时VDNAGen的最小并发数
+    :param max_workers: 自动调整时VDNAGen的最大并发数, 为None时使用CPU线程数
+    :param timeout_base: ffmpeg/VDNAGen超时时间的基础部分(秒)
+    :param timeout_factor: ffmpeg/VDNAGen超时时间中视频时长的倍数, <=0时不限制
+    :param log_level: 日志级别 debug info warning error
+    :param report_format: 任务结束时逐行写入的报告格式, 逗号分隔, 可选 csv jsonl parquet
+    :param xlsx: 全部任务结束后是否把报告转换为xlsx
+    :param include_ext: 遍历视频文件夹时只处理这些后缀的文件, 逗号分隔, 为空时不限制
+    :param exclude_ext: 遍历视频文件夹时排除这些后缀的文件, 逗号分隔
+    :param min_size: 遍历视频文件夹时跳过小于该大小(字节)的文件
+    :param max_size: 遍历视频文件夹时跳过大于该大小(字节)的文件, 为None时不限制
+    :param walk_workers: 遍历视频文件夹时同时读取目录的线程数
+    :param coordinator: 分布式模式下协调进程地址 host:port, 从协调进程租用任务, 忽略 input 和 output
+    :param ffmpeg_device: 压缩设备 [(gpu_id, 线程数)], gpu_id 为-1表示CPU, 为None时使用 ffmpeg_devices
+    :param ffmpeg: CPU压缩使用的ffmpeg
+    :param ffmpeg_gpu: GPU压缩使用的ffmpeg
+    :param calibrate: 大于0时为校准模式, 每个编码和分辨率分档抽取该数量的视频测量是否值得压缩, 生成决策表后退出
+    :param compress_quota: 压缩视频缓存的总大小上限(GB)
+    :param dedup: 内容相同的视频只生成一次far, 其他路径通过硬链接或者复制得到far
+    :return:
+    """
+    os.makedirs(cache, exist_ok=True)
+    policy_path = os.path.join(cache, compress_policy_name)
+    compress_policy = None if calibrate > 0 else CompressPolicy.load(policy_path)
+    # 同一主机上的多个工作进程使用相同的cache目录时, 每个进程使用自己的数据库文件, 不互相锁定
+    db_dir, db_lock_fd = dir_slot_acquire(cache)
+    probe_cache = ProbeCache(os.path.join(db_dir, "probe_cache.db"))
+    job_db = JobDB(os.path.join(db_dir, "batch_far_create_jobs.db"))
+    vdg_cost_model, fpg_cost_model = cost_models_fit(job_db)
+    client = None if coordinator is None else WorkQueueClient(coordinator)
+    fc = FarCreater(num_workers, fpg_cache=os.path.join(cache, "ffmpeg_compress"), probe_workers=probe_workers,
+                    probe_cache=probe_cache, pipe=pipe, job_db=job_db, rebuild=rebuild,
+                    vdg_cost_model=vdg_cost_model, fpg_cost_model=fpg_cost_model,
+                    autoscale=autoscale, min_workers=min_workers, max_workers=max_workers,
+                    timeout_base=timeout_base, timeout_factor=timeout_factor, log_level=level_get(log_level),
+                    report_formats=report_format.split(","), report_xlsx=xlsx,
+                    walk_filter=WalkFilter(include_ext.split(",") if include_ext else None,
+                                           exclude_ext.split(",") if exclude_ext else None, min_size, max_size),
+                    walk_workers=walk_workers, fpg_devices=ffmpeg_device, ffmpeg=ffmpeg, ffmpeg_gpu=ffmpeg_gpu,
+                    compress_policy=compress_policy, compress_quota=int(compress_quota * 1024 ** 3), dedup=dedup,
+                    report_suffix="" if client is None else worker_report_suffix_get(client.worker))
+    if calibrate > 0:
+        try:
+            fc.tasks_calibrate(input, policy_path, calibrate)
+        finally:
+            job_db.close()
+            probe_cache.close()
+            os.close(db_lock_fd)
+        return
+    if client is not None:
+        fc.tasks_lease(client)
+    else:
+        fc.tasks_discover(input, output)
+    try:
+        fc.tasks_run()
+    finally:
+        if client is not None:
+            client.close()
+        job_db.close()
+        probe_cache.close()
+        os.close(db_lock_fd)
+
+
+def batch_far_serve(input: str, output: str, bind: str, lease_time: float = 600.0, max_attempts: int = 3,
+                    log_level: str = "info", report_format: str = "csv", xlsx: bool = True,
+                    include_ext: str = "", exclude_ext: str = ".far", min_size: int = 0,
+                    max_size: Optional[int] = None, walk_workers: int = 4):
+    """
+    分布式模式的协调进程: 发现任务并发布到任务队列, 由任意数量的工作进程(--coordinator)租用执行,
+    工作进程提交的结果写入报告; 视频和far文件路径在所有工作节点上必须相同(共享文件系统)
+    :param input: 视频文件所在路径或指明视频路径的文本文件
+    :param output: far文件所在路径
+    :param bind: 监听地址 host:port
+    :param lease_time: 租约时长(秒), 工作进程每隔 lease_time/3 续约, 工作进程异常退出后任务在租约到期后重新执行
+    :param max_attempts: 单个任务最多租用的次数
+    :param log_level: 日志级别 debug info warning error
+    :param report_format: 报告格式, 见 batch_far_create
+    :param xlsx: 全部任务结束后是否把报告转换为xlsx
+    :param include_ext: 见 batch_far_create
+    :param exclude_ext: 见 batch_far_create
+    :param min_size: 见 batch_far_create
+    :param max_size: 见 batch_far_create
+    :param walk_workers: 见 batch_far_create
     :return:
     """
-    fc = FarCreater(num_workers, fpg_cache=os.path.join(cache, "ffmpeg_compress"))
+    reporter = Reporter(level_get(log_level), coordinator_report_suffix)
+    reporter.report_open(report_columns, report_format.split(","), xlsx)
+    lock = threading.Lock()
+
+    def on_complete(media_path: str, task: dict, report: Optional[dict]):
+        if report is None:
+            report = dict.fromkeys(report_columns, "")
+            report["media_path"] = media_path
+            report["far_path"] = task["far_path"]
+            report["status"] = "工作进程异常(放弃)"
+            reporter.log_write(f"{media_path} lease expired {max_attempts} times, abandoned.", WARNING)
+        with lock:
+            reporter.report_write(report)
+        if report["status"] in ["执行成功", "已完成(跳过)"]:
+            reporter.path_write(report["far_path"])
+
+    work_queue = LeaseQueue(lease_time, max_attempts, on_complete)
+    host, port = bind.rsplit(":", 1)
+    server = WorkQueueServer(work_queue, host, int(port))
+    server.start()
+    reporter.log_write(f"coordinator listening on {server.address[0]}:{server.address[1]}")
+
+    def on_error(path: str, e: OSError):
+        reporter.log_write(f"{path} can not be read: {e}", WARNING)
+
     if os.path.isfile(input):
-        fc.tasks_add_from_file(input, output)
+        paths = media_file_read(input, output)
     else:
-        fc.tasks_add_from_dir(input, output)
-    fc.tasks_run()
+        walk_filter = WalkFilter(include_ext.split(",") if include_ext else None,
+                                 exclude_ext.split(",") if exclude_ext else None, min_size, max_size)
+        paths = media_dir_walk(input, output, walk_filter, walk_workers, on_error)
+    total = 0
+    for media_path, far_path, _ in paths:
+        work_queue.put(media_path, {"media_path": media_path, "far_path": far_path})
+        total += 1
+    work_queue.close()
+    reporter.log_write(f"{total} tasks published.")
+
+    status_time = time.monotonic()
+    while not work_queue.finished():
+        time.sleep(1)
+        work_queue.reap()
+        if time.monotonic() - status_time >= 30:
+            reporter.log_write(f"coordinator status: {work_queue.status()}")
+            status_time = time.monotonic()
+    reporter.log_write(f"all tasks done: {work_queue.status()}")
+    server.stop()
+    reporter.report_close()
+    reporter.flush()
+
+
+def report_format_check(value: str) -> str:
+    """ 检查报告格式参数
+    """
+    for fmt in value.split(","):
+        if fmt not in report_formats:
+            raise argparse.ArgumentTypeError(f"unsupported report format: {fmt}")
+    return value
+
+
+def ffmpeg_device_check(value: str) -> Tuple[int, int]:
+    """ 检查压缩设备参数
+    """
+    try:
+        return device_spec_parse(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
 
 
 def parse_args():
@@ -768,25 +2035,89 @@ def parse_args():
     :return:
     """
     parser = argparse.ArgumentParser(prog="./BatchFarCreate.py", description="批量视频far文件生成")
-    parser.add_argument("-i", "--input", type=str, required=True, help="源视频文件路径信息")
-    parser.add_argument("-o", "--output_dir", type=str, required=True, help="far文件保存路径")
+    parser.add_argument("-i", "--input", type=str, required=False, help="源视频文件路径信息, 工作进程模式下不需要")
+    parser.add_argument("-o", "--output_dir", type=str, required=False, help="far文件保存路径, 工作进程模式下不需要")
     parser.add_argument("--cache", type=str, default="/tmp/cache", required=False, help="中间缓存路径")
     parser.add_argument("--num_workers", default=int(os.cpu_count() / 1.5) + 1, type=int, required=False, help="工作线程数")
-    return parser.parse_args()
+    parser.add_argument("--probe_workers", default=8, type=int, required=False, help="视频信息解析线程数")
+    parser.add_argument("--pipe", action="store_true", help="ffmpeg压缩结果通过管道直接交给VDNAGen, 不生成中间文件")
+    parser.add_argument("--rebuild", action="store_true", help="忽略上次运行记录, 重新生成所有far文件")
+    parser.add_argument("--autoscale", action="store_true", help="根据系统负载、可用内存和吞吐量自动调整并发数")
+    parser.add_argument("--min_workers", default=1, type=int, required=False, help="自动调整时VDNAGen的最小并发数")
+    parser.add_argument("--max_workers", default=None, type=int, required=False,
+                        help="自动调整时VDNAGen的最大并发数, 默认为CPU线程数")
+    parser.add_argument("--timeout_base", default=task_timeout_base, type=float, required=False,
+                        help="ffmpeg/VDNAGen超时时间 = timeout_base + 视频时长 x timeout_factor (秒)")
+    parser.add_argument("--timeout_factor", default=task_timeout_factor, type=float, required=False,
+                        help="超时时间中视频时长的倍数, <=0 表示不限制")
+    parser.add_argument("--log_level", default="info", choices=list(level_names), required=False,
+                        help="日志级别, 默认info: 成功的任务只输出一行摘要, debug时输出每个任务的详细信息")
+    parser.add_argument("--report_format", default="csv", type=report_format_check, required=False,
+                        help=f"任务结束时逐行写入的报告格式, 逗号分隔, 可选 {','.join(report_formats)}, parquet需要安装pyarrow")
+    parser.add_argument("--no_xlsx", action="store_true", help="全部任务结束后不生成xlsx报告")
+    parser.add_argument("--include_ext", default="", type=str, required=False,
+                        help="只处理这些后缀的视频文件, 逗号分隔, 例如 .mp4,.ts, 默认不限制")
+    parser.add_argument("--exclude_ext", default=".far", type=str, required=False,
+                        help="排除这些后缀的文件, 逗号分隔, 默认 .far")
+    parser.add_argument("--min_size", default=0, type=int, required=False, help="跳过小于该大小(字节)的文件")
+    parser.add_argument("--max_size", default=None, type=int, required=False, help="跳过大于该大小(字节)的文件")
+    parser.add_argument("--walk_workers", default=4, type=int, required=False,
+                        help="遍历视频文件夹时同时读取目录的线程数, 网络文件系统上可以适当增大")
+    parser.add_argument("--ffmpeg_device", default=None, type=ffmpeg_device_check, action="append", required=False,
+                        metavar="DEVICE", help="压缩设备及线程数, 可以多次指定, 例如 --ffmpeg_device cpu:2 "
+                                               "--ffmpeg_device gpu0:4, 默认使用脚本中的 ffmpeg_devices")
+    parser.add_argument("--no_compress", action="store_true", help="不压缩视频, 所有视频直接生成far文件")
+    parser.add_argument("--ffmpeg", default=ffmpeg_bin, type=str, required=False, help="CPU压缩使用的ffmpeg")
+    parser.add_argument("--ffmpeg_gpu", default=ffmpeg_gpu_bin, type=str, required=False,
+                        help="GPU压缩使用的ffmpeg, 需要支持cuvid/nvenc")
+    parser.add_argument("--compress_quota", default=compress_cache_quota / 1024 ** 3, type=float, required=False,
+                        help="压缩视频缓存的总大小上限(GB), 超过时淘汰最早使用的压缩视频, 全部在使用时压缩任务等待")
+    parser.add_argument("--dedup", action="store_true",
+                        help="内容相同的视频只生成一次far, 其他路径通过硬链接或者复制得到far, 报告的duplicate_of列记录对应的视频")
+    parser.add_argument("--calibrate", default=0, type=int, required=False, metavar="N",
+                        help="校准模式: 每个编码和分辨率分档抽取N个视频, 比较直接生成far与压缩后生成far的耗时, "
+                             "决策表保存在 --cache 目录中, 之后的运行据此决定是否压缩")
+    parser.add_argument("--serve", default=None, type=str, required=False, metavar="HOST:PORT",
+                        help="分布式模式: 作为协调进程发布任务, 由 --coordinator 指定的工作进程执行")
+    parser.add_argument("--coordinator", default=None, type=str, required=False, metavar="HOST:PORT",
+                        help="分布式模式: 作为工作进程从协调进程租用任务")
+    parser.add_argument("--lease_time", default=600, type=float, required=False,
+                        help="分布式模式下任务租约时长(秒), 工作进程异常退出后任务在租约到期后由其他工作进程执行")
+    parser.add_argument("--max_attempts", default=3, type=int, required=False, help="分布式模式下单个任务最多租用的次数")
+    args = parser.parse_args()
+    if args.serve is not None and args.coordinator is not None:
+        parser.error("--serve and --coordinator can not be used together")
+    if args.calibrate > 0 and (args.serve is not None or args.coordinator is not None):
+        parser.error("--calibrate can not be used in distributed mode")
+    if args.coordinator is None and (args.input is None or (args.output_dir is None and args.calibrate <= 0)):
+        parser.error("the following arguments are required: -i/--input, -o/--output_dir")
+    return args
 
 
 def main():
     args = parse_args()
 
-    # 进程重复启动检测
-    import subprocess
-    proc = subprocess.Popen(["pgrep", "-f", __file__], stdout=subprocess.PIPE)
-    std = [p for p in proc.communicate() if p is not None]
-    if len(std[0].decode().split()) > 1:
-        exit('Already running')
+    # 进程重复启动检测, 分布式模式下同一台机器可以运行多个工作进程
+    if args.serve is None and args.coordinator is None:
+        import subprocess
+        proc = subprocess.Popen(["pgrep", "-f", __file__], stdout=subprocess.PIPE)
+        std = [p for p in proc.communicate() if p is not None]
+        if len(std[0].decode().split()) > 1:
+            exit('Already running')
 
     time_begin = time.time()
-    batch_far_create(args.input, args.output_dir, args.num_workers, args.cache)
+    if args.serve is not None:
+        batch_far_serve(args.input, args.output_dir, args.serve, args.lease_time, args.max_attempts, args.log_level,
+                        args.report_format, not args.no_xlsx, args.include_ext, args.exclude_ext, args.min_size,
+                        args.max_size, args.walk_workers)
+        print(f"总共用时: {time.time() - time_begin:.3f}s")
+        return
+    batch_far_create(args.input, args.output_dir, args.num_workers, args.cache, args.probe_workers, args.pipe,
+                     args.rebuild, args.autoscale, args.min_workers, args.max_workers, args.timeout_base,
+                     args.timeout_factor, args.log_level, args.report_format, not args.no_xlsx,
+                     args.include_ext, args.exclude_ext, args.min_size, args.max_size, args.walk_workers,
+                     args.coordinator, [] if args.no_compress else args.ffmpeg_device, args.ffmpeg, args.ffmpeg_gpu,
+                     args.calibrate, args.compress_quota, args.dedup)
     time_end = time.time()
     print(f"总共用时: {time_end - time_begin:.3f}s")
 
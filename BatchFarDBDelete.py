@@ -7,9 +7,9 @@ import os
 import shlex
 from typing import List
 
-from common import getstatusoutput_s
-from common import sh2bash
 from common import str_md5_get
+from runner import run
+from walker import walk
 
 
 class Task:
@@ -54,14 +54,9 @@ class FarDBDeleter:
         self.__tasks.append(task)
 
     def tasks_add_from_dir(self, far_dir: str) -> None:
-        for sub in os.listdir(far_dir):
-            sub_path = os.path.join(far_dir, sub)
-            if os.path.isdir(sub_path):
-                sub_far_dir = sub_path
-                self.tasks_add_from_dir(sub_far_dir)
-            elif os.path.isfile(sub_path):
-                far_path = sub_path
-                self.task_add(far_path)
+        for entry in walk(far_dir, include_exts=[".far"], workers=4,
+                          on_error=lambda path, e: print(f"{path} 无法读取: {e}")):
+            self.task_add(entry.path)
 
     def tasks_add_from_file(self, file: str):
         if not os.path.isfile(file):
@@ -94,13 +89,12 @@ class FarDBDeleter:
             delete_xml = template_xml % task.meta_uid
             with open(delete_xml_path, mode="w", encoding="utf-8") as f:
                 f.write(delete_xml)
-            delete_cmd = f"VDNAGen -s {shlex.quote(self.__host)} -u {shlex.quote(self.__user)} " \
-                         f"-p {shlex.quote(self.__passwd)} -m {shlex.quote(delete_xml_path)}"
-            delete_cmd = sh2bash(delete_cmd)
-            print(f"执行命令: {delete_cmd}")
-            task.delete_cmd = delete_cmd
-            sts, stdout = getstatusoutput_s(delete_cmd)
-            print(stdout)
+            delete_cmd = ["VDNAGen", "-s", self.__host, "-u", self.__user, "-p", self.__passwd,
+                          "-m", delete_xml_path]
+            task.delete_cmd = shlex.join(delete_cmd)
+            print(f"执行命令: {task.delete_cmd}")
+            res = run(delete_cmd)
+            print(res.output)
             print("done.")
 
 
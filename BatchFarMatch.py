@@ -1,43 +1,73 @@
 #!/miniconda3/envs/py39us/bin/python
 # coding: utf-8
 import argparse
+import asyncio
+import collections
 import json
 import os
-import shlex
+import shutil
+import threading
 import time
+from array import array
+from concurrent.futures import Future
 from concurrent.futures import ThreadPoolExecutor
-from copy import deepcopy
 from enum import IntEnum
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Optional
 
-import pandas as pd
-
-from common import far_is_video_far
-from common import far_video_duration_get
-from common import getstatusoutput_s
-from common import real_time_get
-from common import sh2bash
-from common import mediawise_stdout_get_json
+from common import far_inspect
 from common import str_md5_get
 from common import time_now_get
-from common import symlink_real_path
+from log_writer import AsyncLogWriter
+from log_writer import DEBUG
+from log_writer import INFO
+from log_writer import WARNING
+from log_writer import level_get
+from log_writer import level_names
+from mediawise_aio import AsyncMatchEngine
+from mediawise_aio import max_inflight
+from mediawise_client import MediaWiseClient
+from mediawise_client import MediaWiseError
+from mediawise_client import MediaWiseTimeout
+from report_sink import ReportWriter
+from report_sink import report_formats
+from report_sink import report_xlsx_export
+from walker import walk
 
 backup = os.path.join(os.getcwd(), "backup")
 log_filename = "batch_far_match.log"
 far_path_report = "batch_far_match_far_path.txt"
 xlsx_export = "batch_far_match_report.xlsx"
+# 任务结束时逐行写入的报告, 文件名为 {report_name}.{格式}
+report_name = "batch_far_match_report"
 
 # 使用上次查询结果
 # vdnagen_rematch = False
 # 重新查询
 vdnagen_rematch = True
 
+# 查询超时时间(秒) = match_timeout_base + 视频时长(秒) x match_timeout_factor, match_timeout_factor<=0 表示不限制
+# 视频时长未知时按 match_timeout_duration_unknown 秒计算
+match_timeout_base = 300
+match_timeout_factor = 1.0
+match_timeout_duration_unknown = 3600
+
+# 同时检查far文件的线程数, 检查与查询同时进行
+far_inspect_workers = 4
+
+# 查询方式: thread 每个查询占用一个线程; async 在一个事件循环中同时进行多个查询, 并发数由 max_inflight 限制
+match_engines = ["thread", "async"]
+match_engine = "thread"
+
 
 class Reporter:
     backup_dir = backup
 
-    def __init__(self):
+    def __init__(self, level: int = INFO):
+        """
+        :param level: 日志级别, 低于该级别的日志不输出
+        """
         os.makedirs(self.backup_dir, exist_ok=True)
+        self.level = level
         time_start = time.strftime("%Y%m%d%H%M%S", time.localtime())
         self.__log_path = os.path.join(os.getcwd(), log_filename)
         self.__log_path_bkp = os.path.join(self.backup_dir, f"{time_start}-{log_filename}")
@@ -50,31 +80,69 @@ class Reporter:
             os.remove(far_path_report)
 
         self.__xlsx_export = os.path.join(os.getcwd(), xlsx_export)
-        self.__xlsx_export_bkp = os.path.join(self.backup_dir, f"{time_start}-{xlsx_export}")
+        self.__xlsx = True
+        self.__time_start = time_start
+        self.__report_prefix = os.path.join(os.getcwd(), report_name)
+        self.__report_prefix_bkp = os.path.join(self.backup_dir, f"{time_start}-{report_name}")
+        self.__report_writer: Optional[ReportWriter] = None
+
+        # 日志和far路径由后台线程批量写入, 文件只打开一次
+        self.__log_writer = AsyncLogWriter([self.__log_path, self.__log_path_bkp])
+        self.__path_writer = AsyncLogWriter([self.far_path_report, self.far_path_report_bkp], echo=False)
 
-    def log_write(self, msg: str) -> None:
+    def is_enabled(self, level: int) -> bool:
+        return level >= self.level
+
+    def log_write(self, msg: str, level: int = INFO) -> None:
         """ 写入日志
         """
-        msg = f"[{time_now_get()}] {msg}"
-        print(msg)
-        with open(self.__log_path, mode="a", encoding="utf-8") as f:
-            f.write(msg + "\n")
-        with open(self.__log_path_bkp, mode="a", encoding="utf-8") as f:
-            f.write(msg + "\n")
+        if level < self.level:
+            return
+        self.__log_writer.write(f"[{time_now_get()}] {msg}")
 
     def far_path_write(self, far_path: str) -> None:
-        with open(self.far_path_report, mode="a", encoding="utf-8") as f:
-            f.write(far_path + "\n")
-        with open(self.far_path_report_bkp, mode="a", encoding="utf-8") as f:
-            f.write(far_path + "\n")
+        self.__path_writer.write(far_path)
 
-        pass
+    def flush(self) -> None:
+        """ 等待日志和far路径全部写入文件
+        """
+        self.__log_writer.flush()
+        self.__path_writer.flush()
+
+    def report_open(self, columns: List[str], formats: List[str], xlsx: bool = True) -> None:
+        """
+        打开报告文件, 之后每个任务结束时写入
+        :param columns: 报告列名
+        :param formats: 报告格式 csv jsonl parquet
+        :param xlsx: 结束时是否转换为xlsx, xlsx由csv或jsonl报告转换, 两者都没有时同时生成csv报告
+        :return:
+        """
+        formats = list(dict.fromkeys(formats))
+        if xlsx and "csv" not in formats and "jsonl" not in formats:
+            formats.append("csv")
+        self.__xlsx = xlsx
+        self.__report_writer = ReportWriter(self.__report_prefix, columns, formats)
+
+    def report_write(self, row: dict) -> None:
+        """ 写入报告的一行
+        """
+        self.__report_writer.write(row)
 
-    def xlsx_write(self, df: pd.DataFrame) -> None:
-        """ far生成报告导出
+    def report_close(self) -> None:
+        """ 关闭报告文件, 复制到备份目录, 需要时转换为xlsx
         """
-        df.to_excel(self.__xlsx_export)
-        df.to_excel(self.__xlsx_export_bkp)
+        if self.__report_writer is None:
+            return
+        writer = self.__report_writer
+        self.__report_writer = None
+        writer.close()
+        for path in writer.paths():
+            shutil.copyfile(path, self.__report_prefix_bkp + os.path.splitext(path)[1])
+        if not self.__xlsx:
+            return
+        src = writer.path_get("jsonl") or writer.path_get("csv")
+        for xlsx_path in report_xlsx_export(src, self.__xlsx_export, writer.columns):
+            shutil.copyfile(xlsx_path, os.path.join(self.backup_dir, f"{self.__time_start}-{os.path.basename(xlsx_path)}"))
 
 
 class TaskStatus(IntEnum):
@@ -86,28 +154,35 @@ class TaskStatus(IntEnum):
     match_running = 4
     match_done = 5
     match_error = 6
+    match_timeout = 7
 
 
 class Task:
+    """ 任务记录
+    使用 __slots__ 不为每个任务创建属性字典; 没有匹配结果时匹配信息为共用的空元组,
+    查询结果解析并保存到缓存文件后不再保留原始结果
+    """
+    __slots__ = ["status", "far_path", "far_size", "media_duration", "task_id", "match_start_time", "match_end_time",
+                 "match_time_used", "match_count", "title", "asset_id", "sample_off", "ref_off", "match_duration",
+                 "likelihood", "request"]
+
     def __init__(self):
         self.status = TaskStatus.null
         self.far_path = ""
         self.far_size = -1
         self.media_duration = -1
-        self.match_cmd = ""
-        self.match_task_proc = None
         self.task_id = ""
         self.match_start_time = ""
         self.match_end_time = ""
         self.match_time_used = -1
         self.match_count = -1
-        self.title = []
-        self.asset_id = []
-        self.sample_off = []
-        self.ref_off = []
-        self.match_duration = []
-        self.likelihood = []
-        self.request = {}
+        self.title = ()
+        self.asset_id = ()
+        self.sample_off = ()
+        self.ref_off = ()
+        self.match_duration = ()
+        self.likelihood = ()
+        self.request = None
 
     def dump(self, file: str):
         res = {
@@ -115,7 +190,6 @@ class Task:
             "far_path": self.far_path,
             "far_size": self.far_size,
             "media_duration": self.media_duration,
-            "match_cmd": self.match_cmd,
             "task_id": self.task_id,
             "match_start_time": self.match_start_time,
             "match_end_time": self.match_end_time,
@@ -141,7 +215,6 @@ class Task:
             self.far_path = js.get("far_path", "")
             self.far_size = js.get("far_size", -1)
             self.media_duration = js.get("media_duration", -1)
-            self.match_cmd = js.get("match_cmd", "")
             self.task_id = js.get("task_id", "")
             self.match_start_time = js.get("match_start_time", "")
             self.match_end_time = js.get("match_end_time", "")
@@ -159,30 +232,56 @@ class Task:
 class FarMatcher:
     reporter = Reporter()
 
-    def __init__(self, host: str, user: str, passwd: str, num_workers: int = 40, match_cache: str = "/tmp/far_match"):
-        self.__host = host
-        self.__user = user
-        self.__passwd = passwd
-
+    def __init__(self, host: str, user: str, passwd: str, num_workers: int = 40, match_cache: str = "/tmp/far_match",
+                 log_level: int = INFO, report_formats: Optional[List[str]] = None, report_xlsx: bool = True,
+                 inspect_workers: int = far_inspect_workers, engine: str = match_engine,
+                 inflight: int = max_inflight):
+        self.reporter.level = log_level
+        # 任务结束时逐行写入报告, report_xlsx 为True时全部任务结束后再转换为xlsx
+        self.reporter.report_open(self.__report_columns, ["csv"] if report_formats is None else report_formats,
+                                  report_xlsx)
         os.makedirs(match_cache, exist_ok=True)
         self.match_cache = match_cache
         self.__tasks: List[Task] = []
-        self.__tasks_init_error: List[Task] = []
+        self.__tasks_init_error: int = 0  # 不需要查询或者解析失败的far文件数量
 
         self.__num_workers = 1
         if num_workers > 1:
             self.__num_workers = num_workers
 
-        self.__match_pools = ThreadPoolExecutor(max_workers=self.__num_workers)
-        self.__match_tasks_wait: List[int] = []  # match 还没开始运行的
-        self.__match_tasks_running: List[int] = []  # match 正在运行的
-        self.__match_tasks_done: List[int] = []  # match 已经运行结束的
-        self.__match_tasks_error: List[int] = []  # match 运行出错的任务
+        # thread: 查询线程共用客户端, 连接保持复用; async: 查询在后台事件循环中进行, 不占用线程
+        self.__engine: Optional[AsyncMatchEngine] = None
+        self.__match_pools: Optional[ThreadPoolExecutor] = None
+        self.__client: Optional[MediaWiseClient] = None
+        if engine == "async":
+            self.__engine = AsyncMatchEngine(host, user, passwd, inflight)
+            self.__match_slots = self.__engine.inflight
+            self.__engine_name = f"async engine ({self.__match_slots} in flight)"
+            self.__host = self.__engine.client.host
+        else:
+            self.__match_pools = ThreadPoolExecutor(max_workers=self.__num_workers)
+            self.__client = MediaWiseClient(host, user, passwd, pool_size=self.__num_workers)
+            self.__match_slots = self.__num_workers
+            self.__engine_name = f"{self.__num_workers} thread"
+            self.__host = self.__client.host
+        # 任务按添加顺序运行, 等待中的任务为 [__match_tasks_wait_tr, len(__tasks)) 范围内的索引
+        self.__match_tasks_wait_tr: int = 0  # match 下一个开始运行的任务
+        self.__match_tasks_running: Dict[int, Future] = {}  # match 正在运行的, 结束后不再保留Future
+        self.__match_tasks_finished: "collections.deque[int]" = collections.deque()  # match 运行结束, 等待统计的
+        self.__match_tasks_done: "array[int]" = array("q")  # match 已经运行结束的
+        self.__match_tasks_error: "array[int]" = array("q")  # match 运行出错的任务
 
         # match 结果查询的控制变量
         self.__match_tasks_done_tr: int = 0  # match 已经运行结束的 上次遍历结束的位置
         self.__match_tasks_error_tr: int = 0  # match 运行错误的 上次遍历结束的位置
 
+        # far检查在后台线程池中进行, 检查通过的far立即加入 __tasks, 调度循环随即开始查询
+        self.__tasks_lock = threading.Lock()
+        self.__inspect_workers = max(1, inspect_workers)
+        self.__inspect_done = threading.Event()  # 没有正在进行的后台检查
+        self.__inspect_done.set()
+        self.__wakeup = threading.Event()  # 有新任务或者查询结束时唤醒调度循环
+
     def task_add(self, far_path: str) -> None:
         far_path = os.path.abspath(far_path)
         if os.path.isfile(far_path) and far_path.endswith(".far"):
@@ -192,53 +291,103 @@ class FarMatcher:
             try:
                 cache_dir = os.path.join(self.match_cache, str_md5_get(far_path.encode("utf-8")))
                 os.makedirs(cache_dir, exist_ok=True)
-                if far_is_video_far(far_path, cache_dir):
-                    self.reporter.log_write(f"{far_path} task add success")
+                codec, support, duration = far_inspect(far_path, cache_dir)
+                if support:
+                    self.reporter.log_write(f"{far_path} task add success", DEBUG)
                     self.reporter.far_path_write(far_path)
-                    task.media_duration = far_video_duration_get(far_path, cache_dir)
+                    task.media_duration = duration
                     task.status = TaskStatus.task_create
-                    self.__tasks.append(task)
+                    with self.__tasks_lock:
+                        self.__tasks.append(task)
+                    self.__wakeup.set()
                 else:
-                    self.reporter.log_write(f"{far_path} not support.")
+                    self.reporter.log_write(f"{far_path} not support, video codec: {codec or 'unknown'}.", WARNING)
                     task.status = TaskStatus.no_need_match
-                    self.__tasks_init_error.append(task)
+                    with self.__tasks_lock:
+                        self.__tasks_init_error += 1
             except:
-                self.reporter.log_write(f"{far_path} parse error.")
+                self.reporter.log_write(f"{far_path} parse error.", WARNING)
                 task.status = TaskStatus.parse_error
-                self.__tasks_init_error.append(task)
+                with self.__tasks_lock:
+                    self.__tasks_init_error += 1
         else:
-            self.reporter.log_write(f"{far_path} not found or suffix error, ignored.")
-
-    def tasks_add_from_dir(self, far_dir: str) -> None:
-        for sub in os.listdir(far_dir):
-            sub_path = os.path.join(far_dir, sub)
-            if os.path.isdir(sub_path):
-                sub_far_dir = sub_path
-                self.tasks_add_from_dir(sub_far_dir)
-            elif os.path.isfile(sub_path):
-                far_path = sub_path
-                self.task_add(far_path)
+            self.reporter.log_write(f"{far_path} not found or suffix error, ignored.", WARNING)
 
-    def tasks_add_from_file(self, file: str):
+    def far_paths_from_dir(self, far_dir: str, walk_workers: int = 4) -> Iterator[str]:
+        """
+        遍历文件夹下的所有far文件, 支持递归
+        :param far_dir: far文件夹
+        :param walk_workers: 同时读取目录的线程数
+        :return:
+        """
+
+        def on_error(path: str, e: OSError):
+            self.reporter.log_write(f"{path} can not be read: {e}", WARNING)
+
+        for entry in walk(far_dir, include_exts=[".far"], workers=walk_workers, on_error=on_error):
+            yield entry.path
+
+    def far_paths_from_file(self, file: str) -> Iterator[str]:
+        """ 逐行读取far路径列表文件
+        """
         if not os.path.isfile(file):
-            self.reporter.log_write(f"{file} not found.")
+            self.reporter.log_write(f"{file} not found.", WARNING)
+            return
         with open(file, mode="r", encoding="utf-8") as f:
-            for far_path in f.readlines():
+            for far_path in f:
                 far_path = far_path.strip()
+                if far_path:
+                    yield far_path
+
+    def tasks_add_from_dir(self, far_dir: str, walk_workers: int = 4) -> None:
+        for far_path in self.far_paths_from_dir(far_dir, walk_workers):
+            self.task_add(far_path)
+
+    def tasks_add_from_file(self, file: str):
+        for far_path in self.far_paths_from_file(file):
+            self.task_add(far_path)
+
+    def tasks_add_async(self, far_paths: Iterable[str]) -> None:
+        """
+        在后台线程中检查far文件, 与 tasks_run 同时运行, 检查通过的far立即加入查询队列
+        :param far_paths: far文件路径, 可以是遍历目录的生成器, 遍历同样在后台线程中进行
+        :return:
+        """
+        self.__inspect_done.clear()
+        threading.Thread(target=self.__inspect_loop, args=(far_paths,), daemon=True).start()
+
+    def __inspect_loop(self, far_paths: Iterable[str]) -> None:
+        # 等待检查的far数量有上限, 遍历不会远远超前于检查
+        pending = threading.BoundedSemaphore(self.__inspect_workers * 4)
+
+        def inspect(far_path: str):
+            try:
                 self.task_add(far_path)
+            finally:
+                pending.release()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.__inspect_workers) as pool:
+                for far_path in far_paths:
+                    pending.acquire()
+                    pool.submit(inspect, far_path)
+        except Exception as e:
+            self.reporter.log_write(f"far inspect stopped: {e}", WARNING)
+        finally:
+            self.__inspect_done.set()
+            self.__wakeup.set()
 
     def __tasks_init(self):
 
-        self.__match_tasks_wait = []
-        self.__match_tasks_done = []
-        self.__match_tasks_running = []
-        self.__match_tasks_error = []
+        self.__match_tasks_wait_tr = 0
+        self.__match_tasks_done = array("q")
+        self.__match_tasks_running = {}
+        self.__match_tasks_finished.clear()
+        self.__match_tasks_error = array("q")
 
         self.__match_tasks_done_tr = 0
         self.__match_tasks_error_tr = 0
 
-        self.__match_tasks_wait = [*range(len(self.__tasks))]
-
     def __request_parse(self, task_id: int):
         if 0 <= task_id < len(self.__tasks):
             task: Task = self.__tasks[task_id]
@@ -263,6 +412,8 @@ class FarMatcher:
             task.match_count = len(match_list)
             if len(match_list) == 0:
                 return
+            task.title, task.asset_id, task.sample_off, task.ref_off, task.match_duration, task.likelihood = \
+                [], [], [], [], [], []
 
             # match_item 服务器查询的一个母本匹配结果
             for match_item in match_list:
@@ -314,190 +465,276 @@ class FarMatcher:
                 task.sample_off.append(sample_offset)
                 task.ref_off.append(reference_offset)
 
-    def __match_runner(self, task_id: int):
+    @staticmethod
+    def __match_timeout_get(task: Task) -> Optional[float]:
+        """
+        获得查询任务的超时时间
+        :param task: 任务
+        :return: 超时时间(秒), 不限制时返回None
+        """
+        if match_timeout_factor <= 0:
+            return None
+        duration = task.media_duration
+        if duration is None or duration <= 0:
+            duration = match_timeout_duration_unknown
+        return match_timeout_base + duration * match_timeout_factor
+
+    def __match_task_begin(self, task_id: int) -> Optional[Task]:
+        """
+        查询前的准备, 不重新查询时读取上次的查询结果
+        :param task_id: 任务索引
+        :return: 需要查询的任务, 不需要查询时返回None
+        """
         if 0 <= task_id < len(self.__tasks):
             task: Task = self.__tasks[task_id]
         else:
-            return
+            return None
 
         if task.status != TaskStatus.need_match:
             task.status = TaskStatus.match_error
-            return
+            return None
         task.status = TaskStatus.match_running
-        far_path = task.far_path
-        far_name = os.path.basename(far_path)
-        cache_dir = os.path.join(self.match_cache, str_md5_get(far_path.encode("utf-8")))
-        os.makedirs(cache_dir, exist_ok=True)
-        task_dump_path = os.path.join(cache_dir, far_name + ".match")
+        task_dump_path = self.__match_dump_path_get(task)
         if not vdnagen_rematch and os.path.isfile(task_dump_path):
             task.load(task_dump_path)
-        if task.status != TaskStatus.match_done:
-            match_cmd = f"time python2 {shlex.quote(os.path.join(os.path.dirname(symlink_real_path(__file__)), 'FarQuerySampleCode.py'))} " \
-                        f"-s {self.__host} -u {self.__user} -p {self.__passwd}" \
-                        f" -i {shlex.quote(far_path)}"
-            match_cmd = sh2bash(match_cmd)
-            task.match_cmd = match_cmd
-            time_begin = time_now_get()
-            status, output = getstatusoutput_s(match_cmd)
-            time_end = time_now_get()
-            task.match_start_time = time_begin
-            task.match_end_time = time_end
-            task.match_time_used = real_time_get(output)
-            request = mediawise_stdout_get_json(output)
-            if len(request) == 0:
-                task.status = TaskStatus.match_error
-                task.request = output
-                return
-            request = json.loads(request)
-            task.request = request
-            self.__request_parse(task_id)
-            task.status = TaskStatus.match_done
-            task.dump(task_dump_path)
+            task.request = None
+        return None if task.status == TaskStatus.match_done else task
 
-    def __match_tasks_queue_update(self):
-        # 统计已经完成的任务
-        tasks = []
-        for task_id in self.__match_tasks_running:
-            task: Task = self.__tasks[task_id]
-            task_proc = task.match_task_proc
-            if task_proc.done():
-                tasks.append(task_id)
+    def __match_dump_path_get(self, task: Task) -> str:
+        cache_dir = os.path.join(self.match_cache, str_md5_get(task.far_path.encode("utf-8")))
+        os.makedirs(cache_dir, exist_ok=True)
+        return os.path.join(cache_dir, os.path.basename(task.far_path) + ".match")
+
+    def __match_task_end(self, task_id: int, request: Optional[dict], error: Optional[MediaWiseError]) -> None:
+        """
+        保存查询结果
+        :param task_id: 任务索引
+        :param request: 服务器返回的查询结果
+        :param error: 查询失败的原因
+        """
+        task: Task = self.__tasks[task_id]
+        if error is not None:
+            task.status = TaskStatus.match_timeout if isinstance(error, MediaWiseTimeout) else TaskStatus.match_error
+            task.request = str(error)
+            return
+        task.request = request
+        self.__request_parse(task_id)
+        task.status = TaskStatus.match_done
+        task.dump(self.__match_dump_path_get(task))
+        task.request = None
+
+    def __match_runner(self, task_id: int):
+        task = self.__match_task_begin(task_id)
+        if task is None:
+            return
+        timeout = self.__match_timeout_get(task)
+        task.match_start_time = time_now_get()
+        time_run_start = time.monotonic()
+        request, error = None, None
+        try:
+            request = self.__client.query(task.far_path, timeout=0 if timeout is None else timeout)
+        except MediaWiseError as e:
+            error = e
+        task.match_end_time = time_now_get()
+        task.match_time_used = round(time.monotonic() - time_run_start, 3)
+        self.__match_task_end(task_id, request, error)
+
+    async def __match_runner_async(self, task_id: int):
+        """ 与 __match_runner 相同, 在事件循环中运行
+        查询前后的文件读写(创建目录, 读取和保存查询结果)在线程池中执行, 事件循环线程只等待查询
+        """
+        loop = asyncio.get_running_loop()
+        task = await loop.run_in_executor(None, self.__match_task_begin, task_id)
+        if task is None:
+            return
+        timeout = self.__match_timeout_get(task)
+        task.match_start_time = time_now_get()
+        time_run_start = time.monotonic()
+        request, error = None, None
+        try:
+            request = await self.__engine.client.query(task.far_path, timeout=0 if timeout is None else timeout)
+        except MediaWiseError as e:
+            error = e
+        task.match_end_time = time_now_get()
+        task.match_time_used = round(time.monotonic() - time_run_start, 3)
+        await loop.run_in_executor(None, self.__match_task_end, task_id, request, error)
 
-        # 删除已经完成的任务
-        for task_id in tasks:
-            self.__match_tasks_running.remove(task_id)
+    def __match_tasks_queue_update(self):
+        # 删除已经完成的任务, 结束的任务由回调记录, 不需要遍历所有正在运行的任务
+        while self.__match_tasks_finished:
+            task_id = self.__match_tasks_finished.popleft()
+            del self.__match_tasks_running[task_id]
             task: Task = self.__tasks[task_id]
             if task.status == TaskStatus.match_done:
                 self.__match_tasks_done.append(task_id)
             else:
                 self.__match_tasks_error.append(task_id)
-
-        # 获得新任务
-        tasks = []
-        for task_id in self.__match_tasks_wait:
-            if len(tasks) + len(self.__match_tasks_running) >= self.__num_workers:
-                break
-            tasks.append(task_id)
+            self.__task_report_write(task)
 
         # 启动新任务
-        for task_id in tasks:
+        while len(self.__match_tasks_running) < self.__match_slots and self.__match_tasks_wait_tr < len(self.__tasks):
+            task_id = self.__match_tasks_wait_tr
+            self.__match_tasks_wait_tr += 1
             task: Task = self.__tasks[task_id]
             task.status = TaskStatus.need_match
-            task_proc = self.__match_pools.submit(self.__match_runner, task_id)
-            task.match_task_proc = task_proc
-            self.__match_tasks_running.append(task_id)
-            self.__match_tasks_wait.remove(task_id)
+            if self.__engine is not None:
+                future = self.__engine.submit(self.__match_runner_async(task_id))
+            else:
+                future = self.__match_pools.submit(self.__match_runner, task_id)
+            self.__match_tasks_running[task_id] = future
+            future.add_done_callback(lambda f, i=task_id: self.__match_task_finish(i))
+
+    def __match_task_finish(self, task_id: int) -> None:
+        """ 查询结束的回调, 在查询线程或者事件循环线程中运行
+        """
+        self.__match_tasks_finished.append(task_id)
+        self.__wakeup.set()
 
-    def __match_task_log_update_op(self, task_id: int):
+    def __match_task_log_update_op(self, task_id: int, level: int):
+        if not self.reporter.is_enabled(level):
+            return
         if 0 <= task_id <= len(self.__tasks):
             task: Task = self.__tasks[task_id]
         else:
             return
-        self.reporter.log_write(f"far path: {task.far_path}")
-        self.reporter.log_write(f"far size: {task.far_size}")
-        self.reporter.log_write(f"media duration: {task.media_duration}")
-        self.reporter.log_write(f"match command: {task.match_cmd}")
-        self.reporter.log_write(f"match status: {task.status}")
-        self.reporter.log_write(f"match start time: {task.match_start_time}")
-        self.reporter.log_write(f"match end time: {task.match_end_time}")
-        self.reporter.log_write(f"match time used: {task.match_time_used}")
-        self.reporter.log_write(f"match task id: {task.task_id}")
-        self.reporter.log_write(f"match result count: {task.match_count}")
+        self.reporter.log_write(f"far path: {task.far_path}", level)
+        self.reporter.log_write(f"far size: {task.far_size}", level)
+        self.reporter.log_write(f"media duration: {task.media_duration}", level)
+        self.reporter.log_write(f"match server: {self.__host}", level)
+        self.reporter.log_write(f"match status: {task.status}", level)
+        if task.status in (TaskStatus.match_error, TaskStatus.match_timeout):
+            self.reporter.log_write(f"match error: {task.request}", level)
+        self.reporter.log_write(f"match start time: {task.match_start_time}", level)
+        self.reporter.log_write(f"match end time: {task.match_end_time}", level)
+        self.reporter.log_write(f"match time used: {task.match_time_used}", level)
+        self.reporter.log_write(f"match task id: {task.task_id}", level)
+        self.reporter.log_write(f"match result count: {task.match_count}", level)
         if task.match_count <= 0:
             return
         for i in range(task.match_count):
-            self.reporter.log_write(f"match result {i + 1}:")
-            self.reporter.log_write(f"\tmatch title: {task.title[i]}")
-            self.reporter.log_write(f"\tmatch asset_id: {task.asset_id[i]}")
-            self.reporter.log_write(f"\tmatch sample offset: {task.sample_off[i]}")
-            self.reporter.log_write(f"\tmatch reference offset: {task.ref_off[i]}")
-            self.reporter.log_write(f"\tmatch duration duration: {task.match_duration[i]}")
-            self.reporter.log_write(f"\tmatch likelihood: {task.likelihood[i]}")
+            self.reporter.log_write(f"match result {i + 1}:", level)
+            self.reporter.log_write(f"\tmatch title: {task.title[i]}", level)
+            self.reporter.log_write(f"\tmatch asset_id: {task.asset_id[i]}", level)
+            self.reporter.log_write(f"\tmatch sample offset: {task.sample_off[i]}", level)
+            self.reporter.log_write(f"\tmatch reference offset: {task.ref_off[i]}", level)
+            self.reporter.log_write(f"\tmatch duration duration: {task.match_duration[i]}", level)
+            self.reporter.log_write(f"\tmatch likelihood: {task.likelihood[i]}", level)
 
     def __match_task_log_update(self):
         for i in range(len(self.__match_tasks_done) - self.__match_tasks_done_tr):
-            self.reporter.log_write(
-                f"=============== Success Match task {self.__match_tasks_done_tr + i + 1} ===============")
+            # 成功的任务只打印一行摘要, 详细信息为DEBUG级别
             task_id = self.__match_tasks_done[self.__match_tasks_done_tr + i]
-            self.__match_task_log_update_op(task_id)
+            task: Task = self.__tasks[task_id]
+            self.reporter.log_write(f"Success Match task {self.__match_tasks_done_tr + i + 1}: "
+                                    f"{task.far_path} ({task.match_count} matches, {task.match_time_used} sec)")
+            self.__match_task_log_update_op(task_id, DEBUG)
 
         self.__match_tasks_done_tr = len(self.__match_tasks_done)
         for i in range(len(self.__match_tasks_error) - self.__match_tasks_error_tr):
             self.reporter.log_write(
-                f"=============== Error Match task {self.__match_tasks_error_tr + i + 1} ===============")
+                f"=============== Error Match task {self.__match_tasks_error_tr + i + 1} ===============", WARNING)
             task_id = self.__match_tasks_error[self.__match_tasks_error_tr + i]
-            self.__match_task_log_update_op(task_id)
+            self.__match_task_log_update_op(task_id, WARNING)
         self.__match_tasks_error_tr = len(self.__match_tasks_error)
 
-    def __tasks_report_export(self):
-        tpl = {
-            # 文件信息
-            "far_path": "",  # far文件路径
-            "media_duration(s)": "",
-            # 查询时间与查询状态
-            "start_time": "",
-            "end_time": "",
-            "error": "",  # 错误信息 格式 error_code(error_message)
-            "TaskID": "",
-
-            # 匹配信息
-            "match_count": "",  # 匹配数
-            "Title": "",  # 匹配到的视频名称
-            "AssetID": "",  # 匹配母本的唯一标识号
-            "SampleOffset": "",  # 样本的偏移时间
-            "RefOffset": "",  # 母本的偏移时间
-            "MatchDuration(s)": "",  # 母本匹配时间
-            "Likelihood": ""  # 匹配的相似度
-        }
-        res = []
-        for task in self.__tasks:
-            report = deepcopy(tpl)
-            report["far_path"] = task.far_path
-            report["media_duration(s)"] = task.media_duration
-            report["start_time"] = task.match_start_time
-            report["end_time"] = task.match_end_time
-            report["TaskID"] = task.task_id
-            if task.status != TaskStatus.match_done or task.match_count < 0:
-                report["error"] = "-1(Failed)"
-                res.append(report)
-                continue
-            report["error"] = "0(Success)"
-            report["match_count"] = task.match_count
-            if task.match_count == 0:
-                res.append(report)
-                continue
-            for match_idx in range(task.match_count):
-                report_match_item = deepcopy(report)
-                report_match_item["Title"] = task.title[match_idx]
-                report_match_item["AssetID"] = task.asset_id[match_idx]
-                report_match_item["SampleOffset"] = task.sample_off[match_idx]
-                report_match_item["RefOffset"] = task.ref_off[match_idx]
-                report_match_item["MatchDuration(s)"] = task.match_duration[match_idx]
-                report_match_item["Likelihood"] = task.likelihood[match_idx]
-                res.append(report_match_item)
-        res = pd.DataFrame(res)
-        self.reporter.xlsx_write(res)
+    # 报告列名
+    __report_columns = [
+        # 文件信息
+        "far_path",  # far文件路径
+        "media_duration(s)",
+        # 查询时间与查询状态
+        "start_time",
+        "end_time",
+        "error",  # 错误信息 格式 error_code(error_message)
+        "TaskID",
+
+        # 匹配信息
+        "match_count",  # 匹配数
+        "Title",  # 匹配到的视频名称
+        "AssetID",  # 匹配母本的唯一标识号
+        "SampleOffset",  # 样本的偏移时间
+        "RefOffset",  # 母本的偏移时间
+        "MatchDuration(s)",  # 母本匹配时间
+        "Likelihood",  # 匹配的相似度
+    ]
+
+    def __task_report_write(self, task: Task) -> None:
+        """ 任务结束时立即写入报告, 每个匹配结果一行
+        """
+        report = dict.fromkeys(self.__report_columns, "")
+        report["far_path"] = task.far_path
+        report["media_duration(s)"] = task.media_duration
+        report["start_time"] = task.match_start_time
+        report["end_time"] = task.match_end_time
+        report["TaskID"] = task.task_id
+        if task.status == TaskStatus.match_timeout:
+            report["error"] = "-2(Timeout)"
+            self.reporter.report_write(report)
+            return
+        if task.status != TaskStatus.match_done or task.match_count < 0:
+            report["error"] = "-1(Failed)"
+            self.reporter.report_write(report)
+            return
+        report["error"] = "0(Success)"
+        report["match_count"] = task.match_count
+        if task.match_count == 0:
+            self.reporter.report_write(report)
+            return
+        for match_idx in range(task.match_count):
+            report["Title"] = task.title[match_idx]
+            report["AssetID"] = task.asset_id[match_idx]
+            report["SampleOffset"] = task.sample_off[match_idx]
+            report["RefOffset"] = task.ref_off[match_idx]
+            report["MatchDuration(s)"] = task.match_duration[match_idx]
+            report["Likelihood"] = task.likelihood[match_idx]
+            self.reporter.report_write(report)
 
     def tasks_run(self):
         self.__tasks_init()
-        self.reporter.log_write(f"start {self.__num_workers} thread to running {len(self.__tasks)} task...")
-        while len(self.__match_tasks_wait) + len(self.__match_tasks_running) > 0:
+        if self.__inspect_done.is_set():
+            self.reporter.log_write(f"start {self.__engine_name} to running {len(self.__tasks)} task...")
+        else:
+            self.reporter.log_write(f"start {self.__engine_name} to running tasks, "
+                                    f"{self.__inspect_workers} thread to inspect far...")
+        while not self.__inspect_done.is_set() or self.__match_tasks_wait_tr < len(self.__tasks) \
+                or len(self.__match_tasks_running) > 0:
+            self.__wakeup.clear()
             self.__match_tasks_queue_update()
             self.__match_task_log_update()
-            time.sleep(1)
-        self.__tasks_report_export()
-        self.reporter.log_write(f"{self.__num_workers} thread to running {len(self.__tasks)} task done.")
-
-
-def batch_far_match(host: str, user: str, passwd: str, input: str, num_workers: int):
-    fm = FarMatcher(host, user, passwd, num_workers)
+            self.__wakeup.wait(1)
+        self.reporter.log_write(f"far inspect: {len(self.__tasks)} need match, {self.__tasks_init_error} skipped")
+        if self.__engine is not None:
+            self.__engine.close()
+        else:
+            self.__client.close()
+        self.reporter.report_close()
+        self.reporter.log_write(f"{self.__engine_name} to running {len(self.__tasks)} task done.")
+        self.reporter.flush()
+
+
+def batch_far_match(host: str, user: str, passwd: str, input: str, num_workers: int, log_level: str = "info",
+                    report_format: str = "csv", xlsx: bool = True, inspect_workers: int = far_inspect_workers,
+                    engine: str = match_engine, inflight: int = max_inflight):
+    fm = FarMatcher(host, user, passwd, num_workers, log_level=level_get(log_level),
+                    report_formats=report_format.split(","), report_xlsx=xlsx, inspect_workers=inspect_workers,
+                    engine=engine, inflight=inflight)
+    # far检查与查询同时进行, 第一个far检查通过后立即开始查询
     if os.path.isfile(input):
-        fm.tasks_add_from_file(input)
+        fm.tasks_add_async(fm.far_paths_from_file(input))
     else:
-        fm.tasks_add_from_dir(input)
+        fm.tasks_add_async(fm.far_paths_from_dir(input))
     fm.tasks_run()
 
 
+def report_format_check(value: str) -> str:
+    """ 检查报告格式参数
+    """
+    for fmt in value.split(","):
+        if fmt not in report_formats:
+            raise argparse.ArgumentTypeError(f"unsupported report format: {fmt}")
+    return value
+
+
 def parse_args():
     parser = argparse.ArgumentParser(prog="python3 BatchFarMatch.py", description="批量far文件vddb查询")
     parser.add_argument("-s", "--host", type=str, required=True, help="VDDB服务地址")
@@ -505,6 +742,18 @@ def parse_args():
     parser.add_argument("-p", "--password", type=str, required=True, help="VDDB用户密码")
     parser.add_argument("-i", "--input", type=str, required=True, help="far文件路径信息")
     parser.add_argument("--num_workers", default=1, type=int, required=False, help="工作线程数")
+    parser.add_argument("--log_level", default="info", choices=list(level_names), required=False,
+                        help="日志级别, 默认info: 成功的任务只输出一行摘要, debug时输出每个任务的详细信息")
+    parser.add_argument("--report_format", default="csv", type=report_format_check, required=False,
+                        help=f"任务结束时逐行写入的报告格式, 逗号分隔, 可选 {','.join(report_formats)}, parquet需要安装pyarrow")
+    parser.add_argument("--no_xlsx", action="store_true", help="全部任务结束后不生成xlsx报告")
+    parser.add_argument("--inspect_workers", default=far_inspect_workers, type=int, required=False,
+                        help=f"同时检查far文件的线程数, 检查与查询同时进行, 默认{far_inspect_workers}")
+    parser.add_argument("--engine", default=match_engine, choices=match_engines, required=False,
+                        help="查询方式: thread 每个查询占用一个工作线程; async 在一个事件循环中同时进行多个查询, "
+                             "并发数由 --max_inflight 限制, 不使用 --num_workers")
+    parser.add_argument("--max_inflight", default=max_inflight, type=int, required=False,
+                        help=f"async 查询方式同时进行的查询数量上限, 默认{max_inflight}")
     return parser.parse_args()
 
 
@@ -519,7 +768,8 @@ def main():
         exit('Already running')
 
     time_begin = time.time()
-    batch_far_match(args.host, args.user, args.password, args.input, args.num_workers)
+    batch_far_match(args.host, args.user, args.password, args.input, args.num_workers, args.log_level,
+                    args.report_format, not args.no_xlsx, args.inspect_workers, args.engine, args.max_inflight)
     time_end = time.time()
     print(f"总共用时: {time_end - time_begin:.3f}s")
 
@@ -19,6 +19,7 @@ import os
 from xml.dom import minidom
 from xml.dom.minidom import parseString
 import time
+import socket
 import urllib
 import urllib2
 import mimetypes
@@ -108,14 +109,22 @@ def parse_options():
         parser.add_option("-i", "--input", dest="far",
                           help="specify FAR file to query",
                           metavar="FAR")
+        parser.add_option("-t", "--timeout", dest="timeout", type="int", default=3600,
+                          help="specify the max seconds to wait for the query result, 0 means no limit, "
+                               "default to 3600",
+                          metavar="TIMEOUT")
         parser.add_option("-f", "--format", dest="format",
                           help='specify the output format of query result, only "vobile" or "crr"' \
                                'is available, default to "vobile"',
                           default="vobile",
                           metavar="FORMAT")
         (options, args) = parser.parse_args()
-        options.retry = sys.maxint
         options.interval = 1
+        options.retry = sys.maxint
+        if options.timeout > 0:
+            options.retry = options.timeout / options.interval
+            # single http request should not block longer than the whole query
+            socket.setdefaulttimeout(min(options.timeout, 60))
     except Exception, e:
         sys.exit(ERROR_INVALID_PARAMENT)
 
@@ -298,7 +307,7 @@ def fetch_result(host, user, password, taskID, interval, retry, format):
             far_query_exit(ERROR_INTERNAL, "Failed to fetch result:%s" % e)
 
         if (retry < 1):  # if retry timeout
-            far_query_exit(ERROR_INTERNAL, "Fetry timeout")
+            far_query_exit(ERROR_INTERNAL, "Fetch timeout")
         time.sleep(interval)
         retry -= 1
 
@@ -2,10 +2,11 @@
 # pip install xmltodict
 import json
 import os
-import shlex
-import subprocess
-from typing import Optional, Tuple
-from common import sh2bash
+from typing import List, Optional, Tuple
+
+from mediawise_client import MediaWiseClient
+from mediawise_client import MediaWiseError
+from runner import run
 
 import xmltodict
 
@@ -25,37 +26,14 @@ def _stdout_get_xml(stdout: str, tag: str) -> str:
     return res
 
 
-def _stdout_get_json(stdout: str) -> str:
-    """
-    从stdout从提取json信息
-    :param stdout:
-    :return:
-    """
-    res = ""
-    if "{" in stdout and "}" in stdout:
-        start_idx = 0
-        for i in range(len(stdout)):
-            if stdout[i] == "{":
-                start_idx = i
-                break
-        end_idx = len(stdout)
-        for i in range(len(stdout), 0, -1):
-            if stdout[i - 1] == "}":
-                end_idx = i
-                break
-        res = stdout[start_idx:end_idx]
-    return res
-
-
-def _shell_run(shell_cmd: str) -> Tuple[int, str]:
+def _shell_run(argv: List[str]) -> Tuple[str, int, str]:
     """
-    运行shell命令,并获得命令的退出状态和打印信息
+    运行命令,并获得命令的退出状态和打印信息
+    :param argv: 命令参数列表, 直接执行不经过shell
+    :return: (命令字符串, 退出状态, 打印信息)
     """
-    # print(f"running: {shell_cmd}")
-    status, stdout = subprocess.getstatusoutput(shell_cmd)
-    # print(f"exit code: {status}")
-    # print(f"stdout: \n {stdout}")
-    return status, stdout
+    res = run(argv)
+    return res.cmd, res.status, res.output
 
 
 class VDNAGen:
@@ -64,15 +42,28 @@ class VDNAGen:
         self.__host = None
         self.__user = None
         self.__passwd = None
+        self.__client: Optional[MediaWiseClient] = None
 
     def host_set(self, host: str) -> None:
         self.__host = host
+        self.__client = None
 
     def user_set(self, user: str) -> None:
         self.__user = user
+        self.__client = None
 
     def passwd_set(self, passwd: str) -> None:
         self.__passwd = passwd
+        self.__client = None
+
+    def __client_get(self) -> MediaWiseClient:
+        """ 查询客户端, 连接在多次查询之间复用
+        """
+        client = self.__client
+        if client is None:
+            client = MediaWiseClient(self.__host, self.__user, self.__passwd, pool_size=8)
+            self.__client = client
+        return client
 
     def __config_check(self) -> bool:
         if None in [self.__host, self.__user, self.__passwd]:
@@ -117,9 +108,8 @@ class VDNAGen:
             res["rebuild"] = 0
         else:
             res["rebuild"] = 1
-            shell_cmd = sh2bash(f"VDNAGen -o {shlex.quote(far_path)} {shlex.quote(movie_path)}")
+            shell_cmd, status, stdout = _shell_run(["VDNAGen", "-o", far_path, movie_path])
             res["shell_cmd"] = shell_cmd
-            status, stdout = _shell_run(shell_cmd)
             res["exit_code"] = status
             xml_str = _stdout_get_xml(stdout, "receipt")
             if len(xml_str) != 0:
@@ -143,10 +133,9 @@ class VDNAGen:
             rename_xml = template_xml % (meta_uid, dna_name)
             with open("rename_dna.xml", mode="w", encoding="utf-8") as f:
                 f.write(rename_xml)
-            shell_cmd = f"VDNAGen -s {shlex.quote(self.__host)} -u {shlex.quote(self.__user)} -p {shlex.quote(self.__passwd)} -m rename_dna.xml"
-            shell_cmd = sh2bash(shell_cmd)
+            shell_cmd, status, stdout = _shell_run(
+                ["VDNAGen", "-s", self.__host, "-u", self.__user, "-p", self.__passwd, "-m", "rename_dna.xml"])
             res["shell_cmd"] = shell_cmd
-            status, stdout = _shell_run(shell_cmd)
             res["exit_code"] = status
             xml_str = _stdout_get_xml(stdout, "receipt")
             if len(xml_str) != 0:
@@ -176,10 +165,9 @@ class VDNAGen:
             delete_xml = template_xml % meta_uid
             with open("delete_dna.xml", mode="w", encoding="utf-8") as f:
                 f.write(delete_xml)
-            shell_cmd = f"VDNAGen -s {shlex.quote(self.__host)} -u {shlex.quote(self.__user)} -p {shlex.quote(self.__passwd)} -m delete_dna.xml"
-            shell_cmd = sh2bash(shell_cmd)
+            shell_cmd, status, stdout = _shell_run(
+                ["VDNAGen", "-s", self.__host, "-u", self.__user, "-p", self.__passwd, "-m", "delete_dna.xml"])
             res["shell_cmd"] = shell_cmd
-            status, stdout = _shell_run(shell_cmd)
             res["exit_code"] = status
             xml_str = _stdout_get_xml(stdout, "receipt")
             if len(xml_str) != 0:
@@ -197,10 +185,9 @@ class VDNAGen:
         """
         res = {"mode": "far_db_insert"}
         if self.__config_check():
-            shell_cmd = f"VDNAGen -s {shlex.quote(self.__host)} -u {shlex.quote(self.__user)} -p {shlex.quote(self.__passwd)} {shlex.quote(far_path)}"
-            shell_cmd = sh2bash(shell_cmd)
+            shell_cmd, status, stdout = _shell_run(
+                ["VDNAGen", "-s", self.__host, "-u", self.__user, "-p", self.__passwd, far_path])
             res["shell_cmd"] = shell_cmd
-            status, stdout = _shell_run(shell_cmd)
             res["exit_code"] = status
             xml_str = _stdout_get_xml(stdout, "receipt")
             if len(xml_str) != 0:
@@ -215,17 +202,12 @@ class VDNAGen:
         :param far_path:
         :return:
         """
-        res = {"mode": "far_db_match"}
-        shell_cmd = f"python2 FarQuerySampleCode.py -s " \
-                    f"{shlex.quote(self.__host)} -u {shlex.quote(self.__user)} " \
-                    f"-p {shlex.quote(self.__passwd)} -i {shlex.quote(far_path)}"
-        shell_cmd = sh2bash(shell_cmd)
-        res["shell_cmd"] = shell_cmd
-        status, stdout = _shell_run(shell_cmd)
-        res["exit_code"] = status
-        json_str = _stdout_get_json(stdout)
-        if len(json_str) != 0:
-            res["stdout2json"] = json.loads(json_str)
-        else:
-            res["stdout"] = stdout
+        res = {"mode": "far_db_match", "server": self.__host}
+        # 结果格式与原来调用 FarQuerySampleCode.py 时相同, 查询失败时 stdout 为错误信息
+        try:
+            res["stdout2json"] = self.__client_get().query(far_path)
+            res["exit_code"] = 0
+        except MediaWiseError as e:
+            res["exit_code"] = 2
+            res["stdout"] = str(e)
         return json.dumps(res, indent=2, ensure_ascii=False)
@@ -0,0 +1,114 @@
+# coding: utf-8
+import os
+import time
+from typing import Optional
+
+
+def load_avg_get() -> float:
+    """
+    获得每个CPU线程的平均负载(1分钟)
+    :return: 负载, 不支持时返回0
+    """
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return 0.0
+
+
+def mem_available_get() -> Optional[int]:
+    """
+    获得系统可用内存
+    :return: 可用内存(字节), 不支持时返回None
+    """
+    try:
+        with open("/proc/meminfo", mode="r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class WorkerScaler:
+    """ 并发数自动调整
+    每个调整周期根据系统负载、可用内存以及任务吞吐量调整并发数:
+    负载过高或可用内存不足时减少并发数; 负载较低且任务排队时增加并发数,
+    如果上次增加并发数后吞吐量没有提升, 则撤销上次的增加并保持不变
+    """
+
+    def __init__(self, name: str,
+                 workers: int,
+                 min_workers: int,
+                 max_workers: int,
+                 interval: float = 30.0,
+                 load_low: float = 0.8,
+                 load_high: float = 1.2,
+                 mem_min: int = 1024 * 1024 * 1024):
+        """
+        :param name: 名称, 用于日志
+        :param workers: 初始并发数
+        :param min_workers: 最小并发数
+        :param max_workers: 最大并发数
+        :param interval: 调整周期(秒)
+        :param load_low: 每个CPU线程的负载低于该值时允许增加并发数
+        :param load_high: 每个CPU线程的负载高于该值时减少并发数
+        :param mem_min: 可用内存低于该值(字节)时减少并发数
+        """
+        self.name = name
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.workers = min(max(workers, self.min_workers), self.max_workers)
+        self.interval = interval
+        self.__load_low = load_low
+        self.__load_high = load_high
+        self.__mem_min = mem_min
+
+        self.__time_last = time.monotonic()
+        self.__done = 0  # 本周期完成的任务数量
+        self.__throughput_last = -1.0  # 上个周期的吞吐量(任务/分钟)
+        self.__grown = False  # 上个周期是否增加了并发数
+        self.status = ""
+
+    def task_done(self, count: int = 1) -> None:
+        """ 记录完成的任务数量
+        """
+        self.__done += count
+
+    def is_due(self) -> bool:
+        return time.monotonic() - self.__time_last >= self.interval
+
+    def update(self, backlog: bool) -> bool:
+        """
+        调整并发数, 调用间隔不足一个调整周期时不做调整
+        :param backlog: 是否有任务在排队等待
+        :return: 并发数是否发生变化
+        """
+        now = time.monotonic()
+        elapsed = now - self.__time_last
+        if elapsed < self.interval:
+            return False
+        throughput = self.__done * 60 / elapsed
+        self.__done = 0
+        self.__time_last = now
+
+        load = load_avg_get()
+        mem = mem_available_get()
+        workers = self.workers
+        if (mem is not None and mem < self.__mem_min) or load > self.__load_high:
+            workers -= 1
+        elif self.__grown and 0 < throughput <= self.__throughput_last:
+            # 增加并发数没有提升吞吐量, 撤销
+            workers -= 1
+        elif backlog and load < self.__load_low:
+            workers += 1
+        workers = min(max(workers, self.min_workers), self.max_workers)
+
+        self.__grown = workers > self.workers
+        self.__throughput_last = throughput
+        mem_desc = "unknown" if mem is None else f"{mem / 1024 / 1024:.0f}MB"
+        self.status = f"{self.name} workers {self.workers} -> {workers} " \
+                      f"(load {load:.2f}, mem available {mem_desc}, throughput {throughput:.1f} tasks/min)"
+        changed = workers != self.workers
+        self.workers = workers
+        return changed
@@ -1,11 +1,26 @@
 # coding: utf-8
+import errno
+import fcntl
 import hashlib
+import mmap
 import os
-import shlex
 import shutil
-import subprocess
+import tempfile
+import threading
 import time
-from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional, Tuple
+
+from runner import run
+
+# 抽样指纹每块的大小
+hash_block_size = 1024 * 1024
+# 计算整个文件哈希时每次处理的数据量
+hash_buffer_size = 8 * 1024 * 1024
+# 同一目录被多个进程使用时, 第一个进程使用目录本身, 其他进程使用 {root}/.slot-N 子目录
+dir_slot_prefix = ".slot-"
+# 每个目录中的锁文件, 持有锁的进程独占该目录
+dir_slot_lock_name = ".lock"
 
 
 def symlink_real_path(path: str):
@@ -15,17 +30,6 @@ def symlink_real_path(path: str):
     return res
 
 
-def sh2bash(cmd: str) -> str:
-    return "bash -c {sh}".format(sh=shlex.quote(cmd))
-
-
-def getstatusoutput_s(cmd: str) -> Tuple[int, str]:
-    try:
-        return subprocess.getstatusoutput(cmd)
-    except Exception:
-        return -1, ""
-
-
 def video_duration_get(path: str):
     """
     通过ffprobe获得视频时长
@@ -34,8 +38,9 @@ def video_duration_get(path: str):
     """
     duration = -1
     if os.path.isfile(path):
-        sts, output = getstatusoutput_s(
-            f"ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 {shlex.quote(path)}")
+        res = run(["ffprobe", "-v", "error", "-show_entries", "format=duration",
+                   "-of", "default=noprint_wrappers=1:nokey=1", path])
+        sts, output = res.status, res.output
         if sts == 0:
             try:
                 # 这里的视频时长信息再最后一行，最前面的信息进行过滤
@@ -54,6 +59,17 @@ def time_now_get() -> str:
     return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
 
 
+def time_format(ts: float) -> str:
+    """
+    时间戳格式化, 格式与 time_now_get 相同
+    :param ts: 时间戳, <=0 表示没有记录
+    :return: 没有记录时返回空字符串
+    """
+    if ts <= 0:
+        return ""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+
+
 def file_size_format(size: int) -> str:
     """
     将文件大小进行格式化
@@ -88,43 +104,167 @@ def file_md5_get(file_name):
     :param file_name:
     :return:
     """
-    m = hashlib.md5()  # 创建md5对象
-    with open(file_name, 'rb') as fobj:
-        while True:
-            data = fobj.read(4096)
-            if not data:
-                break
-            m.update(data)  # 更新md5对象
+    return file_hash_get(file_name, "md5")
+
 
-    return m.hexdigest()  # 返回md5对象
+def file_hash_get(file_name: str, algorithm: str = "md5", buffer_size: int = hash_buffer_size) -> str:
+    """
+    计算整个文件的哈希
+    优先使用mmap, 由内核按顺序预读, 数据不需要复制到用户空间; 无法mmap时(空文件、特殊文件)使用大缓冲区读取.
+    hashlib 计算时释放GIL, 多个线程可以同时计算不同的文件
+    :param file_name:
+    :param algorithm: hashlib 支持的算法名称
+    :param buffer_size: 每次计算的数据量
+    :return:
+    """
+    m = hashlib.new(algorithm)
+    with open(file_name, 'rb') as fobj:
+        size = os.fstat(fobj.fileno()).st_size
+        try:
+            mm = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else None
+        except (OSError, ValueError):
+            mm = None
+        if mm is not None:
+            with mm:
+                if hasattr(mm, "madvise"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                view = memoryview(mm)
+                try:
+                    for offset in range(0, len(mm), buffer_size):
+                        m.update(view[offset:offset + buffer_size])
+                finally:
+                    view.release()
+        else:
+            buf = bytearray(buffer_size)
+            view = memoryview(buf)
+            while True:
+                n = fobj.readinto(buf)
+                if not n:
+                    break
+                m.update(view[:n])
+    return m.hexdigest()
 
 
-def user_time_get(time_output: str) -> int:
-    """ 获得time命令下程序执行所消耗的时间
-    :param time_output:
+def file_sample_hash_get(file_name: str, block_size: int = hash_block_size, algorithm: str = "md5") -> str:
+    """
+    计算文件的抽样指纹: 文件大小 + 开头、中间、结尾各一块内容的哈希
+    只读取少量数据, 用于缓存的键和去重等场景, 内容完全相同的文件指纹一定相同, 指纹相同的文件不一定相同
+    :param file_name:
+    :param block_size: 每块的大小
+    :param algorithm: hashlib 支持的算法名称
     :return:
     """
-    try:
-        *_, real_time, user_time, sys_time = time_output.split("\n")
-        m, s = user_time.replace("user\t", "").split("m")
-        s = s.replace("s", "")
-        return int(m) * 60 + int(float(s))
-    except Exception as e:
-        return -1
+    m = hashlib.new(algorithm)
+    with open(file_name, 'rb') as fobj:
+        size = os.fstat(fobj.fileno()).st_size
+        m.update(str(size).encode())
+        if size <= block_size * 3:
+            m.update(fobj.read())
+        else:
+            for offset in [0, (size - block_size) // 2, size - block_size]:
+                fobj.seek(offset)
+                m.update(fobj.read(block_size))
+    return m.hexdigest()
+
+
+class FileHashCache:
+    """ 文件哈希缓存
+    以 (设备号, inode, 文件大小, 修改时间, 哈希方式) 为键, 文件未变化时不再重新读取, 同一个文件的多个路径(硬链接)共用结果
+    """
+
+    def __init__(self, max_entries: int = 1000000):
+        """
+        :param max_entries: 最多缓存的数量, 超过时清空
+        """
+        self.__max_entries = max_entries
+        self.__lock = threading.Lock()
+        self.__hashes: Dict[tuple, str] = {}
+
+    @staticmethod
+    def __key_get(st: os.stat_result, mode: str) -> tuple:
+        return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, mode
+
+    def get(self, st: os.stat_result, mode: str) -> Optional[str]:
+        with self.__lock:
+            return self.__hashes.get(self.__key_get(st, mode))
+
+    def put(self, st: os.stat_result, mode: str, value: str) -> None:
+        with self.__lock:
+            if len(self.__hashes) >= self.__max_entries:
+                self.__hashes.clear()
+            self.__hashes[self.__key_get(st, mode)] = value
+
+
+# 进程内共用的文件哈希缓存
+file_hash_cache = FileHashCache()
 
 
-def real_time_get(time_output: str) -> int:
-    """ 获得time命令下程序执行所消耗的时间
-    :param time_output:
+def file_hash_cached_get(file_name: str, mode: str = "sample", stat: Optional[os.stat_result] = None,
+                         cache: Optional[FileHashCache] = file_hash_cache) -> str:
+    """
+    计算文件哈希, 文件未变化时使用缓存结果
+    :param file_name:
+    :param mode: sample 为抽样指纹, 其他为计算整个文件使用的哈希算法, 例如 md5 sha1
+    :param stat: 文件的stat信息, 为None时重新获取
+    :param cache: 哈希缓存, 为None时不使用缓存
     :return:
     """
-    try:
-        *_, real_time, user_time, sys_time = time_output.split("\n")
-        m, s = real_time.replace("real\t", "").split("m")
-        s = s.replace("s", "")
-        return int(m) * 60 + int(float(s))
-    except Exception as e:
-        return -1
+    if stat is None:
+        stat = os.stat(file_name)
+    if cache is not None:
+        value = cache.get(stat, mode)
+        if value is not None:
+            return value
+    if mode == "sample":
+        value = file_sample_hash_get(file_name)
+    else:
+        value = file_hash_get(file_name, mode)
+    if cache is not None:
+        cache.put(stat, mode, value)
+    return value
+
+
+def files_hash_get(file_names: Iterable[str], mode: str = "sample", workers: int = 8,
+                   cache: Optional[FileHashCache] = file_hash_cache) -> Dict[str, Optional[str]]:
+    """
+    多线程计算多个文件的哈希, 适合网络文件系统等单次读取延迟高的场景
+    :param file_names: 文件路径
+    :param mode: 哈希方式, 见 file_hash_cached_get
+    :param workers: 线程数
+    :param cache: 哈希缓存, 为None时不使用缓存
+    :return: 文件路径 -> 哈希, 无法读取的文件为None
+    """
+
+    def hash_get(file_name: str) -> Optional[str]:
+        try:
+            return file_hash_cached_get(file_name, mode, cache=cache)
+        except OSError:
+            return None
+
+    file_names = list(dict.fromkeys(file_names))
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return dict(zip(file_names, pool.map(hash_get, file_names)))
+
+
+def dir_slot_acquire(root: str) -> Tuple[str, int]:
+    """
+    同一目录可能被多个进程使用(同一主机上的多个工作进程), 选择第一个没有被其他进程锁定的目录并加锁;
+    锁在进程退出时自动释放, 之后运行的进程可以继续使用其中的文件
+    :param root: 目录
+    :return: (当前进程使用的目录, 锁文件描述符), 关闭描述符后释放锁
+    """
+    slot_id = 0
+    while True:
+        slot = root if slot_id == 0 else os.path.join(root, f"{dir_slot_prefix}{slot_id}")
+        os.makedirs(slot, exist_ok=True)
+        fd = os.open(os.path.join(slot, dir_slot_lock_name), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            slot_id += 1
+            continue
+        return slot, fd
 
 
 def xml_str_escape(s):
@@ -135,6 +275,14 @@ def xml_str_escape(s):
         .replace(">", "&gt;")
 
 
+# 支持生成视频dna的编码, 以及可能有问题的编码
+far_support_codecs = {"flv", "h264", "hevc", "mpeg1video", "mpeg2video", "mpeg4", "msmpeg4", "rv30", "rv40", "theora",
+                      "vp6f", "vp9", "wmv3"}
+far_warning_codecs = {"ansi", "mjpeg", "png", "qtrle", "svq1"}
+# 解包far文件的临时目录, 优先使用内存文件系统
+far_scratch_root = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
 def far_is_video_far(far_path: str, cache: str = "./far_split.d"):
     """
     判断far文件是否为视频dna
@@ -153,13 +301,9 @@ def far_is_video_far(far_path: str, cache: str = "./far_split.d"):
             line = f.readline()
             return line.strip() == "Support"
     os.makedirs(sub_cache, exist_ok=True)
-    split_cmd = f"/usr/local/VDNAGen/far_split -i {shlex.quote(far_path)} -d {shlex.quote(sub_cache)}"
-    split_cmd = sh2bash(split_cmd)
+    split_cmd = ["/usr/local/VDNAGen/far_split", "-i", far_path, "-d", sub_cache]
     stats_file = os.path.join(sub_cache, "stats")
-    sts, output = getstatusoutput_s(split_cmd)
-    support_codec = {"flv", "h264", "hevc", "mpeg1video", "mpeg2video", "mpeg4", "msmpeg4", "rv30", "rv40", "theora",
-                     "vp6f", "vp9", "wmv3"}
-    waning_codec = {"ansi", "mjpeg", "png", "qtrle", "svq1"}
+    sts = run(split_cmd).status
 
     # 默认情况，判断不支持
     with open(support_log, mode="w", encoding="utf-8") as f:
@@ -177,7 +321,7 @@ def far_is_video_far(far_path: str, cache: str = "./far_split.d"):
             content = stats_data[content_left:content_right]
             content = content.strip()
             with open(support_log, mode="w", encoding="utf-8") as f:
-                flag = "Support" if content in support_codec else "No Support"
+                flag = "Support" if content in far_support_codecs else "No Support"
                 f.write("\n".join([flag, content, far_path]))
 
     shutil.rmtree(sub_cache)
@@ -206,15 +350,13 @@ def far_video_duration_get(far_path: str, cache: str = "./far_split.d"):
         shutil.rmtree(sub_cache)
     os.makedirs(sub_cache, exist_ok=True)
 
-    split_cmd = f"/usr/local/VDNAGen/far_split -i {shlex.quote(far_path)} -d {shlex.quote(sub_cache)}"
-    split_cmd = sh2bash(split_cmd)
+    split_cmd = ["/usr/local/VDNAGen/far_split", "-i", far_path, "-d", sub_cache]
     merge_dna = os.path.join(sub_cache, "merged.dna")
-    status_cmd = f"/usr/local/VDNAGen/dna_status -i {shlex.quote(merge_dna)}"
-    status_cmd = sh2bash(status_cmd)
+    status_cmd = ["/usr/local/VDNAGen/dna_status", "-i", merge_dna]
     duration = -1
-    sts, output = subprocess.getstatusoutput(split_cmd)
+    sts = run(split_cmd).status
     if sts == 0 and os.path.isfile(merge_dna):
-        sts, output = subprocess.getstatusoutput(status_cmd)
+        output = run(status_cmd).output
         output: list = [line for line in output.split("\n") if line.startswith("LENGTH=")]
         if len(output) > 0:
             output = output[0]
@@ -229,6 +371,131 @@ def far_video_duration_get(far_path: str, cache: str = "./far_split.d"):
     return duration
 
 
+def far_stats_codec_get(stats_data: str) -> Optional[str]:
+    """
+    从far的stats中读取视频编码
+    :param stats_data: stats文件内容
+    :return: 没有视频编码时返回None
+    """
+    vc_tag_l = "<VideoCodec>"
+    vc_tag_r = "</VideoCodec>"
+    if vc_tag_l not in stats_data or vc_tag_r not in stats_data:
+        return None
+    content_left = stats_data.index(vc_tag_l) + len(vc_tag_l)
+    content_right = stats_data.index(vc_tag_r)
+    return stats_data[content_left:content_right].strip()
+
+
+def dna_status_length_get(output: str) -> int:
+    """
+    从dna_status的输出中读取dna时长
+    :param output: dna_status的输出
+    :return: 无法解析时返回-1
+    """
+    lines = [line for line in output.split("\n") if line.startswith("LENGTH=")]
+    if len(lines) == 0:
+        return -1
+    try:
+        return int(lines[0].replace("LENGTH=", ""))
+    except ValueError:
+        return -1
+
+
+def far_inspect_cache_get(far_path: str, cache: str) -> Optional[Tuple[str, bool, int]]:
+    """
+    读取 far_is_video_far/far_video_duration_get/far_inspect 留下的检查结果
+    :return: (视频编码, 是否支持, dna时长), 两个结果不全时返回None
+    """
+    support_log = os.path.join(cache, os.path.basename(far_path) + ".sup")
+    duration_log = os.path.join(cache, os.path.basename(far_path) + ".dur")
+    if not os.path.isfile(support_log) or not os.path.isfile(duration_log):
+        return None
+    with open(support_log, mode="r", encoding="utf-8") as f:
+        lines = f.read().split("\n")
+    codec = lines[1].strip() if len(lines) > 1 else ""
+    with open(duration_log, mode="r", encoding="utf-8") as f:
+        data = f.read().strip()
+    try:
+        duration = int(data)
+    except ValueError:
+        duration = -1
+    return codec, lines[0].strip() == "Support", duration
+
+
+def far_inspect_cache_write(far_path: str, cache: str, codec: str, support: bool, duration: int) -> None:
+    """ 保存检查结果, 格式与 far_is_video_far/far_video_duration_get 相同
+    """
+    support_log = os.path.join(cache, os.path.basename(far_path) + ".sup")
+    duration_log = os.path.join(cache, os.path.basename(far_path) + ".dur")
+    with open(support_log, mode="w", encoding="utf-8") as f:
+        f.write("\n".join(["Support" if support else "No Support", codec, far_path]))
+    with open(duration_log, mode="w", encoding="utf-8") as f:
+        f.write(f"{duration}")
+
+
+def _far_split_no_space(output: str, scratch_dir: str, far_path: str) -> bool:
+    """
+    far_split失败是否因为解包目录空间不足
+    :param output: far_split的输出
+    :param scratch_dir: 解包目录, 在删除解包结果之前检查
+    :param far_path: far文件
+    :return: 输出中有空间不足的错误信息, 或者剩余空间小于far文件大小时返回True
+    """
+    if os.strerror(errno.ENOSPC) in output:
+        return True
+    try:
+        st = os.statvfs(scratch_dir)
+        return st.f_bavail * st.f_frsize < os.path.getsize(far_path)
+    except OSError:
+        return False
+
+
+def far_inspect(far_path: str, cache: str = "./far_split.d") -> Tuple[str, bool, int]:
+    """
+    检查far文件: 只解包一次, 同时得到视频编码, 是否支持以及dna时长
+    解包目录优先放在内存文件系统中, 结果保存在cache目录下, 与 far_is_video_far/far_video_duration_get 共用
+    :param far_path: far文件
+    :param cache: 检查结果的保存目录
+    :return: (视频编码, 是否支持, dna时长), 编码未知时为空字符串, 时长未知时为-1
+    """
+    far_path = os.path.abspath(far_path)
+    if not os.path.isfile(far_path):
+        return "", False, -1
+    cache = os.path.abspath(cache)
+    os.makedirs(cache, exist_ok=True)
+    res = far_inspect_cache_get(far_path, cache)
+    if res is not None:
+        return res
+
+    codec, duration = "", -1
+    # 内存文件系统不可写或者空间不足时解包失败, 改为在cache目录下重试; far文件损坏时不重试, 直接使用第一次的结果
+    scratch_roots = [far_scratch_root, cache] if far_scratch_root is not None else [cache]
+    for i, scratch_root in enumerate(scratch_roots):
+        try:
+            sub_cache = tempfile.mkdtemp(prefix=os.path.basename(far_path) + ".far_split.", dir=scratch_root)
+        except OSError:
+            continue
+        try:
+            split_res = run(["/usr/local/VDNAGen/far_split", "-i", far_path, "-d", sub_cache])
+            if split_res.status != 0:
+                if i + 1 < len(scratch_roots) and _far_split_no_space(split_res.output, sub_cache, far_path):
+                    continue
+                break
+            stats_file = os.path.join(sub_cache, "stats")
+            merge_dna = os.path.join(sub_cache, "merged.dna")
+            if os.path.isfile(stats_file):
+                with open(stats_file, mode="r", encoding="utf-8") as f:
+                    codec = far_stats_codec_get(f.read()) or ""
+            if os.path.isfile(merge_dna):
+                duration = dna_status_length_get(run(["/usr/local/VDNAGen/dna_status", "-i", merge_dna]).output)
+            break
+        finally:
+            shutil.rmtree(sub_cache, ignore_errors=True)
+    support = codec in far_support_codecs
+    far_inspect_cache_write(far_path, cache, codec, support, duration)
+    return codec, support, duration
+
+
 def mediawise_stdout_get_json(stdout: str) -> str:
     """
     从stdout从提取json信息
@@ -0,0 +1,228 @@
+# coding: utf-8
+import collections
+import hashlib
+import json
+import os
+import shutil
+import threading
+from typing import List, Optional, Tuple
+
+from common import dir_slot_acquire
+from common import file_size_format
+
+# 临时文件名前缀, 压缩完成后重命名为正式文件名, 启动时清理
+_tmp_prefix = ".tmp-"
+
+
+class _CacheEntry:
+    __slots__ = ["path", "size", "pins", "done"]
+
+    def __init__(self, path: str, size: int, done: bool):
+        self.path = path  # 压缩视频路径
+        self.size = size  # 文件大小, 压缩完成前为预计大小
+        self.pins = 0  # 正在使用的任务数量, 大于0时不能淘汰
+        self.done = done  # 是否压缩完成
+
+
+class CompressCache:
+    """ 压缩视频缓存
+    每个压缩视频保存在 {root}/{键}/ 目录下, 键由源视频文件标识, 内容指纹和ffmpeg命令模板生成, 源视频或压缩参数变化时不会误用;
+    总大小超过配额时按最近使用时间淘汰没有在使用的文件, 全部文件都在使用时不能再预留空间, 压缩任务需要等待;
+    重新运行时目录中已经压缩完成的文件可以直接使用;
+    同一主机上的多个进程(分布式模式的工作进程)使用相同缓存目录时, 每个进程通过flock独占一个子目录,
+    不会删除其他进程正在写入或者使用的文件, 配额按进程分别计算
+    """
+
+    def __init__(self, root: str, quota: int):
+        """
+        :param root: 缓存目录
+        :param quota: 缓存总大小上限(字节)
+        """
+        self.quota = quota
+        self.__lock = threading.Lock()
+        # 按最近使用时间排列, 最早使用的在前面
+        self.__entries: "collections.OrderedDict[str, _CacheEntry]" = collections.OrderedDict()
+        self.used = 0  # 所有文件的大小(包括预留的空间)
+        self.pinned = 0  # 正在使用的文件大小
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        # 每个进程独占一个目录, 见 common.dir_slot_acquire
+        self.root, self.__lock_fd = dir_slot_acquire(root)
+        self.__scan()
+
+    def __scan(self) -> None:
+        """ 读取上次运行留下的压缩视频, 删除没有完成的临时文件
+        """
+        items = []
+        with os.scandir(self.root) as it:
+            for entry in it:
+                # 跳过锁文件和其他进程的子目录
+                if entry.name.startswith(".") or not entry.is_dir(follow_symlinks=False):
+                    continue
+                done_file = None
+                for sub in os.scandir(entry.path):
+                    if sub.is_file(follow_symlinks=False) and not sub.name.startswith(_tmp_prefix) \
+                            and done_file is None:
+                        done_file = sub
+                    else:
+                        self.__path_remove(sub.path)
+                if done_file is None:
+                    self.__path_remove(entry.path)
+                    continue
+                st = done_file.stat()
+                items.append((st.st_mtime, entry.name, done_file.path, st.st_size))
+        for _, key, path, size in sorted(items):
+            self.__entries[key] = _CacheEntry(path, size, True)
+            self.used += size
+
+    @staticmethod
+    def __path_remove(path: str) -> None:
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def key_get(fingerprint: str, cmd_tpl: List[str], source: Tuple[int, int, int, int]) -> str:
+        """
+        生成缓存的键
+        抽样指纹只读取文件的一部分, 不同视频可能得到相同指纹, 修改视频未被抽样的部分后指纹也不变,
+        因此同时使用源文件标识, 只有同一个文件并且没有修改过时才能命中
+        :param fingerprint: 源视频内容指纹
+        :param cmd_tpl: 压缩命令模板, 输出参数变化时键随之变化
+        :param source: 源视频文件标识 (st_dev, st_ino, st_size, st_mtime_ns)
+        :return:
+        """
+        return hashlib.md5(f"{fingerprint}\n{json.dumps(list(source))}\n{json.dumps(cmd_tpl)}".encode("utf-8")) \
+            .hexdigest()
+
+    @staticmethod
+    def tmp_path_get(path: str) -> str:
+        """ 压缩过程中使用的临时文件, 与正式文件后缀相同, ffmpeg据此确定输出格式
+        """
+        return os.path.join(os.path.dirname(path), _tmp_prefix + os.path.basename(path))
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        查询压缩完成的文件, 找到时标记为正在使用, 使用结束后需要调用 release
+        :param key: 缓存的键
+        :return: 压缩视频路径, 不存在时返回None
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None or not entry.done:
+                return None
+            if not os.path.isfile(entry.path):
+                # 文件被外部删除
+                self.__entries.pop(key)
+                self.used -= entry.size
+                return None
+            self.__pin(entry)
+            self.__entries.move_to_end(key)
+            self.hits += 1
+        try:
+            os.utime(entry.path)
+        except OSError:
+            pass
+        return entry.path
+
+    def __pin(self, entry: _CacheEntry) -> None:
+        if entry.pins == 0:
+            self.pinned += entry.size
+        entry.pins += 1
+
+    def busy(self, key: str) -> bool:
+        """ 该键的压缩视频正在生成或者正在使用, 此时不能重新预留, 需要等待 commit/discard/release
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            return entry is not None and entry.pins > 0
+
+    def reserve(self, key: str, name: str, size: int) -> Optional[str]:
+        """
+        为新的压缩视频预留空间, 空间不足时淘汰最早使用的没有在使用的文件
+        预留的文件标记为正在使用, 压缩完成后调用 commit, 压缩失败时调用 discard
+        :param key: 缓存的键
+        :param name: 压缩视频文件名
+        :param size: 预计大小
+        :return: 压缩视频路径, 正在使用的文件占满配额或者该键正在使用(见 busy)时返回None
+        """
+        with self.__lock:
+            old = self.__entries.get(key)
+            if old is not None:
+                if old.pins > 0:
+                    return None
+                self.__entry_remove(key)
+            if self.used + size > self.quota:
+                for old_key in [k for k, e in self.__entries.items() if e.pins == 0]:
+                    self.__entry_remove(old_key)
+                    self.evicted += 1
+                    if self.used + size <= self.quota:
+                        break
+            # 没有正在使用的文件时, 单个文件超过配额也允许写入, 避免所有任务永久等待
+            if self.used + size > self.quota and self.pinned > 0:
+                return None
+            entry_dir = os.path.join(self.root, key)
+            os.makedirs(entry_dir, exist_ok=True)
+            entry = _CacheEntry(os.path.join(entry_dir, name), size, False)
+            self.__entries[key] = entry
+            self.used += size
+            self.__pin(entry)
+            self.misses += 1
+        return entry.path
+
+    def commit(self, key: str) -> int:
+        """
+        压缩完成, 临时文件重命名为正式文件, 使用实际大小替换预计大小
+        :return: 压缩视频大小
+        """
+        with self.__lock:
+            entry = self.__entries[key]
+            os.replace(self.tmp_path_get(entry.path), entry.path)
+            size = os.path.getsize(entry.path)
+            self.used += size - entry.size
+            if entry.pins > 0:
+                self.pinned += size - entry.size
+            entry.size = size
+            entry.done = True
+        return size
+
+    def discard(self, key: str) -> None:
+        """ 删除压缩失败的文件
+        """
+        with self.__lock:
+            if key in self.__entries:
+                self.__entry_remove(key)
+
+    def release(self, key: str) -> None:
+        """ 使用结束, 文件可以被淘汰
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None or entry.pins == 0:
+                return
+            entry.pins -= 1
+            if entry.pins == 0:
+                self.pinned -= entry.size
+
+    def __entry_remove(self, key: str) -> None:
+        entry = self.__entries.pop(key)
+        self.used -= entry.size
+        if entry.pins > 0:
+            self.pinned -= entry.size
+        self.__path_remove(os.path.dirname(entry.path))
+
+    def close(self) -> None:
+        """ 释放目录锁
+        """
+        if self.__lock_fd >= 0:
+            os.close(self.__lock_fd)
+            self.__lock_fd = -1
+
+    def summary(self) -> str:
+        return f"compress cache: {len(self.__entries)} files, {file_size_format(max(self.used, 0))} / " \
+               f"{file_size_format(self.quota)}, {self.hits} hits, {self.misses} misses, {self.evicted} evicted"
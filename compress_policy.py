@@ -0,0 +1,133 @@
+# coding: utf-8
+import json
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+# 分辨率分档: (像素数上限, 名称), 超过最后一档的为 "8k"
+resolution_buckets = [
+    (640 * 480, "480p"),
+    (1280 * 720, "720p"),
+    (1920 * 1080, "1080p"),
+    (2560 * 1440, "1440p"),
+    (3840 * 2160, "2160p"),
+]
+
+
+def resolution_bucket_get(width: int, height: int) -> str:
+    """
+    视频分辨率所在的分档
+    :param width: 视频宽
+    :param height: 视频高
+    :return: 分档名称
+    """
+    pixels = width * height
+    for limit, name in resolution_buckets:
+        if pixels <= limit:
+            return name
+    return "8k"
+
+
+def policy_key_get(codec: Optional[str], width: int, height: int) -> str:
+    """ 决策表的键: 编码/分辨率分档, 编码未知时为 *
+    """
+    return f"{codec or '*'}/{resolution_bucket_get(width, height)}"
+
+
+class CompressPolicy:
+    """ 是否预先压缩视频的决策表
+    按 (视频编码, 分辨率分档) 记录校准结果, 没有对应编码时使用同一分辨率分档下所有编码的汇总结果
+    """
+
+    def __init__(self, entries: Optional[Dict[str, dict]] = None, device: str = "", created: str = ""):
+        """
+        :param entries: 编码/分辨率分档 -> {"compress": 是否压缩, "samples": 样本数, ...}
+        :param device: 校准时使用的压缩设备
+        :param created: 校准时间
+        """
+        self.entries = entries if entries is not None else {}
+        self.device = device
+        self.created = created
+
+    def decide(self, codec: Optional[str], width: int, height: int) -> Optional[bool]:
+        """
+        查询决策表
+        :return: 是否压缩, 决策表中没有对应的分档时返回None
+        """
+        entry = self.entries.get(policy_key_get(codec, width, height))
+        if entry is None:
+            entry = self.entries.get(policy_key_get(None, width, height))
+        return None if entry is None else entry["compress"]
+
+    @staticmethod
+    def load(path: str) -> Optional["CompressPolicy"]:
+        """
+        读取决策表
+        :param path: 决策表路径
+        :return: 文件不存在或者无法解析时返回None
+        """
+        try:
+            with open(path, mode="r", encoding="utf-8") as f:
+                data = json.load(f)
+            return CompressPolicy(data["entries"], data.get("device", ""), data.get("created", ""))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, path: str) -> None:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, mode="w", encoding="utf-8") as f:
+            json.dump({"device": self.device, "created": self.created, "entries": self.entries}, f,
+                      ensure_ascii=False, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    def summary(self) -> List[str]:
+        return [f"{key}: {'compress' if entry['compress'] else 'direct'} "
+                f"(direct {entry['direct']:.3f}, compress {entry['compress_cost']:.3f} sec per media sec, "
+                f"{entry['samples']} samples)"
+                for key, entry in sorted(self.entries.items())]
+
+
+class CompressCalibration:
+    """ 收集校准样本并生成决策表
+    每个样本在同一个视频上分别测量: 直接生成far的耗时, 以及压缩耗时 + 使用压缩结果生成far的耗时,
+    按视频时长归一化后比较, 压缩方式的总耗时明显更短时才压缩
+    """
+
+    def __init__(self, margin: float = 0.1):
+        """
+        :param margin: 压缩方式至少节省的比例, 差别不大时不压缩, 减少中间文件的磁盘读写
+        """
+        self.__margin = margin
+        self.__samples: Dict[str, List[Tuple[float, float]]] = {}
+
+    def add(self, codec: Optional[str], width: int, height: int, duration: float,
+            direct_time: float, compress_time: float, compressed_vdg_time: float) -> None:
+        """
+        添加一个样本
+        :param codec: 视频编码
+        :param width: 视频宽
+        :param height: 视频高
+        :param duration: 视频时长(秒), 未知时按1秒计算
+        :param direct_time: 直接生成far的耗时(秒)
+        :param compress_time: 压缩耗时(秒)
+        :param compressed_vdg_time: 使用压缩结果生成far的耗时(秒)
+        """
+        duration = duration if duration is not None and duration > 0 else 1
+        sample = (direct_time / duration, (compress_time + compressed_vdg_time) / duration)
+        for key in {policy_key_get(codec, width, height), policy_key_get(None, width, height)}:
+            self.__samples.setdefault(key, []).append(sample)
+
+    def policy_get(self, device: str = "") -> CompressPolicy:
+        """ 生成决策表
+        """
+        entries = {}
+        for key, samples in self.__samples.items():
+            direct = sum(s[0] for s in samples) / len(samples)
+            compress_cost = sum(s[1] for s in samples) / len(samples)
+            entries[key] = {
+                "compress": compress_cost < direct * (1 - self.__margin),
+                "samples": len(samples),
+                "direct": direct,
+                "compress_cost": compress_cost,
+            }
+        return CompressPolicy(entries, device, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()))
@@ -0,0 +1,91 @@
+# coding: utf-8
+from typing import Dict, Iterable, List, Tuple
+
+# 视频压缩后的分辨率(与ffmpeg压缩命令中的 -s 400:244 对应)
+compress_pixels = 400 * 244
+
+
+def cost_feature_get(duration: float, width: int, height: int) -> float:
+    """
+    任务耗时模型的特征: 视频时长(秒) x 像素数(百万)
+    :param duration: 视频时长, 未知时(<=0)按1秒计算
+    :param width: 视频宽
+    :param height: 视频高
+    :return:
+    """
+    duration = duration if duration is not None and duration > 0 else 1
+    width = width if width is not None and width > 0 else 1
+    height = height if height is not None and height > 0 else 1
+    return duration * width * height / 1e6
+
+
+class CostModel:
+    """ 任务耗时模型
+    按视频编码分别拟合 耗时 = a + k * 特征, 某个编码的样本不足时使用所有样本拟合的全局系数,
+    没有历史数据时耗时与特征成正比
+    """
+
+    def __init__(self, name: str, min_samples: int = 5):
+        """
+        :param name: 模型名称, 用于日志
+        :param min_samples: 拟合一个编码所需的最少样本数
+        """
+        self.name = name
+        self.__min_samples = min_samples
+        self.__global: Tuple[float, float] = (0.0, 1.0)
+        self.__codecs: Dict[str, Tuple[float, float]] = {}
+        self.__samples = 0
+
+    @staticmethod
+    def __linear_fit(samples: List[Tuple[float, float]]) -> Tuple[float, float]:
+        """
+        最小二乘拟合 y = a + k * x, 系数限制为非负
+        :param samples: [(x, y), ...]
+        :return: (a, k)
+        """
+        n = len(samples)
+        mean_x = sum(x for x, _ in samples) / n
+        mean_y = sum(y for _, y in samples) / n
+        var_x = sum((x - mean_x) ** 2 for x, _ in samples)
+        if var_x <= 0:
+            return 0.0, mean_y / mean_x if mean_x > 0 else 1.0
+        k = sum((x - mean_x) * (y - mean_y) for x, y in samples) / var_x
+        if k <= 0:
+            # 过原点拟合
+            k = sum(x * y for x, y in samples) / sum(x * x for x, _ in samples)
+            return 0.0, max(k, 0.0)
+        return max(mean_y - k * mean_x, 0.0), k
+
+    def fit(self, samples: Iterable[Tuple[str, float, float]]) -> None:
+        """
+        使用历史任务拟合模型
+        :param samples: [(视频编码, 特征, 耗时(秒)), ...], 耗时<=0的样本被忽略
+        :return:
+        """
+        by_codec: Dict[str, List[Tuple[float, float]]] = {}
+        total: List[Tuple[float, float]] = []
+        for codec, x, y in samples:
+            if x is None or y is None or x <= 0 or y <= 0:
+                continue
+            by_codec.setdefault(codec or "", []).append((x, y))
+            total.append((x, y))
+        self.__samples = len(total)
+        if len(total) >= self.__min_samples:
+            self.__global = self.__linear_fit(total)
+        self.__codecs = {codec: self.__linear_fit(items)
+                         for codec, items in by_codec.items() if len(items) >= self.__min_samples}
+
+    def predict(self, codec: str, x: float) -> float:
+        """
+        预测任务耗时
+        :param codec: 视频编码
+        :param x: 特征, 见 cost_feature_get
+        :return: 预测耗时(秒)
+        """
+        a, k = self.__codecs.get(codec or "", self.__global)
+        return a + k * x
+
+    def summary(self) -> str:
+        a, k = self.__global
+        return f"{self.name} cost model: {self.__samples} samples, {len(self.__codecs)} codecs, " \
+               f"global cost = {a:.3f} + {k:.3f} * duration x Mpixel"
@@ -0,0 +1,119 @@
+# coding: utf-8
+import sqlite3
+import threading
+from typing import Iterator, Optional
+
+from common import time_now_get
+
+
+class JobDB:
+    """ far生成任务数据库
+    记录每个任务的状态变化、输入文件指纹(文件大小, 修改时间)以及输出结果,
+    重新运行相同的命令时, 已经完成的任务通过索引直接跳过
+    """
+
+    # 任务表字段, 与 BatchFarCreate.Task 中的同名属性对应
+    job_fields = ["media_path", "far_path", "media_size", "media_mtime_ns", "media_codec", "media_width",
+                  "media_height", "media_duration", "status", "far_size", "compress_time_used", "vdg_time_used"]
+
+    def __init__(self, db_path: str, transitions_limit: int = 1000000, busy_timeout: float = 30.0):
+        """
+        :param db_path: 数据库路径
+        :param transitions_limit: 状态变化记录保留的最大条数, 打开数据库时删除更早的记录
+        :param busy_timeout: 数据库被其他连接锁定时等待的最长时间(秒)
+        """
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(db_path, timeout=busy_timeout, check_same_thread=False)
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        self.__conn.execute("PRAGMA synchronous=NORMAL")
+        self.__conn.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                            "media_path TEXT PRIMARY KEY, "
+                            "far_path TEXT NOT NULL, "
+                            "media_size INTEGER NOT NULL, "
+                            "media_mtime_ns INTEGER NOT NULL, "
+                            "media_codec TEXT, "
+                            "media_width INTEGER, "
+                            "media_height INTEGER, "
+                            "media_duration INTEGER, "
+                            "status INTEGER NOT NULL, "
+                            "far_size INTEGER, "
+                            "compress_time_used REAL, "
+                            "vdg_time_used REAL, "
+                            "updated_at TEXT NOT NULL)")
+        self.__conn.execute("CREATE TABLE IF NOT EXISTS transitions ("
+                            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                            "media_path TEXT NOT NULL, "
+                            "status INTEGER NOT NULL, "
+                            "time TEXT NOT NULL)")
+        self.__conn.execute("CREATE INDEX IF NOT EXISTS transitions_media_path ON transitions (media_path)")
+        self.__conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+        self.__conn.execute("DELETE FROM transitions WHERE id <= (SELECT MAX(id) FROM transitions) - ?",
+                            (max(0, transitions_limit),))
+        self.__conn.commit()
+
+    def job_get(self, media_path: str) -> Optional[dict]:
+        """
+        查询任务记录
+        :param media_path: 视频文件路径
+        :return: 任务记录, 不存在时返回None
+        """
+        with self.__lock:
+            row = self.__conn.execute(f"SELECT {', '.join(self.job_fields)} FROM jobs WHERE media_path = ?",
+                                      (media_path,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(self.job_fields, row))
+
+    def job_done_get(self, media_path: str, media_size: int, media_mtime_ns: int, far_path: str,
+                     done_status: int) -> Optional[dict]:
+        """
+        查询已经完成的任务, 视频文件发生变化或输出路径不同时认为未完成
+        :param media_path: 视频文件路径
+        :param media_size: 视频文件大小
+        :param media_mtime_ns: 视频文件修改时间(纳秒)
+        :param far_path: far文件路径
+        :param done_status: 任务完成的状态值
+        :return: 任务记录, 未完成时返回None
+        """
+        job = self.job_get(media_path)
+        if job is None \
+                or job["status"] != done_status \
+                or job["media_size"] != media_size \
+                or job["media_mtime_ns"] != media_mtime_ns \
+                or job["far_path"] != far_path:
+            return None
+        return job
+
+    def jobs_get(self, status: int, limit: int = -1) -> Iterator[dict]:
+        """
+        遍历指定状态的任务记录, 最近更新的在前面
+        :param status: 任务状态值
+        :param limit: 最多返回的记录数, 小于0时不限制
+        :return:
+        """
+        # INSERT OR REPLACE 更新的记录使用新的rowid, rowid越大越晚更新
+        with self.__lock:
+            rows = self.__conn.execute(f"SELECT {', '.join(self.job_fields)} FROM jobs WHERE status = ? "
+                                       f"ORDER BY rowid DESC LIMIT ?", (status, limit)).fetchall()
+        for row in rows:
+            yield dict(zip(self.job_fields, row))
+
+    def job_update(self, job: dict) -> None:
+        """
+        更新任务记录并记录一次状态变化, 每次更新单独提交, 不长时间占用数据库的写锁
+        :param job: 任务信息, 键为 job_fields
+        :return:
+        """
+        now = time_now_get()
+        values = [job.get(field, None) for field in self.job_fields]
+        with self.__lock:
+            self.__conn.execute(f"INSERT OR REPLACE INTO jobs ({', '.join(self.job_fields)}, updated_at) "
+                                f"VALUES ({', '.join(['?'] * (len(self.job_fields) + 1))})", (*values, now))
+            self.__conn.execute("INSERT INTO transitions (media_path, status, time) VALUES (?, ?, ?)",
+                                (job["media_path"], job["status"], now))
+            self.__conn.commit()
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__conn.commit()
+            self.__conn.close()
@@ -0,0 +1,147 @@
+# coding: utf-8
+import atexit
+import os
+import queue
+import sys
+import threading
+import time
+from typing import List, Optional
+
+# 日志级别
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+level_names = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+
+
+def level_get(name: str) -> int:
+    """
+    日志级别名称转换为级别值
+    :param name: debug info warning error, 不区分大小写
+    :return:
+    """
+    return level_names[name.lower()]
+
+
+class AsyncLogWriter:
+    """ 后台线程批量写日志
+    日志行写入队列后立即返回, 后台线程一次取出队列中的所有日志行写入已经打开的文件,
+    队列为空或者距离上次刷新超过 flush_interval 时刷新文件, 每隔 fsync_interval 同步到磁盘,
+    运行过程中日志文件中始终是完整的行, 可以随时读取
+    """
+
+    __sentinel = object()
+
+    def __init__(self, paths: List[str],
+                 echo: bool = True,
+                 flush_interval: float = 1.0,
+                 fsync_interval: float = 10.0,
+                 batch_size: int = 4096,
+                 max_pending: int = 100000):
+        """
+        :param paths: 日志文件路径, 同一行写入所有文件
+        :param echo: 是否同时输出到stdout
+        :param flush_interval: 刷新间隔(秒)
+        :param fsync_interval: 同步到磁盘的间隔(秒), <=0 时不同步
+        :param batch_size: 每次最多写入的行数
+        :param max_pending: 队列中最多等待写入的行数, 超过时写日志阻塞
+        """
+        self.__paths = paths
+        self.__echo = echo
+        self.__flush_interval = flush_interval
+        self.__fsync_interval = fsync_interval
+        self.__batch_size = max(1, batch_size)
+        self.__queue: "queue.Queue" = queue.Queue(maxsize=max(1, max_pending))
+        self.__lock = threading.Lock()
+        self.__thread: Optional[threading.Thread] = None
+        self.__closed = False
+
+    def __start(self) -> None:
+        with self.__lock:
+            if self.__thread is not None:
+                return
+            self.__thread = threading.Thread(target=self.__run, name="log-writer", daemon=True)
+            self.__thread.start()
+            atexit.register(self.close)
+
+    def write(self, line: str) -> None:
+        """ 写入一行日志, 不包括换行符
+        """
+        if self.__closed:
+            return
+        if self.__thread is None:
+            self.__start()
+        self.__queue.put(line)
+
+    def flush(self) -> None:
+        """ 等待队列中的日志全部写入并同步到磁盘
+        """
+        if self.__thread is None or self.__closed:
+            return
+        done = threading.Event()
+        self.__queue.put(done)
+        done.wait()
+
+    def close(self) -> None:
+        """ 写入剩余日志后关闭文件
+        """
+        with self.__lock:
+            if self.__thread is None or self.__closed:
+                self.__closed = True
+                return
+            self.__closed = True
+        self.__queue.put(self.__sentinel)
+        self.__thread.join()
+
+    def __run(self) -> None:
+        files = []
+        for path in self.__paths:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            files.append(open(path, mode="a", encoding="utf-8"))
+        flush_time = time.monotonic()
+        fsync_time = time.monotonic()
+        stop = False
+        while not stop:
+            try:
+                item = self.__queue.get(timeout=self.__flush_interval)
+            except queue.Empty:
+                item = None
+            lines = []
+            events = []
+            while item is not None:
+                if item is self.__sentinel:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    events.append(item)
+                else:
+                    lines.append(item)
+                if stop or len(lines) >= self.__batch_size:
+                    break
+                try:
+                    item = self.__queue.get_nowait()
+                except queue.Empty:
+                    item = None
+
+            if len(lines) > 0:
+                data = "\n".join(lines) + "\n"
+                for f in files:
+                    f.write(data)
+                if self.__echo:
+                    sys.stdout.write(data)
+            now = time.monotonic()
+            if self.__queue.empty() or stop or len(events) > 0 or now - flush_time >= self.__flush_interval:
+                for f in files:
+                    f.flush()
+                if self.__echo:
+                    sys.stdout.flush()
+                flush_time = now
+            if stop or len(events) > 0 or (0 < self.__fsync_interval <= now - fsync_time):
+                for f in files:
+                    os.fsync(f.fileno())
+                fsync_time = now
+            for event in events:
+                event.set()
+        for f in files:
+            f.close()
@@ -0,0 +1,270 @@
+# coding: utf-8
+import asyncio
+import gzip
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Awaitable, List, Optional, Tuple
+
+from mediawise_client import MediaWiseError
+from mediawise_client import MediaWiseTimeout
+from mediawise_client import check_status_response_parse
+from mediawise_client import check_status_url_get
+from mediawise_client import poll_interval
+from mediawise_client import query_status_processing
+from mediawise_client import request_timeout
+from mediawise_client import status_get
+from mediawise_client import upload_request_get
+from mediawise_client import upload_response_parse
+
+# 同时进行的查询数量上限
+max_inflight = 1000
+# 同时打开的连接数量上限, 查询在轮询间隔中不占用连接
+max_connections = 64
+
+
+class _Connection:
+    __slots__ = ["reader", "writer"]
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class AsyncMediaWiseClient:
+    """ 基于asyncio的MediaWise查询客户端
+    直接使用HTTP/1.1, 连接保持复用, 上传与轮询等待都不占用线程, 一个事件循环中可以同时进行上千个查询;
+    请求与结果格式与 MediaWiseClient 相同. 只能在创建时所在的事件循环中使用
+    """
+
+    def __init__(self, host: str, user: str, passwd: str, connections: int = max_connections,
+                 timeout: float = request_timeout):
+        """
+        :param host: 服务地址, host 或 host:port
+        :param user: 用户名
+        :param passwd: 密码
+        :param connections: 同时打开的连接数量上限
+        :param timeout: 单个http请求的超时时间(秒)
+        """
+        self.host = host
+        name, _, port = host.partition(":")
+        self.__addr: Tuple[str, int] = (name, int(port) if port else 80)
+        self.__user = user
+        self.__passwd = passwd
+        self.__timeout = timeout
+        self.__idle: List[_Connection] = []
+        self.__conn_limit = asyncio.Semaphore(max(1, connections))
+
+    async def __conn_get(self) -> Tuple[_Connection, bool]:
+        """
+        :return: (连接, 是否为复用的连接)
+        """
+        while self.__idle:
+            conn = self.__idle.pop()
+            if not conn.reader.at_eof():
+                return conn, True
+            conn.close()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*self.__addr), self.__timeout)
+        except asyncio.TimeoutError:
+            raise MediaWiseError("connection error: timed out")
+        except OSError as e:
+            raise MediaWiseError(f"connection error: {e}")
+        return _Connection(reader, writer), False
+
+    async def __response_read(self, conn: _Connection) -> Tuple[int, dict, bytes]:
+        """
+        读取一个响应
+        :return: (状态码, 响应头(名称小写), 内容)
+        """
+        status_line = await conn.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed by server")
+        parts = status_line.decode("latin-1").split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise MediaWiseError(f"bad status line: {status_line[:100]}")
+        headers = {"version": parts[0]}
+        while True:
+            line = await conn.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await conn.reader.readline()).split(b";")[0].strip(), 16)
+                if size == 0:
+                    # 跳过trailer
+                    while (await conn.reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(await conn.reader.readexactly(size))
+                await conn.reader.readline()
+            data = b"".join(chunks)
+        elif "content-length" in headers:
+            data = await conn.reader.readexactly(int(headers["content-length"]))
+        else:
+            data = await conn.reader.read()
+            headers["connection"] = "close"
+        return int(parts[1]), headers, data
+
+    async def __request(self, method: str, url: str, body: Optional[bytes] = None,
+                        headers: Optional[dict] = None) -> str:
+        """
+        发送请求并读取完整响应
+        复用的连接可能已经被服务器关闭, 此时使用新连接重试一次
+        :return: 响应内容
+        """
+        lines = [f"{method} {url} HTTP/1.1", f"Host: {self.host}", "Accept-Encoding: gzip",
+                 "Connection: keep-alive"]
+        headers = dict(headers or {})
+        if body is not None and "Content-Length" not in headers:
+            headers["Content-Length"] = str(len(body))
+        lines += [f"{key}: {value}" for key, value in headers.items()]
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode("utf-8")
+
+        async def exchange(conn: _Connection) -> Tuple[int, dict, bytes]:
+            conn.writer.write(head)
+            if body is not None:
+                conn.writer.write(body)
+            await conn.writer.drain()
+            return await self.__response_read(conn)
+
+        async with self.__conn_limit:
+            while True:
+                conn, reused = await self.__conn_get()
+                try:
+                    status, resp_headers, data = await asyncio.wait_for(exchange(conn), self.__timeout)
+                except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError) as e:
+                    conn.close()
+                    if reused:
+                        continue
+                    raise MediaWiseError(f"connection error: {e}")
+                except asyncio.TimeoutError:
+                    conn.close()
+                    raise MediaWiseError("connection error: timed out")
+                except (OSError, ValueError) as e:
+                    conn.close()
+                    raise MediaWiseError(f"connection error: {e}")
+                except BaseException:
+                    # 取消等情况, 连接状态未知, 不再复用
+                    conn.close()
+                    raise
+                if resp_headers.get("connection", "").lower() == "close" or resp_headers["version"] == "HTTP/1.0":
+                    conn.close()
+                else:
+                    self.__idle.append(conn)
+                break
+        if resp_headers.get("content-encoding", "").lower() == "gzip":
+            try:
+                data = gzip.decompress(data)
+            except (OSError, EOFError) as e:
+                raise MediaWiseError(f"bad gzip response: {e}")
+        text = data.decode("utf-8", errors="replace")
+        if status != 200:
+            raise MediaWiseError(f"HTTP {status}: {text[:200]}")
+        return text
+
+    async def upload2server(self, far_path: str) -> str:
+        """
+        上传far文件, 文件在线程池中读取, 不阻塞事件循环
+        :param far_path: far文件
+        :return: 查询任务ID
+        """
+
+        def far_read() -> bytes:
+            with open(far_path, mode="rb") as f:
+                return f.read()
+
+        far_data = await asyncio.get_running_loop().run_in_executor(None, far_read)
+        url, body, headers = upload_request_get(self.__user, self.__passwd, far_path, far_data)
+        return upload_response_parse(await self.__request("POST", url, body, headers))
+
+    async def check_status(self, task_id: str, format: str = "vobile") -> dict:
+        url = check_status_url_get(self.__user, self.__passwd, task_id, format)
+        return check_status_response_parse(await self.__request("GET", url))
+
+    async def fetch_result(self, task_id: str, timeout: float = 3600, interval: float = poll_interval,
+                           format: str = "vobile") -> dict:
+        """
+        轮询直到查询结束, 参数与 MediaWiseClient.fetch_result 相同
+        """
+        deadline = time.time() + timeout if timeout > 0 else None
+        while True:
+            result = await self.check_status(task_id, format)
+            if status_get(result) != query_status_processing:
+                return result
+            if deadline is not None and time.time() + interval > deadline:
+                raise MediaWiseTimeout("Fetch timeout")
+            await asyncio.sleep(interval)
+
+    async def query(self, far_path: str, timeout: float = 3600, format: str = "vobile") -> dict:
+        """
+        上传far文件并等待查询结果
+        :param far_path: far文件
+        :param timeout: 等待查询结果的最长时间(秒), <=0 表示不限制
+        :param format: 结果格式 vobile 或 crr
+        :return: 查询结果
+        """
+        if not os.path.isfile(far_path):
+            raise MediaWiseError("Specified FAR file does not exist")
+        return await self.fetch_result(await self.upload2server(far_path), timeout=timeout, format=format)
+
+    def close(self) -> None:
+        while self.__idle:
+            self.__idle.pop().close()
+
+
+class AsyncMatchEngine:
+    """ 在后台线程中运行事件循环, 其他线程通过 submit 提交协程, 返回 concurrent.futures.Future;
+    同时运行的协程数量受 inflight 限制, 超出的协程在事件循环中等待, 不占用线程
+    """
+
+    def __init__(self, host: str, user: str, passwd: str, inflight: int = max_inflight,
+                 connections: int = max_connections):
+        """
+        :param host: 服务地址
+        :param user: 用户名
+        :param passwd: 密码
+        :param inflight: 同时进行的查询数量上限
+        :param connections: 同时打开的连接数量上限
+        """
+        self.inflight = max(1, inflight)
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = threading.Thread(target=self.__loop.run_forever, name="mediawise-aio", daemon=True)
+        self.__thread.start()
+
+        async def init():
+            # Semaphore 需要在事件循环中创建
+            return AsyncMediaWiseClient(host, user, passwd, connections), asyncio.Semaphore(self.inflight)
+
+        self.client, self.__inflight_limit = asyncio.run_coroutine_threadsafe(init(), self.__loop).result()
+
+    async def __limited(self, coro: Awaitable):
+        async with self.__inflight_limit:
+            return await coro
+
+    def submit(self, coro: Awaitable) -> Future:
+        """
+        提交协程, 可以在任意线程中调用
+        :param coro: 协程, 一般使用 self.client 进行查询
+        :return: 协程结束后得到结果
+        """
+        return asyncio.run_coroutine_threadsafe(self.__limited(coro), self.__loop)
+
+    def close(self) -> None:
+        """ 关闭连接并停止事件循环, 调用前所有提交的协程应该已经结束
+        """
+
+        async def shutdown():
+            self.client.close()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.__loop).result()
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+        self.__thread.join()
+        self.__loop.close()
@@ -0,0 +1,239 @@
+# coding: utf-8
+import gzip
+import http.client
+import json
+import mimetypes
+import os
+import queue
+import time
+import urllib.parse
+from typing import Optional, Tuple
+
+# 与 FarQuerySampleCode.py 相同的服务接口
+_service_path = "/service/mediawise"
+_server_success = "<ErrorCode>0</ErrorCode>"
+_task_id_start = "<TaskID>"
+_task_id_end = "</TaskID>"
+_boundary = "----------ThIs_Is_tHe_bouNdaRY_$"
+
+# 查询状态: 1 有匹配结果, 0 没有匹配结果, 2 正在查询, -1 出错
+query_status_processing = 2
+
+# 单个http请求的超时时间(秒)
+request_timeout = 60
+# 查询结果的轮询间隔(秒)
+poll_interval = 1
+
+
+class MediaWiseError(Exception):
+    """ 上传或者查询失败, 异常信息为服务器返回的内容或者错误原因
+    """
+
+
+class MediaWiseTimeout(MediaWiseError):
+    """ 超时后仍然没有查询结果
+    """
+
+
+def multipart_encode(fields: list, files: list) -> Tuple[str, bytes]:
+    """
+    生成上传far文件的表单
+    :param fields: [(名称, 值)]
+    :param files: [(名称, 文件名, 内容)]
+    :return: (Content-Type, 表单内容)
+    """
+    lines = []
+    for key, value in fields:
+        lines += [f"--{_boundary}".encode(), f'Content-Disposition: form-data; name="{key}"'.encode(), b"",
+                  value.encode("utf-8")]
+    for key, filename, value in files:
+        content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        lines += [f"--{_boundary}".encode(),
+                  f'Content-Disposition: form-data; name="{key}"; filename="{filename}"'.encode("utf-8"),
+                  f"Content-Type: {content_type}".encode(), b"", value]
+    lines += [f"--{_boundary}--".encode(), b""]
+    return f"multipart/form-data; boundary={_boundary}", b"\r\n".join(lines)
+
+
+def upload_request_get(user: str, passwd: str, far_path: str, far_data: bytes) -> Tuple[str, bytes, dict]:
+    """
+    上传请求
+    :return: (url, 请求内容, 请求头)
+    """
+    content_type, body = multipart_encode([("action", "submit"), ("username", user), ("password", passwd)],
+                                          [("dna", far_path, far_data)])
+    return _service_path, body, {"Content-Type": content_type, "Content-Length": str(len(body))}
+
+
+def upload_response_parse(response: str) -> str:
+    """
+    解析上传结果
+    :return: 查询任务ID
+    """
+    if _server_success not in response or _task_id_start not in response or _task_id_end not in response:
+        raise MediaWiseError(f"Upload to server error:{response}")
+    return response[response.find(_task_id_start) + len(_task_id_start): response.find(_task_id_end)]
+
+
+def check_status_url_get(user: str, passwd: str, task_id: str, format: str = "vobile") -> str:
+    params = urllib.parse.urlencode({"action": "check_status", "username": user, "password": passwd,
+                                     "type": "task_id", "format": format, "outputformat": "json", "id": task_id})
+    return f"{_service_path}?{params}"
+
+
+def check_status_response_parse(response: str) -> dict:
+    """
+    解析查询结果
+    :return: 服务器返回的查询结果
+    """
+    try:
+        result = json.loads(response)
+    except ValueError:
+        raise MediaWiseError(f"Failed to fetch result:{response[:200]}")
+    if result.get("Head", {}).get("ErrorCode") == -1:
+        raise MediaWiseError(f"Failed to fetch result:{response[:200]}")
+    return result
+
+
+def status_get(result: dict) -> int:
+    """ 查询结果中第一个query的状态
+    """
+    try:
+        return int(result["Body"]["Query"][0]["QueryLog"]["Status"])
+    except (KeyError, IndexError, TypeError, ValueError):
+        raise MediaWiseError(f"Failed to fetch result:{json.dumps(result, ensure_ascii=False)[:200]}")
+
+
+class MediaWiseClient:
+    """ MediaWise far查询客户端
+    实现 FarQuerySampleCode.py 的 upload2server/fetch_result, 不再为每个far启动python2进程;
+    http连接保持并在线程间复用, 上传和每次轮询都不需要重新建立连接, 响应使用gzip压缩传输;
+    返回解析后的查询结果, 不需要从标准输出中提取json. 线程安全, 多个查询线程共用一个实例
+    """
+
+    def __init__(self, host: str, user: str, passwd: str, pool_size: int = 4,
+                 timeout: float = request_timeout):
+        """
+        :param host: 服务地址, host 或 host:port
+        :param user: 用户名
+        :param passwd: 密码
+        :param pool_size: 保留的空闲连接数量, 一般与查询线程数相同
+        :param timeout: 单个http请求的超时时间(秒)
+        """
+        self.host = host
+        self.__user = user
+        self.__passwd = passwd
+        self.__timeout = timeout
+        self.__pool: "queue.LifoQueue[http.client.HTTPConnection]" = queue.LifoQueue(maxsize=max(1, pool_size))
+
+    def __conn_get(self) -> Tuple[http.client.HTTPConnection, bool]:
+        """
+        :return: (连接, 是否为复用的连接)
+        """
+        try:
+            return self.__pool.get_nowait(), True
+        except queue.Empty:
+            return http.client.HTTPConnection(self.host, timeout=self.__timeout), False
+
+    def __conn_put(self, conn: http.client.HTTPConnection) -> None:
+        try:
+            self.__pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def __request(self, method: str, url: str, body: Optional[bytes] = None,
+                  headers: Optional[dict] = None) -> str:
+        """
+        发送请求并读取完整响应
+        复用的连接可能已经被服务器关闭, 此时使用新连接重试一次
+        :return: 响应内容
+        """
+        headers = dict(headers or {})
+        headers["Accept-Encoding"] = "gzip"
+        while True:
+            conn, reused = self.__conn_get()
+            try:
+                conn.request(method, url, body=body, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionResetError,
+                    BrokenPipeError) as e:
+                conn.close()
+                if reused:
+                    continue
+                raise MediaWiseError(f"connection error: {e}")
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                raise MediaWiseError(f"connection error: {e}")
+            if resp.will_close:
+                conn.close()
+            else:
+                self.__conn_put(conn)
+            if resp.getheader("Content-Encoding", "").lower() == "gzip":
+                try:
+                    data = gzip.decompress(data)
+                except (OSError, EOFError) as e:
+                    raise MediaWiseError(f"bad gzip response: {e}")
+            text = data.decode("utf-8", errors="replace")
+            if resp.status != 200:
+                raise MediaWiseError(f"HTTP {resp.status} {resp.reason}: {text[:200]}")
+            return text
+
+    def upload2server(self, far_path: str) -> str:
+        """
+        上传far文件
+        :param far_path: far文件
+        :return: 查询任务ID
+        """
+        with open(far_path, mode="rb") as f:
+            far_data = f.read()
+        url, body, headers = upload_request_get(self.__user, self.__passwd, far_path, far_data)
+        return upload_response_parse(self.__request("POST", url, body, headers))
+
+    def check_status(self, task_id: str, format: str = "vobile") -> dict:
+        """
+        查询一次任务状态
+        :param task_id: 查询任务ID
+        :param format: 结果格式 vobile 或 crr
+        :return: 服务器返回的查询结果
+        """
+        url = check_status_url_get(self.__user, self.__passwd, task_id, format)
+        return check_status_response_parse(self.__request("GET", url))
+
+    def fetch_result(self, task_id: str, timeout: float = 3600, interval: float = poll_interval,
+                     format: str = "vobile") -> dict:
+        """
+        轮询直到查询结束
+        :param task_id: 查询任务ID
+        :param timeout: 等待查询结果的最长时间(秒), <=0 表示不限制
+        :param interval: 轮询间隔(秒)
+        :param format: 结果格式 vobile 或 crr
+        :return: 查询结果, 格式与 FarQuerySampleCode.py 输出的json相同
+        """
+        deadline = time.time() + timeout if timeout > 0 else None
+        while True:
+            result = self.check_status(task_id, format)
+            if status_get(result) != query_status_processing:
+                return result
+            if deadline is not None and time.time() + interval > deadline:
+                raise MediaWiseTimeout("Fetch timeout")
+            time.sleep(interval)
+
+    def query(self, far_path: str, timeout: float = 3600, format: str = "vobile") -> dict:
+        """
+        上传far文件并等待查询结果
+        :param far_path: far文件
+        :param timeout: 等待查询结果的最长时间(秒), <=0 表示不限制
+        :param format: 结果格式 vobile 或 crr
+        :return: 查询结果
+        """
+        if not os.path.isfile(far_path):
+            raise MediaWiseError("Specified FAR file does not exist")
+        return self.fetch_result(self.upload2server(far_path), timeout=timeout, format=format)
+
+    def close(self) -> None:
+        while True:
+            try:
+                self.__pool.get_nowait().close()
+            except queue.Empty:
+                return
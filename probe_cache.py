@@ -0,0 +1,74 @@
+# coding: utf-8
+import json
+import sqlite3
+import threading
+from typing import Optional, Tuple
+
+
+class ProbeCache:
+    """ 视频信息(ffprobe)解析结果缓存
+    以 (文件路径, 文件大小, 修改时间) 为键保存在sqlite数据库中, 文件未变化时不再重新解析
+    """
+
+    def __init__(self, db_path: str, commit_interval: int = 500, busy_timeout: float = 30.0):
+        """
+        :param db_path: 缓存数据库路径
+        :param commit_interval: 每写入多少条记录提交一次
+        :param busy_timeout: 数据库被其他连接锁定时等待的最长时间(秒)
+        """
+        self.__db_path = db_path
+        self.__commit_interval = max(1, commit_interval)
+        self.__uncommitted = 0
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(db_path, timeout=busy_timeout, check_same_thread=False)
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        self.__conn.execute("PRAGMA synchronous=NORMAL")
+        self.__conn.execute("CREATE TABLE IF NOT EXISTS probe ("
+                            "path TEXT PRIMARY KEY, "
+                            "size INTEGER NOT NULL, "
+                            "mtime_ns INTEGER NOT NULL, "
+                            "status INTEGER NOT NULL, "
+                            "data TEXT NOT NULL)")
+        self.__conn.commit()
+
+    def get(self, path: str, size: int, mtime_ns: int) -> Optional[Tuple[int, dict]]:
+        """
+        查询缓存
+        :param path: 视频文件路径
+        :param size: 文件大小
+        :param mtime_ns: 文件修改时间(纳秒)
+        :return: (ffprobe退出状态, 解析结果), 文件发生变化或没有缓存时返回None
+        """
+        with self.__lock:
+            row = self.__conn.execute("SELECT size, mtime_ns, status, data FROM probe WHERE path = ?",
+                                      (path,)).fetchone()
+        if row is None or row[0] != size or row[1] != mtime_ns:
+            return None
+        try:
+            return row[2], json.loads(row[3])
+        except ValueError:
+            return None
+
+    def put(self, path: str, size: int, mtime_ns: int, status: int, data: dict) -> None:
+        """
+        写入缓存
+        :param path: 视频文件路径
+        :param size: 文件大小
+        :param mtime_ns: 文件修改时间(纳秒)
+        :param status: ffprobe退出状态
+        :param data: 解析结果
+        :return:
+        """
+        data = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        with self.__lock:
+            self.__conn.execute("INSERT OR REPLACE INTO probe (path, size, mtime_ns, status, data) "
+                                "VALUES (?, ?, ?, ?, ?)", (path, size, mtime_ns, status, data))
+            self.__uncommitted += 1
+            if self.__uncommitted >= self.__commit_interval:
+                self.__conn.commit()
+                self.__uncommitted = 0
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__conn.commit()
+            self.__conn.close()
@@ -0,0 +1,256 @@
+# coding: utf-8
+import csv
+import json
+import os
+import time
+from abc import ABC
+from abc import abstractmethod
+from typing import Iterator, List, Optional
+
+# xlsx 单个sheet的最大行数(包括表头)
+xlsx_max_rows = 1048576
+# 单个xlsx文件中的最大sheet数量, 超过时写入新的文件
+xlsx_max_sheets = 8
+
+report_formats = ["csv", "jsonl", "parquet"]
+
+
+class ReportSink(ABC):
+    """ 报告输出
+    任务结束时逐行追加写入, 不在内存中保存整个报告, 程序异常退出时已经写入的行不会丢失;
+    子类实现 _write, 没有实现时创建对象就会失败
+    """
+
+    def __init__(self, path: str, columns: List[str], flush_interval: float = 5.0):
+        """
+        :param path: 报告文件路径
+        :param columns: 列名
+        :param flush_interval: 刷新间隔(秒)
+        """
+        self.path = path
+        self.columns = columns
+        self.__flush_interval = flush_interval
+        self.__flush_time = time.monotonic()
+
+    def write(self, row: dict) -> None:
+        self._write(row)
+        now = time.monotonic()
+        if now - self.__flush_time >= self.__flush_interval:
+            self.flush()
+            self.__flush_time = now
+
+    @abstractmethod
+    def _write(self, row: dict) -> None:
+        """ 写入一行
+        """
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class CsvReportSink(ReportSink):
+    def __init__(self, path: str, columns: List[str], flush_interval: float = 5.0):
+        super().__init__(path, columns, flush_interval)
+        # utf-8-sig 使Excel可以直接打开中文内容
+        self.__file = open(path, mode="w", encoding="utf-8-sig", newline="")
+        self.__writer = csv.DictWriter(self.__file, fieldnames=columns, extrasaction="ignore")
+        self.__writer.writeheader()
+
+    def _write(self, row: dict) -> None:
+        self.__writer.writerow(row)
+
+    def flush(self) -> None:
+        self.__file.flush()
+
+    def close(self) -> None:
+        self.__file.close()
+
+
+class JsonlReportSink(ReportSink):
+    def __init__(self, path: str, columns: List[str], flush_interval: float = 5.0):
+        super().__init__(path, columns, flush_interval)
+        self.__file = open(path, mode="w", encoding="utf-8")
+
+    def _write(self, row: dict) -> None:
+        self.__file.write(json.dumps({column: row.get(column, "") for column in self.columns}, ensure_ascii=False))
+        self.__file.write("\n")
+
+    def flush(self) -> None:
+        self.__file.flush()
+
+    def close(self) -> None:
+        self.__file.close()
+
+
+class ParquetReportSink(ReportSink):
+    """ 列式存储报告, 需要安装 pyarrow
+    所有列按字符串保存, 空值为null; 每 row_group_size 行写入一个row group
+    """
+
+    def __init__(self, path: str, columns: List[str], flush_interval: float = 5.0, row_group_size: int = 65536):
+        super().__init__(path, columns, flush_interval)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("parquet report requires pyarrow, pip install pyarrow")
+        self.__pa = pyarrow
+        self.__schema = pyarrow.schema([(column, pyarrow.string()) for column in columns])
+        self.__writer = pyarrow.parquet.ParquetWriter(path, self.__schema)
+        self.__row_group_size = max(1, row_group_size)
+        self.__rows: List[dict] = []
+
+    def _write(self, row: dict) -> None:
+        self.__rows.append(row)
+        if len(self.__rows) >= self.__row_group_size:
+            self.__row_group_write()
+
+    def __row_group_write(self) -> None:
+        if len(self.__rows) == 0:
+            return
+        data = {}
+        for column in self.columns:
+            values = [row.get(column, "") for row in self.__rows]
+            data[column] = [None if value is None or value == "" else str(value) for value in values]
+        self.__writer.write_table(self.__pa.table(data, schema=self.__schema))
+        self.__rows = []
+
+    def flush(self) -> None:
+        # parquet 只能按row group写入, 行数不足时不刷新, 避免产生大量很小的row group
+        pass
+
+    def close(self) -> None:
+        self.__row_group_write()
+        self.__writer.close()
+
+
+report_sink_classes = {
+    "csv": CsvReportSink,
+    "jsonl": JsonlReportSink,
+    "parquet": ParquetReportSink,
+}
+
+
+class ReportWriter:
+    """ 同时写入多个报告输出
+    """
+
+    def __init__(self, path_prefix: str, columns: List[str], formats: List[str]):
+        """
+        :param path_prefix: 报告文件路径前缀, 文件路径为 {path_prefix}.{格式}
+        :param columns: 列名
+        :param formats: 报告格式, 见 report_formats
+        """
+        self.columns = columns
+        self.sinks: List[ReportSink] = []
+        for fmt in formats:
+            self.sinks.append(report_sink_classes[fmt](f"{path_prefix}.{fmt}", columns))
+        self.rows = 0
+
+    def write(self, row: dict) -> None:
+        for sink in self.sinks:
+            sink.write(row)
+        self.rows += 1
+
+    def close(self) -> None:
+        for sink in self.sinks:
+            sink.close()
+
+    def paths(self) -> List[str]:
+        return [sink.path for sink in self.sinks]
+
+    def path_get(self, fmt: str) -> Optional[str]:
+        for sink in self.sinks:
+            if sink.path.endswith(f".{fmt}"):
+                return sink.path
+        return None
+
+
+def _cell_value(value: str):
+    """ CSV中的数字转换为数字, 其他内容保持不变
+    """
+    if value == "":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def _report_rows_read(path: str, columns: Optional[List[str]] = None) -> Iterator[list]:
+    """
+    逐行读取csv或jsonl报告
+    :param path: 报告路径
+    :param columns: jsonl报告的列名, 为None时使用第一行的键
+    :return: 第一行为列名, 之后为每行的值
+    """
+    if path.endswith(".jsonl"):
+        if columns is not None:
+            yield columns
+        with open(path, mode="r", encoding="utf-8") as f:
+            for line in f:
+                row = json.loads(line)
+                if columns is None:
+                    columns = list(row)
+                    yield columns
+                yield [None if row.get(column, "") == "" else row.get(column) for column in columns]
+    else:
+        with open(path, mode="r", encoding="utf-8-sig", newline="") as f:
+            reader = csv.reader(f)
+            columns = next(reader, None)
+            if columns is None:
+                return
+            yield columns
+            for row in reader:
+                yield [_cell_value(value) for value in row]
+
+
+def report_xlsx_export(report_path: str, xlsx_path: str, columns: Optional[List[str]] = None,
+                       max_rows: int = xlsx_max_rows, max_sheets: int = xlsx_max_sheets) -> List[str]:
+    """
+    把csv或jsonl报告转换为xlsx, 使用openpyxl的write_only模式, 内存占用与报告行数无关
+    超过单个sheet的行数时写入新的sheet, 超过 max_sheets 时写入新的文件 {xlsx_path去掉后缀}-{序号}.xlsx
+    :param report_path: csv或jsonl报告路径
+    :param xlsx_path: xlsx文件路径
+    :param columns: jsonl报告的列名, 为None时使用第一行的键
+    :param max_rows: 单个sheet的最大行数(包括表头)
+    :param max_sheets: 单个xlsx文件中的最大sheet数量
+    :return: 生成的xlsx文件路径
+    """
+    from openpyxl import Workbook
+
+    rows = _report_rows_read(report_path, columns)
+    columns = next(rows, None)
+    if columns is None:
+        return []
+    name, ext = os.path.splitext(xlsx_path)
+    paths = []
+    workbook = None
+    sheet = None
+    sheet_rows = max_rows
+    for row in rows:
+        if sheet_rows >= max_rows:
+            if workbook is None or len(workbook.worksheets) >= max_sheets:
+                if workbook is not None:
+                    workbook.save(paths[-1])
+                workbook = Workbook(write_only=True)
+                paths.append(xlsx_path if len(paths) == 0 else f"{name}-{len(paths) + 1}{ext}")
+            sheet = workbook.create_sheet(f"report{len(workbook.worksheets) + 1}")
+            sheet.append(columns)
+            sheet_rows = 1
+        sheet.append(row)
+        sheet_rows += 1
+    if workbook is None:
+        # 没有数据时只写入表头
+        workbook = Workbook(write_only=True)
+        workbook.create_sheet("report1").append(columns)
+        paths.append(xlsx_path)
+    workbook.save(paths[-1])
+    return paths
@@ -0,0 +1,217 @@
+# coding: utf-8
+import os
+import select
+import shlex
+import signal
+import subprocess
+import time
+from typing import IO, List, NamedTuple, Optional, Sequence
+
+# 默认保留的输出大小, 超出部分只保留开头和结尾
+output_limit = 4 * 1024 * 1024
+# 超时后发送SIGTERM, 等待该时间(秒)后进程组仍未退出则发送SIGKILL
+kill_grace = 5.0
+
+
+class ProcUsage(NamedTuple):
+    """ 子进程资源使用情况, 由 wait4 在回收子进程时获得
+    包含子进程以及子进程等待过的所有子进程
+    注意: linux在exec时保留fork出的进程的内存峰值, 因此 max_rss 不低于启动子进程时父进程的常驻内存
+    """
+    wall_time: float = -1.0  # 运行时间(秒)
+    user_time: float = -1.0  # 用户态CPU时间(秒)
+    sys_time: float = -1.0  # 内核态CPU时间(秒)
+    max_rss: int = -1  # 内存峰值(字节)
+    read_bytes: int = -1  # 磁盘读取量(字节), 不包括从页缓存中读取的部分
+    write_bytes: int = -1  # 磁盘写入量(字节)
+
+
+class RunResult(NamedTuple):
+    """ 子进程运行结果
+    """
+    cmd: str  # 可以直接在shell中执行的命令, 只用于日志
+    status: int  # 退出状态, 被信号终止时为负的信号值, 无法启动时为127(命令不存在)或-1
+    output: str  # stdout和stderr的合并输出, 超出 output_limit 时中间部分被省略
+    usage: ProcUsage
+    timed_out: bool = False  # 是否因为超时被终止
+
+
+class OutputBuffer:
+    """ 有上限的输出缓存
+    保留输出开头和结尾各一半, 中间部分丢弃并记录丢弃的字节数
+    """
+
+    def __init__(self, limit: int = output_limit):
+        self.__head_limit = limit // 2
+        self.__tail_limit = limit - self.__head_limit
+        self.__head = bytearray()
+        self.__tail = bytearray()
+        self.__dropped = 0
+
+    def write(self, data: bytes) -> None:
+        if len(self.__head) < self.__head_limit:
+            n = self.__head_limit - len(self.__head)
+            self.__head += data[:n]
+            data = data[n:]
+        if len(data) == 0:
+            return
+        self.__tail += data
+        if len(self.__tail) > self.__tail_limit:
+            n = len(self.__tail) - self.__tail_limit
+            del self.__tail[:n]
+            self.__dropped += n
+
+    def text(self) -> str:
+        head = self.__head.decode("utf-8", errors="replace")
+        tail = self.__tail.decode("utf-8", errors="replace")
+        if self.__dropped > 0:
+            return f"{head}\n... {self.__dropped} bytes omitted ...\n{tail}"
+        return head + tail
+
+
+class Process:
+    """ 直接执行argv的子进程, 不经过shell
+    stdout和stderr合并后写入有上限的缓存, 同时可以完整写入日志文件, 结束时通过 wait4 获得资源使用情况
+    子进程在新的会话(进程组)中运行, 超时后终止整个进程组, 包括子进程启动的其他进程
+    """
+
+    def __init__(self, argv: Sequence[str],
+                 output_path: Optional[str] = None,
+                 limit: int = output_limit,
+                 cwd: Optional[str] = None,
+                 env: Optional[dict] = None):
+        """
+        :param argv: 命令及参数
+        :param output_path: 完整输出追加写入的文件, 为None时不写入
+        :param limit: 内存中保留的输出大小
+        :param cwd: 工作目录
+        :param env: 环境变量, 为None时继承当前进程
+        """
+        self.argv: List[str] = [str(arg) for arg in argv]
+        self.cmd = shlex.join(self.argv)
+        self.__output = OutputBuffer(limit)
+        self.__output_path = output_path
+        self.__time_begin = time.monotonic()
+        self.__proc: Optional[subprocess.Popen] = None
+        self.__result: Optional[RunResult] = None
+        try:
+            self.__proc = subprocess.Popen(self.argv, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                           stderr=subprocess.STDOUT, cwd=cwd, env=env, start_new_session=True)
+        except FileNotFoundError as e:
+            self.__result = RunResult(self.cmd, 127, str(e), ProcUsage())
+        except Exception as e:
+            self.__result = RunResult(self.cmd, -1, str(e), ProcUsage())
+
+    @property
+    def pid(self) -> int:
+        return -1 if self.__proc is None else self.__proc.pid
+
+    def __output_read(self, deadline: Optional[float]) -> bool:
+        """
+        读取子进程输出直到子进程关闭输出
+        :param deadline: 截止时间(time.monotonic), 为None时不限制
+        :return: 是否在截止时间之前读取完毕
+        """
+        log: Optional[IO[bytes]] = None
+        if self.__output_path is not None:
+            log = open(self.__output_path, mode="ab")
+        try:
+            fd = self.__proc.stdout.fileno()
+            while True:
+                if deadline is not None:
+                    remain = deadline - time.monotonic()
+                    if remain <= 0:
+                        return False
+                    readable, _, _ = select.select([fd], [], [], remain)
+                    if len(readable) == 0:
+                        continue
+                data = os.read(fd, 65536)
+                if not data:
+                    return True
+                self.__output.write(data)
+                if log is not None:
+                    log.write(data)
+        finally:
+            self.__proc.stdout.close()
+            if log is not None:
+                log.close()
+
+    def __exit_wait(self, deadline: Optional[float]) -> bool:
+        """
+        等待子进程退出, 但不回收, 保证进程组ID在终止进程组之前不会被复用
+        :param deadline: 截止时间(time.monotonic), 为None时一直等待
+        :return: 子进程是否已经退出
+        """
+        if deadline is None:
+            return True
+        while True:
+            try:
+                if os.waitid(os.P_PID, self.__proc.pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None:
+                    return True
+            except InterruptedError:
+                continue
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+
+    def __reap(self):
+        """
+        回收子进程
+        :return: (wait状态, rusage)
+        """
+        while True:
+            try:
+                _, sts, rusage = os.wait4(self.__proc.pid, 0)
+                return sts, rusage
+            except InterruptedError:
+                continue
+
+    def __group_kill(self, sig: int) -> None:
+        try:
+            os.killpg(self.__proc.pid, sig)
+        except OSError:
+            # 进程组已经全部退出
+            pass
+
+    def wait(self, timeout: Optional[float] = None) -> RunResult:
+        """
+        等待子进程结束, 超时后终止子进程所在的进程组
+        :param timeout: 超时时间(秒), 为None或者<=0时不限制
+        :return: 运行结果
+        """
+        if self.__result is not None:
+            return self.__result
+        deadline = None
+        if timeout is not None and timeout > 0:
+            deadline = self.__time_begin + timeout
+        timed_out = not self.__output_read(deadline)
+        if not timed_out:
+            timed_out = not self.__exit_wait(deadline)
+        if timed_out:
+            self.__group_kill(signal.SIGTERM)
+            self.__exit_wait(time.monotonic() + kill_grace)
+            # 子进程退出后, 它启动的其他进程可能仍在运行
+            self.__group_kill(signal.SIGKILL)
+        sts, rusage = self.__reap()
+        # 子进程已经回收, 避免 Popen 再次等待
+        self.__proc.returncode = os.waitstatus_to_exitcode(sts)
+        usage = ProcUsage(wall_time=round(time.monotonic() - self.__time_begin, 3),
+                          user_time=round(rusage.ru_utime, 3),
+                          sys_time=round(rusage.ru_stime, 3),
+                          max_rss=rusage.ru_maxrss * 1024,  # linux下单位为KB
+                          read_bytes=rusage.ru_inblock * 512,  # 单位为512字节的块
+                          write_bytes=rusage.ru_oublock * 512)
+        output = self.__output.text()
+        if output.endswith("\n"):
+            output = output[:-1]
+        self.__result = RunResult(self.cmd, self.__proc.returncode, output, usage, timed_out)
+        return self.__result
+
+
+def run(argv: Sequence[str], output_path: Optional[str] = None, limit: int = output_limit,
+        cwd: Optional[str] = None, env: Optional[dict] = None, timeout: Optional[float] = None) -> RunResult:
+    """
+    执行命令并等待结束, 参数见 Process 以及 Process.wait
+    :return: 运行结果
+    """
+    return Process(argv, output_path=output_path, limit=limit, cwd=cwd, env=env).wait(timeout)
@@ -0,0 +1,137 @@
+# coding: utf-8
+import re
+from typing import Iterable, List, Optional, Tuple
+
+# 设备描述: cpu:线程数 或 gpu显卡序号:线程数, 例如 cpu:2 gpu0:4
+_device_spec_re = re.compile(r"^(cpu|gpu(\d+))(?::(\d+))?$")
+
+
+def device_spec_parse(spec: str) -> Tuple[int, int]:
+    """
+    解析设备描述
+    :param spec: cpu:2 gpu0:4, 省略线程数时为1
+    :return: (gpu_id, 线程数), gpu_id 为-1表示CPU
+    """
+    m = _device_spec_re.match(spec.strip().lower())
+    if m is None:
+        raise ValueError(f"invalid device: {spec}, expect cpu:N or gpuID:N")
+    gpu_id = -1 if m.group(2) is None else int(m.group(2))
+    slots = 1 if m.group(3) is None else int(m.group(3))
+    if slots <= 0:
+        raise ValueError(f"invalid device: {spec}, slots must > 0")
+    return gpu_id, slots
+
+
+def device_name_get(gpu_id: int) -> str:
+    if gpu_id == -1:
+        return "CPU"
+    if gpu_id >= 0:
+        return f"GPU:{gpu_id}"
+    return "Error Device"
+
+
+class DeviceSlots:
+    """ 单个设备的线程以及运行统计
+    """
+
+    def __init__(self, gpu_id: int, slots: int):
+        self.gpu_id = gpu_id
+        self.name = device_name_get(gpu_id)
+        self.slots = slots
+        self.busy = 0  # 正在运行的任务数量
+        self.tasks = 0  # 结束的任务数量
+        self.errors = 0  # 失败的任务数量
+        self.busy_time = 0.0  # 成功任务的耗时之和(秒)
+        self.media_time = 0.0  # 成功处理的视频时长之和(秒)
+
+    @property
+    def free(self) -> int:
+        return self.slots - self.busy
+
+    @property
+    def speed(self) -> float:
+        """ 单个线程每秒处理的视频时长, 没有统计数据时为0
+        """
+        return self.media_time / self.busy_time if self.busy_time > 0 else 0.0
+
+    def summary(self) -> str:
+        return f"{self.name} x{self.slots}: {self.tasks} tasks, {self.errors} errors, " \
+               f"busy {self.busy_time:.1f} sec, media {self.media_time:.1f} sec, speed {self.speed:.2f}x/slot"
+
+
+class SlotAllocator:
+    """ 按设备线程数加权的公平分配
+    每次分配给 (正在运行的任务数 + 1) / 线程数 最小的设备, 各设备的负载比例保持一致;
+    负载相同时优先分配给单线程处理速度快的设备. 总并发数受 limit 限制时, 任务仍然按比例分散到各个设备,
+    不会集中在第一个设备上
+    """
+
+    def __init__(self, devices: Iterable[Tuple[int, int]]):
+        """
+        :param devices: [(gpu_id, 线程数)], gpu_id 为-1表示CPU, 同一个设备出现多次时线程数合并
+        """
+        self.devices: List[DeviceSlots] = []
+        for gpu_id, slots in devices:
+            if slots <= 0:
+                continue
+            device = self.device_get(gpu_id)
+            if device is None:
+                self.devices.append(DeviceSlots(gpu_id, slots))
+            else:
+                device.slots += slots
+        self.slots = sum(device.slots for device in self.devices)
+        self.busy = 0
+
+    def device_get(self, gpu_id: int) -> Optional[DeviceSlots]:
+        for device in self.devices:
+            if device.gpu_id == gpu_id:
+                return device
+        return None
+
+    def acquire(self) -> int:
+        """
+        申请一个线程
+        :return: 设备索引, 没有空闲线程时返回-1
+        """
+        best = -1
+        best_key = None
+        for idx, device in enumerate(self.devices):
+            if device.free <= 0:
+                continue
+            key = ((device.busy + 1) / device.slots, -device.speed)
+            if best_key is None or key < best_key:
+                best, best_key = idx, key
+        if best >= 0:
+            self.devices[best].busy += 1
+            self.busy += 1
+        return best
+
+    def release(self, idx: int, time_used: float = 0.0, media_time: float = 0.0, ok: bool = True) -> None:
+        """
+        归还线程并记录任务统计
+        :param idx: acquire 返回的设备索引
+        :param time_used: 任务耗时(秒)
+        :param media_time: 任务处理的视频时长(秒), 用于计算处理速度
+        :param ok: 任务是否成功, 失败的任务不计入处理速度
+        """
+        device = self.devices[idx]
+        device.busy -= 1
+        self.busy -= 1
+        device.tasks += 1
+        if not ok:
+            device.errors += 1
+            return
+        if time_used > 0 and media_time > 0:
+            device.busy_time += time_used
+            device.media_time += media_time
+
+    def cancel(self, idx: int) -> None:
+        """ 归还没有使用的线程, 不记录统计
+        """
+        self.devices[idx].busy -= 1
+        self.busy -= 1
+
+    def summary(self) -> List[str]:
+        """ 各设备的运行统计, 用于日志
+        """
+        return [device.summary() for device in self.devices]
@@ -0,0 +1,199 @@
+# coding: utf-8
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+
+class WalkEntry(NamedTuple):
+    """ 遍历得到的文件
+    """
+    path: str  # 文件路径
+    rel_dir: str  # 文件所在文件夹相对遍历根目录的路径, 根目录下的文件为 ""
+    name: str  # 文件名
+    stat: os.stat_result  # 文件stat信息, 遍历时已经获取, 使用方不需要再次stat
+
+
+class WalkFilter:
+    """ 文件过滤条件
+    """
+
+    def __init__(self, include_exts: Optional[Iterable[str]] = None,
+                 exclude_exts: Optional[Iterable[str]] = None,
+                 min_size: int = 0,
+                 max_size: Optional[int] = None):
+        """
+        :param include_exts: 只保留这些后缀的文件, 例如 [".mp4", ".far"], 不区分大小写, 为None时不限制
+        :param exclude_exts: 排除这些后缀的文件, 不区分大小写
+        :param min_size: 最小文件大小(字节)
+        :param max_size: 最大文件大小(字节), 为None时不限制
+        """
+        self.include_exts = None if include_exts is None else {self.__ext_norm(ext) for ext in include_exts}
+        self.exclude_exts = set() if exclude_exts is None else {self.__ext_norm(ext) for ext in exclude_exts}
+        self.min_size = min_size
+        self.max_size = max_size
+
+    @staticmethod
+    def __ext_norm(ext: str) -> str:
+        ext = ext.strip().lower()
+        return ext if ext.startswith(".") else "." + ext
+
+    def name_match(self, name: str) -> bool:
+        """ 按文件名过滤, 不需要stat
+        """
+        ext = os.path.splitext(name)[1].lower()
+        if self.include_exts is not None and ext not in self.include_exts:
+            return False
+        return ext not in self.exclude_exts
+
+    def stat_match(self, stat: os.stat_result) -> bool:
+        """ 按文件大小过滤
+        """
+        if stat.st_size < self.min_size:
+            return False
+        return self.max_size is None or stat.st_size <= self.max_size
+
+
+class Walker:
+    """ 基于 os.scandir 的目录遍历
+    不使用递归, 目录深度不受递归深度限制; 文件类型使用目录项中的类型信息判断, 每个文件只stat一次;
+    workers > 1 时多个线程同时读取不同的目录, 适合NFS/CIFS等单次读取延迟高的文件系统;
+    结果通过有上限的队列逐个返回, 遍历与使用方的处理同时进行
+    """
+
+    def __init__(self, walk_filter: Optional[WalkFilter] = None, workers: int = 1, follow_links: bool = True,
+                 max_pending: int = 10000, on_error: Optional[Callable[[str, OSError], None]] = None):
+        """
+        :param walk_filter: 文件过滤条件, 为None时返回所有文件
+        :param workers: 同时读取目录的线程数, <=1 时在调用线程中遍历
+        :param follow_links: 是否进入指向目录的符号链接, 同一个目录只遍历一次, 避免链接成环
+        :param max_pending: 等待使用方取走的文件数量上限, 超过时遍历线程阻塞
+        :param on_error: 目录无法读取时的回调 (目录路径, 异常), 为None时忽略
+        """
+        self.__filter = walk_filter if walk_filter is not None else WalkFilter()
+        self.__workers = max(1, workers)
+        self.__follow_links = follow_links
+        self.__max_pending = max(1, max_pending)
+        self.__on_error = on_error
+
+    def __dir_scan(self, path: str, rel_dir: str, visited: Set[Tuple[int, int]], lock: threading.Lock) \
+            -> Tuple[List[WalkEntry], List[Tuple[str, str]]]:
+        """
+        读取一个目录
+        :param path: 目录路径
+        :param rel_dir: 目录相对根目录的路径
+        :param visited: 已经遍历的目录 (st_dev, st_ino)
+        :param lock: visited 的锁
+        :return: (文件, 子目录 (路径, 相对路径))
+        """
+        files = []
+        dirs = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=self.__follow_links):
+                            if self.__follow_links:
+                                st = entry.stat()
+                                key = (st.st_dev, st.st_ino)
+                                with lock:
+                                    if key in visited:
+                                        continue
+                                    visited.add(key)
+                            dirs.append((entry.path, os.path.join(rel_dir, entry.name)))
+                        elif entry.is_file() and self.__filter.name_match(entry.name):
+                            st = entry.stat()
+                            if self.__filter.stat_match(st):
+                                files.append(WalkEntry(entry.path, rel_dir, entry.name, st))
+                    except OSError:
+                        # 目录项在遍历过程中被删除
+                        continue
+        except OSError as e:
+            if self.__on_error is not None:
+                self.__on_error(path, e)
+        return files, dirs
+
+    def walk(self, root: str) -> Iterator[WalkEntry]:
+        """
+        遍历目录下的所有文件
+        :param root: 根目录
+        :return: 文件迭代器, 多线程遍历时顺序不确定
+        """
+        visited: Set[Tuple[int, int]] = set()
+        lock = threading.Lock()
+        try:
+            st = os.stat(root)
+            visited.add((st.st_dev, st.st_ino))
+        except OSError as e:
+            if self.__on_error is not None:
+                self.__on_error(root, e)
+            return
+        if self.__workers <= 1:
+            stack = [(root, "")]
+            while len(stack) > 0:
+                path, rel_dir = stack.pop()
+                files, dirs = self.__dir_scan(path, rel_dir, visited, lock)
+                yield from files
+                stack.extend(reversed(dirs))
+            return
+        yield from self.__walk_parallel(root, visited, lock)
+
+    def __walk_parallel(self, root: str, visited: Set[Tuple[int, int]], lock: threading.Lock) -> Iterator[WalkEntry]:
+        results: "queue.Queue" = queue.Queue(maxsize=self.__max_pending)
+        done = object()
+        stop = threading.Event()
+        pending = [1]  # 已提交还没有读取完成的目录数量
+
+        pool = ThreadPoolExecutor(max_workers=self.__workers, thread_name_prefix="walker")
+
+        def scan(path: str, rel_dir: str):
+            try:
+                if stop.is_set():
+                    return
+                files, dirs = self.__dir_scan(path, rel_dir, visited, lock)
+                with lock:
+                    pending[0] += len(dirs)
+                for sub in dirs:
+                    pool.submit(scan, *sub)
+                for entry in files:
+                    if stop.is_set():
+                        return
+                    results.put(entry)
+            finally:
+                with lock:
+                    pending[0] -= 1
+                    finished = pending[0] == 0
+                if finished:
+                    results.put(done)
+
+        pool.submit(scan, root, "")
+        try:
+            while True:
+                item = results.get()
+                if item is done:
+                    break
+                yield item
+        finally:
+            # 使用方提前结束迭代时通知遍历线程停止, 并取走队列中的结果使阻塞的线程退出
+            stop.set()
+            while True:
+                try:
+                    if results.get(timeout=0.1) is done:
+                        break
+                except queue.Empty:
+                    with lock:
+                        if pending[0] == 0:
+                            break
+            pool.shutdown(wait=True)
+
+
+def walk(root: str, include_exts: Optional[Iterable[str]] = None, exclude_exts: Optional[Iterable[str]] = None,
+         min_size: int = 0, max_size: Optional[int] = None, workers: int = 1,
+         on_error: Optional[Callable[[str, OSError], None]] = None) -> Iterator[WalkEntry]:
+    """
+    遍历目录下的所有文件, 参数见 WalkFilter 以及 Walker
+    :return: 文件迭代器
+    """
+    walk_filter = WalkFilter(include_exts, exclude_exts, min_size, max_size)
+    return Walker(walk_filter, workers=workers, on_error=on_error).walk(root)
@@ -0,0 +1,251 @@
+# coding: utf-8
+import collections
+import os
+import socket
+import threading
+import time
+import xmlrpc.client
+from socketserver import ThreadingMixIn
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+from xmlrpc.server import SimpleXMLRPCServer
+
+
+class LeaseQueue:
+    """ 基于租约的任务队列
+    工作进程租用任务后需要在租约到期前续约, 租约到期的任务重新放回队列, 由其他工作进程执行;
+    同一个任务租约到期超过 max_attempts 次后不再重试, 按失败处理
+    """
+
+    def __init__(self, lease_time: float = 600.0, max_attempts: int = 3,
+                 on_complete: Optional[Callable[[str, dict, Optional[dict]], None]] = None):
+        """
+        :param lease_time: 租约时长(秒)
+        :param max_attempts: 单个任务最多租用的次数
+        :param on_complete: 任务结束回调 (任务标识, 任务内容, 结果), 租约多次到期而放弃的任务结果为None
+        """
+        self.lease_time = lease_time
+        self.__max_attempts = max(1, max_attempts)
+        self.__on_complete = on_complete
+        self.__lock = threading.Lock()
+        self.__tasks: Dict[str, dict] = {}  # 没有结束的任务
+        self.__pending: Deque[str] = collections.deque()  # 等待租用的任务
+        self.__leases: Dict[str, Tuple[str, float]] = {}  # 任务标识 -> (工作进程, 到期时间)
+        self.__attempts: Dict[str, int] = {}
+        self.__closed = False
+        self.done = 0
+        self.failed = 0
+
+    def put(self, key: str, task: dict) -> None:
+        """ 发布任务, 标识相同的任务只保留一个
+        """
+        with self.__lock:
+            if key in self.__tasks:
+                return
+            self.__tasks[key] = task
+            self.__pending.append(key)
+
+    def close(self) -> None:
+        """ 所有任务已经发布
+        """
+        with self.__lock:
+            self.__closed = True
+
+    def lease(self, worker: str, n: int = 1) -> List[dict]:
+        """
+        租用任务
+        :param worker: 工作进程标识
+        :param n: 最多租用的任务数量
+        :return: [{"key": 任务标识, "task": 任务内容}]
+        """
+        self.reap()
+        res = []
+        expire = time.monotonic() + self.lease_time
+        with self.__lock:
+            while len(res) < n and len(self.__pending) > 0:
+                key = self.__pending.popleft()
+                if key not in self.__tasks:
+                    continue
+                self.__leases[key] = (worker, expire)
+                self.__attempts[key] = self.__attempts.get(key, 0) + 1
+                res.append({"key": key, "task": self.__tasks[key]})
+        return res
+
+    def renew(self, worker: str, keys: List[str]) -> int:
+        """
+        续约, 只能续约自己持有的任务
+        :return: 续约成功的任务数量
+        """
+        expire = time.monotonic() + self.lease_time
+        renewed = 0
+        with self.__lock:
+            for key in keys:
+                lease = self.__leases.get(key)
+                if lease is not None and lease[0] == worker:
+                    self.__leases[key] = (worker, expire)
+                    renewed += 1
+        return renewed
+
+    def complete(self, worker: str, key: str, result: dict) -> bool:
+        """
+        提交任务结果, 租约到期后仍然可以提交, 同一个任务只接受第一次提交的结果
+        :return: 结果是否被接受
+        """
+        with self.__lock:
+            task = self.__tasks.pop(key, None)
+            if task is None:
+                return False
+            self.__leases.pop(key, None)
+            self.__attempts.pop(key, None)
+            self.done += 1
+        if self.__on_complete is not None:
+            self.__on_complete(key, task, result)
+        return True
+
+    def reap(self) -> None:
+        """ 回收到期的租约
+        """
+        now = time.monotonic()
+        abandoned = []
+        with self.__lock:
+            for key, (_, expire) in list(self.__leases.items()):
+                if expire > now:
+                    continue
+                del self.__leases[key]
+                if self.__attempts.get(key, 0) >= self.__max_attempts:
+                    abandoned.append((key, self.__tasks.pop(key)))
+                    self.__attempts.pop(key, None)
+                    self.failed += 1
+                else:
+                    # 重新放到队首, 尽快由其他工作进程执行
+                    self.__pending.appendleft(key)
+        if self.__on_complete is not None:
+            for key, task in abandoned:
+                self.__on_complete(key, task, None)
+
+    def status(self) -> dict:
+        with self.__lock:
+            return {"pending": len(self.__pending), "leased": len(self.__leases), "done": self.done,
+                    "failed": self.failed, "closed": self.__closed,
+                    "finished": self.__closed and len(self.__tasks) == 0}
+
+    def finished(self) -> bool:
+        """ 所有任务已经发布并且全部结束
+        """
+        with self.__lock:
+            return self.__closed and len(self.__tasks) == 0
+
+
+class _ThreadingXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+class WorkQueueServer:
+    """ 通过XML-RPC对外提供 LeaseQueue, 工作进程使用 WorkQueueClient 访问
+    """
+
+    def __init__(self, work_queue: LeaseQueue, host: str = "0.0.0.0", port: int = 0):
+        """
+        :param work_queue: 任务队列
+        :param host: 监听地址
+        :param port: 监听端口, 为0时自动分配
+        """
+        self.queue = work_queue
+        self.__server = _ThreadingXMLRPCServer((host, port), allow_none=True, logRequests=False)
+        self.__server.register_function(self.__lease, "lease")
+        self.__server.register_function(self.__renew, "renew")
+        self.__server.register_function(self.__complete, "complete")
+        self.__server.register_function(self.queue.status, "status")
+        self.address = self.__server.server_address
+        self.__thread: Optional[threading.Thread] = None
+
+    def __lease(self, worker: str, n: int) -> dict:
+        return {"lease_time": self.queue.lease_time, "tasks": self.queue.lease(worker, n)}
+
+    def __renew(self, worker: str, keys: List[str]) -> int:
+        return self.queue.renew(worker, keys)
+
+    def __complete(self, worker: str, key: str, result: dict) -> bool:
+        return self.queue.complete(worker, key, result)
+
+    def start(self) -> None:
+        self.__thread = threading.Thread(target=self.__server.serve_forever, name="work-queue-server", daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        self.__server.shutdown()
+        self.__server.server_close()
+
+
+class WorkQueueClient:
+    """ 工作进程访问协调进程的任务队列
+    持有的任务由后台线程定期续约, 提交结果后不再续约
+    """
+
+    def __init__(self, address: str, worker: Optional[str] = None, poll_interval: float = 5.0):
+        """
+        :param address: 协调进程地址 host:port
+        :param worker: 工作进程标识, 为None时使用 主机名:进程号
+        :param poll_interval: 队列暂时为空时重试的间隔(秒)
+        """
+        self.__url = f"http://{address}/"
+        self.worker = worker if worker is not None else f"{socket.gethostname()}:{os.getpid()}"
+        self.poll_interval = poll_interval
+        # ServerProxy 不能在多个线程中同时使用, 每个线程单独创建
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__held: Dict[str, float] = {}
+        self.__lease_time: Optional[float] = None
+        self.__renew_thread: Optional[threading.Thread] = None
+        self.__stop = threading.Event()
+
+    def __proxy(self) -> xmlrpc.client.ServerProxy:
+        proxy = getattr(self.__local, "proxy", None)
+        if proxy is None:
+            proxy = xmlrpc.client.ServerProxy(self.__url, allow_none=True)
+            self.__local.proxy = proxy
+        return proxy
+
+    def lease(self, n: int = 1) -> List[dict]:
+        """
+        租用任务
+        :param n: 最多租用的任务数量
+        :return: [{"key": 任务标识, "task": 任务内容}]
+        """
+        res = self.__proxy().lease(self.worker, n)
+        tasks = res["tasks"]
+        with self.__lock:
+            self.__lease_time = res["lease_time"]
+            for item in tasks:
+                self.__held[item["key"]] = time.monotonic()
+        if len(tasks) > 0 and self.__renew_thread is None:
+            self.__renew_thread = threading.Thread(target=self.__renew_run, name="work-queue-renew", daemon=True)
+            self.__renew_thread.start()
+        return tasks
+
+    def complete(self, key: str, result: dict) -> bool:
+        """ 提交任务结果
+        """
+        with self.__lock:
+            self.__held.pop(key, None)
+        return self.__proxy().complete(self.worker, key, result)
+
+    def status(self) -> dict:
+        return self.__proxy().status()
+
+    def finished(self) -> bool:
+        return self.status()["finished"]
+
+    def close(self) -> None:
+        self.__stop.set()
+
+    def __renew_run(self) -> None:
+        while not self.__stop.wait(max(1.0, self.__lease_time / 3)):
+            with self.__lock:
+                keys = list(self.__held)
+            if len(keys) == 0:
+                continue
+            try:
+                self.__proxy().renew(self.worker, keys)
+            except (OSError, xmlrpc.client.Error):
+                # 协调进程暂时不可用, 下次继续续约
+                pass